@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Platform9 Systems Inc.(http://www.platform9.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Benchmark of the evaluation engines finding the VMs past the tenant default policy.
+Every engine evaluates the same synthetic tenant, the decisions are checked to be
+identical and the best time of a few repeats is reported. The VMs are built before
+each repeat as the Nova lease handler lists them, with the creation times still
+formatted, or with --parsed as records holding datetime objects.
+
+    python benchmark/evaluation_benchmark.py --vms 1000 10000 100000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from mors import evaluation
+from mors.records import VmRecord
+from mors.serialization import DATE_FORMAT
+
+ENGINES = [evaluation.ENGINE_PYTHON, evaluation.ENGINE_NUMPY]
+
+
+def _get_arg_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the mors evaluation engines")
+    parser.add_argument('--vms', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help="VMs of the evaluated tenant")
+    parser.add_argument('--lease-ratio', type=float, default=0.2,
+                        help="Fraction of the VMs with an explicit instance lease")
+    parser.add_argument('--expired-ratio', type=float, default=0.1,
+                        help="Fraction of the VMs past the tenant default policy")
+    parser.add_argument('--parsed', action='store_true',
+                        help="Build the VMs with parsed creation times instead of Nova formatted ones")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help="Write the results to this JSON file")
+    return parser.parse_args()
+
+
+def _make_tenant(vms, lease_ratio, expired_ratio, now):
+    """
+    :return: list of (instance_uuid, formatted creation time) and the ids with an explicit lease
+    """
+    rand = random.Random(vms)
+    servers = []
+    for i in range(vms):
+        age = timedelta(days=2) if rand.random() < expired_ratio else timedelta(hours=rand.randint(0, 23))
+        servers.append(("tenant-vm-%d" % i, (now - age).strftime(DATE_FORMAT)))
+    lease_ids = set(x[0] for x in rand.sample(servers, int(vms * lease_ratio)))
+    return servers, lease_ids
+
+
+def _make_records(servers, parsed):
+    if parsed:
+        return [VmRecord(x, "tenant", "ACTIVE", datetime.strptime(created, DATE_FORMAT)) for x, created in servers]
+    return [VmRecord(x, "tenant", "ACTIVE", created=created) for x, created in servers]
+
+
+def run_scale(args, vms):
+    now = datetime.utcnow()
+    add_seconds = timedelta(days=1)
+    servers, lease_ids = _make_tenant(vms, args.lease_ratio, args.expired_ratio, now)
+    results = {'vms': vms, 'engines': {}}
+    expected = None
+    for engine in ENGINES:
+        evaluator = evaluation.get_evaluator(engine)
+        if engine != evaluation.ENGINE_PYTHON and evaluator is evaluation.get_expired_vms:
+            continue
+        timings = []
+        for _ in range(args.repeat):
+            # Fresh records, a creation time parsed by an earlier repeat is kept by the record
+            tenant_vms = _make_records(servers, args.parsed)
+            start = time.perf_counter()
+            expired = evaluator(tenant_vms, lease_ids, now, add_seconds)
+            timings.append(time.perf_counter() - start)
+        if expected is None:
+            expected = expired
+        elif [x.instance_uuid for x in expired] != [x.instance_uuid for x in expected]:
+            raise SystemExit("Engine %s disagrees with the python engine at %d VMs" % (engine, vms))
+        results['engines'][engine] = {'seconds': min(timings), 'expired': len(expired)}
+    return results
+
+
+def main():
+    args = _get_arg_parser()
+    if args.repeat < 1:
+        raise SystemExit("--repeat must be at least 1")
+    scales = [run_scale(args, vms) for vms in args.vms]
+    print("%10s %10s %12s %12s %9s" % ('vms', 'expired', 'python', 'numpy', 'speedup'))
+    for scale in scales:
+        engines = scale['engines']
+        python_seconds = engines[evaluation.ENGINE_PYTHON]['seconds']
+        numpy_seconds = engines.get(evaluation.ENGINE_NUMPY, {}).get('seconds')
+        print("%10d %10d %11.4fs %12s %9s" % (
+            scale['vms'], engines[evaluation.ENGINE_PYTHON]['expired'], python_seconds,
+            "%.4fs" % numpy_seconds if numpy_seconds is not None else 'n/a',
+            "%.1fx" % (python_seconds / numpy_seconds) if numpy_seconds else 'n/a'))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'parameters': dict((k, v) for k, v in vars(args).items() if k != 'output'),
+                       'scales': scales}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
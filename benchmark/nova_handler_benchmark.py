@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Platform9 Systems Inc.(http://www.platform9.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+End to end benchmark of NovaLeaseHandler against the local OpenStack stand-in. The
+stand-in is started in a subprocess, then the real handler authenticates, lists the
+servers per tenant and for all tenants, and powers off and deletes a share of them.
+Each phase reports its duration and the requests the stand-in served, optionally
+under cProfile.
+
+    python benchmark/nova_handler_benchmark.py --tenants 100 --vms-per-tenant 100 --latency 0.005
+"""
+import eventlet
+eventlet.monkey_patch()
+import argparse
+import cProfile
+import json
+import logging
+import os
+import pstats
+import socket
+import subprocess
+import sys
+import time
+
+import requests
+from six.moves.configparser import ConfigParser
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from mors.leasehandler.http_session import get_connection_stats
+from mors.leasehandler.nova_lease_handler import NovaLeaseHandler
+
+STANDIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'openstack_standin.py')
+STANDIN_START_TIMEOUT = 30
+
+
+def _get_arg_parser():
+    parser = argparse.ArgumentParser(description="Benchmark NovaLeaseHandler against the OpenStack stand-in")
+    parser.add_argument('--tenants', type=int, default=10)
+    parser.add_argument('--vms-per-tenant', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0, help="Seconds added to every stand-in request")
+    parser.add_argument('--shutoff-ratio', type=float, default=0.5,
+                        help="Fraction of the servers already powered off")
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--not-found-rate', type=float, default=0)
+    parser.add_argument('--action-ratio', type=float, default=0.1,
+                        help="Fraction of the servers powered off and deleted")
+    parser.add_argument('--option', action='append', default=[], metavar='SECTION.NAME=VALUE',
+                        help="Extra handler option, for example nova.action_workers=8")
+    parser.add_argument('--profile', help="Write the cProfile statistics of all phases to this file")
+    parser.add_argument('--output', help="Write the results to this JSON file")
+    return parser.parse_args()
+
+
+def _get_free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _start_standin(args, port):
+    process = subprocess.Popen([sys.executable, STANDIN, '--port', str(port),
+                                '--tenants', str(args.tenants),
+                                '--vms-per-tenant', str(args.vms_per_tenant),
+                                '--shutoff-ratio', str(args.shutoff_ratio),
+                                '--latency', str(args.latency),
+                                '--error-rate', str(args.error_rate),
+                                '--not-found-rate', str(args.not_found_rate)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + STANDIN_START_TIMEOUT
+    while time.time() < deadline:
+        try:
+            requests.get('http://127.0.0.1:%d/standin/stats' % port)
+            return process
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("The OpenStack stand-in did not start on port %d" % port)
+
+
+def _get_conf(args, port):
+    conf = ConfigParser()
+    conf.read_string("[DEFAULT]\ninventory_mode=bulk\n[nova]\n")
+    options = {'nova.user_name': 'mors',
+               'nova.password': 'standin',
+               'nova.version': '2',
+               'nova.auth_url': 'http://127.0.0.1:%d/v3' % port,
+               'nova.region_name': 'RegionOne'}
+    for option in args.option:
+        name, value = option.split('=', 1)
+        options[name.strip()] = value.strip()
+    for name, value in options.items():
+        section, key = name.split('.', 1)
+        conf.set(section, key, value)
+    return conf
+
+
+class Phases:
+    def __init__(self, stats_url, profiler):
+        self.stats_url = stats_url
+        self.profiler = profiler
+        self.results = []
+
+    def run(self, name, function, *args):
+        requests.delete(self.stats_url)
+        if self.profiler:
+            self.profiler.enable()
+        start = time.time()
+        try:
+            result = function(*args)
+        finally:
+            seconds = time.time() - start
+            if self.profiler:
+                self.profiler.disable()
+        stats = requests.get(self.stats_url).json()
+        self.results.append({'phase': name,
+                             'seconds': seconds,
+                             'requests': dict((k, v) for k, v in stats.items() if k not in ('servers', 'tokens'))})
+        print("%-32s %9.3fs %s" % (name, seconds, self.results[-1]['requests']))
+        return result
+
+
+def main():
+    args = _get_arg_parser()
+    logging.basicConfig(level=logging.ERROR)
+    port = _get_free_port()
+    standin = _start_standin(args, port)
+    profiler = cProfile.Profile() if args.profile else None
+    phases = Phases('http://127.0.0.1:%d/standin/stats' % port, profiler)
+    try:
+        handler = phases.run('authenticate', NovaLeaseHandler, _get_conf(args, port))
+        phases.run('get_all_vms', lambda: [handler.get_all_vms("tenant-%d" % i) for i in range(args.tenants)])
+        phases.run('get_all_vms_by_tenant', handler.get_all_vms_by_tenant)
+        # Power off listings only return the running servers
+        inventory = phases.run('get_all_vms_by_tenant power off', handler.get_all_vms_by_tenant, 'power off')
+        vms = [vm for tenant_vms in inventory.values() for vm in tenant_vms]
+        count = int(len(vms) * args.action_ratio)
+        phases.run('poweroff_vms', handler.poweroff_vms, vms[:count])
+        phases.run('poweroff_vms stopped', handler.poweroff_vms, vms[:count])
+        phases.run('delete_vms', handler.delete_vms, vms[count:2 * count])
+    finally:
+        standin.kill()
+        standin.wait()
+
+    results = {'parameters': dict((k, v) for k, v in vars(args).items() if k not in ('output', 'profile')),
+               'phases': phases.results,
+               'connections': get_connection_stats()}
+    print("Connections: %s" % results['connections'])
+    if profiler:
+        profiler.dump_stats(args.profile)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Platform9 Systems Inc.(http://www.platform9.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Local stand-in for the Keystone v3 and Nova APIs used by NovaLeaseHandler, for
+exercising the real handler without an OpenStack deployment. It serves token
+issue with a service catalog, the paginated server listing with the filters the
+handler sends, server stop and server delete, on an in-memory fleet. Latency,
+server errors and 404s can be injected, and /standin/stats reports the requests
+served per operation.
+
+    python benchmark/openstack_standin.py --port 5000 --tenants 100 --vms-per-tenant 100
+
+The handler is then pointed at it with auth_url=http://127.0.0.1:5000/v3 in the
+[nova] section, any user name and password are accepted.
+"""
+import eventlet
+eventlet.monkey_patch()
+import argparse
+import random
+import uuid
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
+
+from eventlet import wsgi
+from flask import Flask, jsonify, request
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+PROJECT_ID = 'standin-services'
+DEFAULT_TOKEN_TTL = 3600
+MAX_PAGE_SIZE = 1000
+COMPUTE_MICROVERSION = '2.79'
+
+OP_TOKEN = 'token'
+OP_LIST = 'servers.list'
+OP_STOP = 'stop'
+OP_DELETE = 'delete'
+
+
+def _format(value):
+    return value.strftime(DATE_FORMAT)
+
+
+class Fleet:
+    """
+    In-memory servers ordered by id, the order of a Nova listing without sort keys.
+    Deleted servers are kept with status DELETED for changes-since listings.
+    """
+    def __init__(self, tenants, vms_per_tenant, max_age_hours, shutoff_ratio, seed=0):
+        rand = random.Random(seed)
+        now = datetime.utcnow()
+        servers = []
+        for i in range(tenants):
+            tenant_id = "tenant-%d" % i
+            for j in range(vms_per_tenant):
+                created = now - timedelta(seconds=rand.randint(0, int(max_age_hours * 3600)))
+                servers.append({'id': str(uuid.UUID(int=rand.getrandbits(128))),
+                                'name': "%s-vm-%d" % (tenant_id, j),
+                                'tenant_id': tenant_id,
+                                'created': created,
+                                'updated': created,
+                                'status': 'SHUTOFF' if rand.random() < shutoff_ratio else 'ACTIVE'})
+        self.servers = OrderedDict((x['id'], x) for x in sorted(servers, key=lambda x: x['id']))
+
+    def touch(self, server, status):
+        server['status'] = status
+        server['updated'] = datetime.utcnow()
+
+
+def _server_detail(server, base_url):
+    """
+    Server record with the fields of a Nova 2.1 detailed listing
+    """
+    server_url = "%s/servers/%s" % (base_url, server['id'])
+    return {'id': server['id'],
+            'name': server['name'],
+            'status': server['status'],
+            'tenant_id': server['tenant_id'],
+            'user_id': 'standin-user',
+            'metadata': {},
+            'hostId': 'standin-host-%s' % server['tenant_id'],
+            'image': {'id': 'standin-image', 'links': [{'rel': 'bookmark', 'href': base_url + '/images/standin-image'}]},
+            'flavor': {'id': 'standin-flavor',
+                       'links': [{'rel': 'bookmark', 'href': base_url + '/flavors/standin-flavor'}]},
+            'created': _format(server['created']),
+            'updated': _format(server['updated']),
+            'addresses': {'private': [{'version': 4, 'addr': '10.0.0.1', 'OS-EXT-IPS:type': 'fixed',
+                                       'OS-EXT-IPS-MAC:mac_addr': 'fa:16:3e:00:00:01'}]},
+            'accessIPv4': '',
+            'accessIPv6': '',
+            'links': [{'rel': 'self', 'href': server_url}, {'rel': 'bookmark', 'href': server_url}],
+            'OS-DCF:diskConfig': 'MANUAL',
+            'progress': 0,
+            'OS-EXT-AZ:availability_zone': 'nova',
+            'config_drive': '',
+            'key_name': None,
+            'OS-SRV-USG:launched_at': _format(server['created']),
+            'OS-SRV-USG:terminated_at': None,
+            'OS-EXT-SRV-ATTR:host': 'standin-host',
+            'OS-EXT-SRV-ATTR:instance_name': 'instance-%s' % server['id'][:8],
+            'OS-EXT-SRV-ATTR:hypervisor_hostname': 'standin-host',
+            'OS-EXT-STS:task_state': None,
+            'OS-EXT-STS:vm_state': 'stopped' if server['status'] == 'SHUTOFF' else 'active',
+            'OS-EXT-STS:power_state': 4 if server['status'] == 'SHUTOFF' else 1,
+            'os-extended-volumes:volumes_attached': [],
+            'security_groups': [{'name': 'default'}]}
+
+
+def create_app(fleet, latency=0, error_rate=0, not_found_rate=0, token_ttl=DEFAULT_TOKEN_TTL,
+               region='RegionOne', seed=0):
+    """
+    :param latency: seconds added to every request
+    :param error_rate: fraction of the Nova requests answered with a 500
+    :param not_found_rate: fraction of the stop and delete requests answered with a 404
+    :param token_ttl: lifetime of the issued tokens in seconds
+    """
+    app = Flask("openstack-standin")
+    rand = random.Random(seed)
+    tokens = {}
+    stats = Counter()
+
+    def _base_url():
+        return request.host_url.rstrip('/')
+
+    def _compute_url():
+        return _base_url() + '/compute/v2.1'
+
+    def _fault():
+        if latency:
+            eventlet.sleep(latency)
+        if error_rate and rand.random() < error_rate:
+            stats['injected_errors'] += 1
+            return _error(500, 'computeFault', 'Injected error')
+        return None
+
+    def _error(code, kind, message):
+        return jsonify({kind: {'code': code, 'message': message}}), code
+
+    def _authorized():
+        expires = tokens.get(request.headers.get('X-Auth-Token'))
+        return expires is not None and expires > datetime.utcnow()
+
+    @app.route('/', methods=['GET'])
+    @app.route('/v3', methods=['GET'])
+    @app.route('/v3/', methods=['GET'])
+    def identity_versions():
+        return jsonify({'version': {'id': 'v3.14', 'status': 'stable', 'updated': '2020-04-07T00:00:00Z',
+                                    'links': [{'rel': 'self', 'href': _base_url() + '/v3/'}],
+                                    'media-types': [{'base': 'application/json',
+                                                     'type': 'application/vnd.openstack.identity-v3+json'}]}})
+
+    @app.route('/v3/auth/tokens', methods=['POST'])
+    def issue_token():
+        stats[OP_TOKEN] += 1
+        if latency:
+            eventlet.sleep(latency)
+        token_id = uuid.uuid4().hex
+        now = datetime.utcnow()
+        tokens[token_id] = now + timedelta(seconds=token_ttl)
+        endpoints = [{'id': 'compute-' + interface, 'interface': interface, 'region': region,
+                      'region_id': region, 'url': _compute_url()}
+                     for interface in ('public', 'internal', 'admin')]
+        identity = [{'id': 'identity-' + interface, 'interface': interface, 'region': region,
+                     'region_id': region, 'url': _base_url() + '/v3'}
+                    for interface in ('public', 'internal', 'admin')]
+        body = {'token': {'methods': ['password'],
+                          'expires_at': tokens[token_id].strftime("%Y-%m-%dT%H:%M:%S.000000Z"),
+                          'issued_at': now.strftime("%Y-%m-%dT%H:%M:%S.000000Z"),
+                          'user': {'id': 'standin-user', 'name': 'mors',
+                                   'domain': {'id': 'default', 'name': 'Default'}},
+                          'project': {'id': PROJECT_ID, 'name': 'services',
+                                      'domain': {'id': 'default', 'name': 'Default'}},
+                          'roles': [{'id': 'admin', 'name': 'admin'}],
+                          'catalog': [{'id': 'compute', 'type': 'compute', 'name': 'nova', 'endpoints': endpoints},
+                                      {'id': 'identity', 'type': 'identity', 'name': 'keystone',
+                                       'endpoints': identity}]}}
+        response = jsonify(body)
+        response.status_code = 201
+        response.headers['X-Subject-Token'] = token_id
+        return response
+
+    @app.route('/compute', methods=['GET'])
+    @app.route('/compute/', methods=['GET'])
+    @app.route('/compute/v2.1', methods=['GET'])
+    @app.route('/compute/v2.1/', methods=['GET'])
+    def compute_versions():
+        return jsonify({'version': {'id': 'v2.1', 'status': 'CURRENT', 'version': COMPUTE_MICROVERSION,
+                                    'min_version': '2.1', 'updated': '2013-07-23T11:33:21Z',
+                                    'links': [{'rel': 'self', 'href': _compute_url() + '/'}]}})
+
+    @app.route('/compute/v2.1/servers/detail', methods=['GET'])
+    def list_servers():
+        stats[OP_LIST] += 1
+        fault = _fault()
+        if fault:
+            return fault
+        if not _authorized():
+            return _error(401, 'unauthorized', 'Invalid or expired token')
+        args = request.args
+        limit = min(int(args.get('limit', MAX_PAGE_SIZE)), MAX_PAGE_SIZE)
+        marker = args.get('marker')
+        tenant_id = args.get('tenant_id') or args.get('project_id')
+        statuses = set(args.getlist('status'))
+        changes_since = args.get('changes-since')
+        if changes_since:
+            changes_since = datetime.strptime(changes_since, DATE_FORMAT)
+        if marker and marker not in fleet.servers:
+            return _error(400, 'badRequest', 'marker [%s] not found' % marker)
+        servers = []
+        started = marker is None
+        for server_id, server in fleet.servers.items():
+            if not started:
+                started = server_id == marker
+                continue
+            if tenant_id and server['tenant_id'] != tenant_id:
+                continue
+            if changes_since is not None:
+                if server['updated'] < changes_since:
+                    continue
+            elif server['status'] == 'DELETED':
+                continue
+            if statuses and server['status'] not in statuses:
+                continue
+            servers.append(server)
+            if len(servers) > limit:
+                break
+        body = {'servers': [_server_detail(x, _compute_url()) for x in servers[:limit]]}
+        if len(servers) > limit:
+            body['servers_links'] = [{'rel': 'next', 'href': '%s/servers/detail?limit=%d&marker=%s'
+                                      % (_compute_url(), limit, servers[limit - 1]['id'])}]
+        stats['servers_listed'] += len(body['servers'])
+        return jsonify(body)
+
+    def _get_server(server_id):
+        server = fleet.servers.get(server_id)
+        if server is None or server['status'] == 'DELETED' or \
+                (not_found_rate and rand.random() < not_found_rate):
+            return None
+        return server
+
+    @app.route('/compute/v2.1/servers/<server_id>/action', methods=['POST'])
+    def server_action(server_id):
+        stats[OP_STOP] += 1
+        fault = _fault()
+        if fault:
+            return fault
+        if not _authorized():
+            return _error(401, 'unauthorized', 'Invalid or expired token')
+        if 'os-stop' not in (request.get_json(force=True) or {}):
+            return _error(400, 'badRequest', 'Only os-stop is supported')
+        server = _get_server(server_id)
+        if server is None:
+            return _error(404, 'itemNotFound', 'Instance %s could not be found.' % server_id)
+        if server['status'] == 'SHUTOFF':
+            return _error(409, 'conflictingRequest',
+                          "Cannot 'stop' instance %s while it is in vm_state stopped" % server_id)
+        fleet.touch(server, 'SHUTOFF')
+        return '', 202
+
+    @app.route('/compute/v2.1/servers/<server_id>', methods=['DELETE'])
+    def delete_server(server_id):
+        stats[OP_DELETE] += 1
+        fault = _fault()
+        if fault:
+            return fault
+        if not _authorized():
+            return _error(401, 'unauthorized', 'Invalid or expired token')
+        server = _get_server(server_id)
+        if server is None:
+            return _error(404, 'itemNotFound', 'Instance %s could not be found.' % server_id)
+        fleet.touch(server, 'DELETED')
+        return '', 204
+
+    @app.route('/standin/stats', methods=['GET'])
+    def get_stats():
+        return jsonify(dict(stats, servers=len(fleet.servers), tokens=len(tokens)))
+
+    @app.route('/standin/stats', methods=['DELETE'])
+    def reset_stats():
+        stats.clear()
+        return '', 204
+
+    return app
+
+
+def _get_arg_parser():
+    parser = argparse.ArgumentParser(description="Keystone v3 and Nova stand-in for NovaLeaseHandler")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--tenants', type=int, default=10)
+    parser.add_argument('--vms-per-tenant', type=int, default=100)
+    parser.add_argument('--max-age-hours', type=float, default=72,
+                        help="Servers are created at random times up to this many hours ago")
+    parser.add_argument('--shutoff-ratio', type=float, default=0.1,
+                        help="Fraction of the servers that start powered off")
+    parser.add_argument('--latency', type=float, default=0, help="Seconds added to every request")
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help="Fraction of the Nova requests answered with a 500")
+    parser.add_argument('--not-found-rate', type=float, default=0,
+                        help="Fraction of the stop and delete requests answered with a 404")
+    parser.add_argument('--token-ttl', type=int, default=DEFAULT_TOKEN_TTL)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def main():
+    args = _get_arg_parser()
+    fleet = Fleet(args.tenants, args.vms_per_tenant, args.max_age_hours, args.shutoff_ratio, args.seed)
+    app = create_app(fleet, args.latency, args.error_rate, args.not_found_rate, args.token_ttl, seed=args.seed)
+    wsgi.server(eventlet.listen((args.host, args.port)), app, log_output=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Platform9 Systems Inc.(http://www.platform9.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Scheduler benchmark against a synthetic fleet. For each scale a database is seeded
+with tenant and instance leases, then LeaseManager.run() is timed over a few cycles
+with the fake lease handler. Cycle time, database queries and lease handler calls
+are written as JSON, a previous result file can be passed to compare against.
+
+    python benchmark/scheduler_benchmark.py --vms 100 10000 100000 --output results.json
+"""
+import eventlet
+eventlet.monkey_patch()
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from migrate.versioning.api import upgrade, version_control
+from six.moves.configparser import ConfigParser
+from sqlalchemy import event
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from mors.lease_manager import LeaseManager
+from mors.leasehandler.fake_lease_handler import FakeLeaseHandler
+from mors.persistence import DbPersistence
+
+MIGRATE_REPO = os.path.join(REPO_ROOT, 'mors_repo')
+SEED_BATCH_SIZE = 5000
+
+
+def _get_arg_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the mors scheduler against a synthetic fleet")
+    parser.add_argument('--vms', type=int, nargs='+', default=[100, 10000, 100000],
+                        help="Fleet sizes to benchmark")
+    parser.add_argument('--vms-per-tenant', type=int, default=100)
+    parser.add_argument('--lease-ratio', type=float, default=0.2,
+                        help="Fraction of the VMs with an explicit instance lease")
+    parser.add_argument('--expired-ratio', type=float, default=0.1,
+                        help="Fraction of the VMs and instance leases that are expired")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="Seconds added to every lease handler call")
+    parser.add_argument('--cycles', type=int, default=3)
+    parser.add_argument('--inventory-mode', default='tenant')
+    parser.add_argument('--scheduler-concurrency', type=int, default=1)
+    parser.add_argument('--db', help="SQLAlchemy URL of an empty database, a temporary SQLite file by default")
+    parser.add_argument('--option', action='append', default=[], metavar='NAME=VALUE',
+                        help="Extra DEFAULT section option passed to the LeaseManager")
+    parser.add_argument('--output', help="Write the results to this JSON file")
+    parser.add_argument('--baseline', help="Results JSON of a previous run to compare against")
+    return parser.parse_args()
+
+
+def _get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _create_db(args, vms):
+    if args.db:
+        return args.db, None
+    path = os.path.join(tempfile.mkdtemp(prefix='mors-benchmark-'), 'mors-%d.db' % vms)
+    return 'sqlite:///' + path, path
+
+
+def _seed(db_url, tenant_count, vms_per_tenant, lease_ratio, expired_ratio, now):
+    """
+    Seed tenant policies and instance leases. Every tenant powers off VMs older than a
+    day, the fleet is created so that expired_ratio of the VMs are past that.
+    """
+    version_control(db_url, MIGRATE_REPO)
+    upgrade(db_url, MIGRATE_REPO)
+    db = DbPersistence(db_url)
+    leases_per_tenant = int(vms_per_tenant * lease_ratio)
+    expired_leases = int(leases_per_tenant * expired_ratio)
+    with db.engine.begin() as conn:
+        conn.execute(db.tenant_lease.insert(), [
+            {'tenant_uuid': "tenant-%d" % i, 'expiry_mins': 24 * 60, 'action': 'power off',
+             'created_at': now, 'created_by': 'benchmark'} for i in range(tenant_count)])
+        rows = []
+        for i in range(tenant_count):
+            for j in range(leases_per_tenant):
+                expiry = now - timedelta(hours=1) if j < expired_leases else now + timedelta(days=7)
+                rows.append({'instance_uuid': "tenant-%d-vm-%d" % (i, j), 'tenant_uuid': "tenant-%d" % i,
+                             'expiry': expiry, 'action': 'power off', 'created_at': now,
+                             'created_by': 'benchmark'})
+                if len(rows) >= SEED_BATCH_SIZE:
+                    conn.execute(db.instance_lease.insert(), rows)
+                    rows = []
+        if rows:
+            conn.execute(db.instance_lease.insert(), rows)
+    db.engine.dispose()
+    return tenant_count * leases_per_tenant
+
+
+def _make_fleet(tenant_count, vms_per_tenant, expired_ratio, now):
+    fleet = FakeLeaseHandler.generate_fleet(tenant_count, vms_per_tenant, now - timedelta(hours=1))
+    expired = int(vms_per_tenant * expired_ratio)
+    for vms in fleet.values():
+        # The VMs with the highest index are past the tenant policy, the explicit leases cover the lowest
+        for vm in vms[len(vms) - expired:]:
+            vm.created_at = now - timedelta(days=2)
+    return fleet
+
+
+def _get_conf(args, db_url):
+    conf = ConfigParser()
+    conf.read_string("[DEFAULT]\n")
+    defaults = {'db_conn': db_url,
+                'lease_handler': 'test',
+                'sleep_seconds': '3600',
+                'inventory_mode': args.inventory_mode,
+                'scheduler_concurrency': str(args.scheduler_concurrency),
+                'inventory_cache_ttl': '0',
+                'fake_handler_latency': str(args.latency)}
+    for option in args.option:
+        name, value = option.split('=', 1)
+        defaults[name.strip()] = value.strip()
+    for name, value in defaults.items():
+        conf.set("DEFAULT", name, value)
+    return conf
+
+
+def run_scale(args, vms):
+    tenant_count = max(1, vms // args.vms_per_tenant)
+    vms_per_tenant = min(vms, args.vms_per_tenant)
+    now = datetime.utcnow()
+    db_url, db_path = _create_db(args, vms)
+    instance_leases = _seed(db_url, tenant_count, vms_per_tenant, args.lease_ratio, args.expired_ratio, now)
+    _make_fleet(tenant_count, vms_per_tenant, args.expired_ratio, now)
+
+    lease_manager = LeaseManager(_get_conf(args, db_url))
+    queries = []
+    event.listen(lease_manager.domain_mgr.engine, 'before_cursor_execute', lambda *x: queries.append(1))
+    handler = lease_manager.lease_handler.lease_handler
+
+    cycles = []
+    try:
+        for _ in range(args.cycles):
+            del queries[:]
+            handler.calls.clear()
+            start = time.time()
+            lease_manager.run()
+            cycles.append({'seconds': time.time() - start,
+                           'db_queries': len(queries),
+                           'handler_calls': dict(handler.calls),
+                           'vms_evaluated': lease_manager.scheduler_state['vms'],
+                           'powered_off': lease_manager.scheduler_state['powered_off']})
+            if lease_manager._scheduler_timer is not None:
+                lease_manager._scheduler_timer.cancel()
+    finally:
+        lease_manager.domain_mgr.engine.dispose()
+        if db_path:
+            os.remove(db_path)
+            os.rmdir(os.path.dirname(db_path))
+
+    seconds = sorted(x['seconds'] for x in cycles)
+    return {'vms': tenant_count * vms_per_tenant,
+            'tenants': tenant_count,
+            'instance_leases': instance_leases,
+            'cycles': cycles,
+            'min_cycle_seconds': seconds[0],
+            'median_cycle_seconds': seconds[len(seconds) // 2],
+            'db_queries': cycles[-1]['db_queries'],
+            'handler_calls': sum(cycles[-1]['handler_calls'].values())}
+
+
+def _print_results(results, baseline):
+    baseline_by_vms = {}
+    if baseline:
+        baseline_by_vms = dict((x['vms'], x) for x in baseline['scales'])
+    print("%10s %8s %14s %10s %14s %10s" % ('vms', 'tenants', 'median cycle', 'db queries',
+                                             'handler calls', 'vs base'))
+    for scale in results['scales']:
+        base = baseline_by_vms.get(scale['vms'])
+        change = ''
+        if base:
+            change = "%+.1f%%" % ((scale['median_cycle_seconds'] / base['median_cycle_seconds'] - 1) * 100)
+        print("%10d %8d %13.3fs %10d %14d %10s" % (scale['vms'], scale['tenants'], scale['median_cycle_seconds'],
+                                                   scale['db_queries'], scale['handler_calls'], change))
+
+
+def main():
+    args = _get_arg_parser()
+    logging.basicConfig(level=logging.WARNING)
+    if args.cycles < 1:
+        raise SystemExit("--cycles must be at least 1")
+    results = {'commit': _get_commit(),
+               'timestamp': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+               'python': platform.python_version(),
+               'parameters': dict((k, v) for k, v in vars(args).items() if k not in ('output', 'baseline')),
+               'scales': [run_scale(args, vms) for vms in args.vms]}
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    _print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
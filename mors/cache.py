@@ -0,0 +1,66 @@
+"""
+Copyright 2016 Platform9 Systems Inc.(http://www.platform9.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Simple in-process cache where entries expire 'ttl' seconds after they are set.
+    With a max_size the least recently used entries are evicted once the cache is full.
+    Keeps hit, miss, invalidation and eviction counters.
+    """
+    def __init__(self, ttl, max_size=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is not None and time.time() < entry[0]:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[1]
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        self._entries[key] = (time.time() + self.ttl, value)
+        self._entries.move_to_end(key)
+        if self.max_size and len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        if self._entries.pop(key, None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self.invalidations += len(self._entries)
+        self._entries = OrderedDict()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'evictions': self.evictions,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0}
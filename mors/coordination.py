@@ -0,0 +1,122 @@
+"""
+Copyright 2016 Platform9 Systems Inc.(http://www.platform9.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import bisect
+import hashlib
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+
+from mors.constants import LOGGER_PREFIX
+
+logger = logging.getLogger(LOGGER_PREFIX+__name__)
+
+# Points per member on the hash ring, more points spread the tenants more evenly
+DEFAULT_RING_REPLICAS = 64
+
+# Longest time the ring may go without a refresh when ownership is checked before acting
+DEFAULT_FENCE_SECONDS = 5
+
+
+def _hash(value):
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+
+def get_default_member_id():
+    return "%s-%d-%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+class HashRing:
+    """
+    Consistent hash ring, a key belongs to the first member point at or after the
+    hash of the key. Adding or removing a member only moves the keys of that member.
+    """
+    def __init__(self, members, replicas=DEFAULT_RING_REPLICAS):
+        self.members = sorted(members)
+        points = sorted((_hash("%s#%d" % (member, i)), member)
+                        for member in self.members for i in range(replicas))
+        self._hashes = [x[0] for x in points]
+        self._members = [x[1] for x in points]
+
+    def get_member(self, key):
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._members[index]
+
+
+class SchedulerCoordinator:
+    """
+    Splits the tenants between the scheduler replicas sharing a database. Each replica
+    heartbeats into the scheduler_member table, the replicas with a heartbeat newer than
+    heartbeat_timeout are live and the tenants are partitioned between them with a
+    consistent hash of the tenant_uuid.
+
+    Replicas do not lock tenants. While a member joins or expires, the replicas can
+    disagree on an owner until each of them refreshed its ring. fence() bounds that
+    window to fence_seconds plus the time a tenant takes to act on, in that window two
+    replicas can both act on the same VMs. A repeated delete or power off is answered as
+    not found or already stopped, which the scheduler treats as done.
+    """
+    def __init__(self, domain_mgr, member_id, heartbeat_timeout, fence_seconds=DEFAULT_FENCE_SECONDS):
+        self.domain_mgr = domain_mgr
+        self.member_id = member_id
+        self.hostname = socket.gethostname()
+        self.heartbeat_timeout = heartbeat_timeout
+        self.fence_seconds = fence_seconds
+        self.ring = HashRing([member_id])
+        self.refreshed_at = None
+
+    def heartbeat(self, now=None):
+        now = now or datetime.utcnow()
+        self.domain_mgr.heartbeat_scheduler_member(self.member_id, self.hostname, now)
+
+    def refresh(self, now=None):
+        """
+        Heartbeat, drop expired members and rebuild the ring from the live members
+        :return: True when the set of live members changed
+        """
+        now = now or datetime.utcnow()
+        self.heartbeat(now)
+        expiry = now - timedelta(seconds=self.heartbeat_timeout)
+        expired = self.domain_mgr.delete_expired_scheduler_members(expiry)
+        if expired:
+            logger.info("Removed %d scheduler members with expired heartbeats", expired)
+        members = self.domain_mgr.get_live_scheduler_members(expiry)
+        self.refreshed_at = now
+        if self.member_id not in members:
+            members.append(self.member_id)
+        if sorted(members) == self.ring.members:
+            return False
+        logger.info("Scheduler members changed from %s to %s, rebalancing tenants",
+                    self.ring.members, sorted(members))
+        self.ring = HashRing(members)
+        return True
+
+    def owns(self, tenant_uuid):
+        return self.ring.get_member(tenant_uuid) == self.member_id
+
+    def fence(self, tenant_uuid, now=None):
+        """
+        Ownership check right before acting on a tenant, the ring is refreshed first when
+        it is older than fence_seconds
+        :return: True when this replica still owns the tenant
+        """
+        now = now or datetime.utcnow()
+        if self.refreshed_at is None or now - self.refreshed_at >= timedelta(seconds=self.fence_seconds):
+            self.refresh(now)
+        return self.owns(tenant_uuid)
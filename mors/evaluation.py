@@ -0,0 +1,86 @@
+"""
+Copyright 2016 Platform9 Systems Inc.(http://www.platform9.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import logging
+
+from mors.constants import LOGGER_PREFIX
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(LOGGER_PREFIX+__name__)
+
+ENGINE_PYTHON = 'python'
+ENGINE_NUMPY = 'numpy'
+
+
+def get_expired_vms(tenant_vms, vm_lease_ids, now, add_seconds):
+    """
+    VMs past the tenant default policy, VMs with an explicit lease are left out
+    :param tenant_vms: vms of the tenant
+    :param vm_lease_ids: ids of the VMs with an explicit lease
+    :param add_seconds: timedelta of the tenant default policy
+    :return: list of the expired VMs in listing order
+    """
+    expired = []
+    for vm in tenant_vms:
+        #If VM has an explicit VM lease, skip applying tenant default policy to it
+        if vm.instance_uuid in vm_lease_ids:
+            logger.debug("Skipping VM %s due to explicit VM lease", vm.instance_uuid)
+            continue
+        if now > vm.created_at + add_seconds:
+            expired.append(vm)
+        else:
+            logger.debug("Ignoring vm, vm not expired yet or already powered off or deleted %s, %s",
+                         vm.instance_uuid, vm.created_at)
+    return expired
+
+
+def get_expired_vms_numpy(tenant_vms, vm_lease_ids, now, add_seconds):
+    """
+    Same decisions as get_expired_vms. The creation times of a Nova listing are parsed
+    by numpy into one datetime64 array and compared to the policy cutoff, then only the
+    expired VMs are joined against the explicit leases with a sorted array lookup. VMs
+    whose creation time is already a datetime are evaluated by get_expired_vms, numpy
+    converts datetime objects slower than the loop compares them.
+    """
+    if not tenant_vms or tenant_vms[0].created is None:
+        return get_expired_vms(tenant_vms, vm_lease_ids, now, add_seconds)
+    created = [vm.created for vm in tenant_vms]
+    if None in created:
+        return get_expired_vms(tenant_vms, vm_lease_ids, now, add_seconds)
+    # The trailing Z is dropped, numpy warns about time zones
+    created_at = numpy.array([x[:-1] for x in created], dtype='datetime64[s]')
+    # now > created_at + add_seconds, with the addition done once
+    expired = numpy.flatnonzero(created_at < numpy.datetime64(now - add_seconds, 'us'))
+    if vm_lease_ids and len(expired):
+        expired_ids = numpy.array([tenant_vms[i].instance_uuid for i in expired])
+        expired = expired[~numpy.isin(expired_ids, numpy.array(list(vm_lease_ids)))]
+    return [tenant_vms[i] for i in expired]
+
+
+def get_evaluator(engine):
+    """
+    Function finding the expired VMs of a tenant, numpy is only used when it is installed
+    """
+    if engine == ENGINE_NUMPY:
+        if numpy is not None:
+            return get_expired_vms_numpy
+        logger.warning("numpy is not installed, using the python evaluation engine")
+    elif engine != ENGINE_PYTHON:
+        logger.warning("Unknown evaluation engine %s, using the python evaluation engine", engine)
+    return get_expired_vms
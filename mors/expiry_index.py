@@ -0,0 +1,99 @@
+"""
+Copyright 2016 Platform9 Systems Inc.(http://www.platform9.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import heapq
+import itertools
+
+INSTANCE = 'instance'
+TENANT = 'tenant'
+
+
+class ExpiryIndex:
+    """
+    Min-heap of the next effective expiry of each instance lease and each tenant
+    default policy. Every entry is keyed by (kind, uuid) and remembers the tenant it
+    belongs to. Pushing a key again or removing it leaves the old heap item in place,
+    stale items are skipped when they reach the top of the heap.
+    """
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def push(self, kind, uuid, due, tenant_uuid):
+        """
+        Add or move the entry for (kind, uuid) to 'due'
+        :return: True if the entry is now the earliest one in the index
+        """
+        key = (kind, uuid)
+        seq = next(self._counter)
+        self._entries[key] = (due, seq, tenant_uuid)
+        heapq.heappush(self._heap, (due, seq, key))
+        return self.next_due() == due
+
+    def push_instance(self, instance_uuid, due, tenant_uuid):
+        return self.push(INSTANCE, instance_uuid, due, tenant_uuid)
+
+    def push_tenant(self, tenant_uuid, due, keep_earlier=False):
+        """
+        :param keep_earlier: leave the tenant entry in place when it is already due before 'due'
+        """
+        current = self._entries.get((TENANT, tenant_uuid))
+        if keep_earlier and current is not None and current[0] <= due:
+            return False
+        return self.push(TENANT, tenant_uuid, due, tenant_uuid)
+
+    def remove(self, kind, uuid):
+        self._entries.pop((kind, uuid), None)
+
+    def remove_tenant(self, tenant_uuid):
+        """
+        Remove the tenant default policy entry and all instance entries of a tenant
+        """
+        for key in [k for k, v in self._entries.items() if v[2] == tenant_uuid]:
+            del self._entries[key]
+
+    def clear(self):
+        self._heap = []
+        self._entries = {}
+
+    def _is_current(self, item):
+        entry = self._entries.get(item[2])
+        return entry is not None and entry[1] == item[1]
+
+    def next_due(self):
+        """
+        :return: datetime of the earliest entry, None if the index is empty
+        """
+        while self._heap and not self._is_current(self._heap[0]):
+            heapq.heappop(self._heap)
+        if self._heap:
+            return self._heap[0][0]
+        return None
+
+    def pop_due(self, now):
+        """
+        Remove all entries due at or before 'now'
+        :return: set of tenant uuids that have at least one due entry
+        """
+        tenants = set()
+        while self._heap and self._heap[0][0] <= now:
+            item = heapq.heappop(self._heap)
+            if self._is_current(item):
+                tenants.add(self._entries.pop(item[2])[2])
+        return tenants
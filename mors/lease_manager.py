@@ -16,46 +16,62 @@ limitations under the License.
 
 from datetime import datetime, timedelta
 
+from .coordination import SchedulerCoordinator, get_default_member_id, DEFAULT_FENCE_SECONDS
+from .evaluation import get_evaluator, ENGINE_PYTHON
+from .expiry_index import ExpiryIndex, INSTANCE
 from .leasehandler import get_lease_handler
-from .persistence import DbPersistence
+from .persistence import DbPersistence, DEFAULT_DELETE_BATCH_SIZE, DEFAULT_POOL_SIZE, DEFAULT_MAX_OVERFLOW, \
+    DEFAULT_POOL_TIMEOUT, DEFAULT_POOL_RECYCLE
+from .persistence_cache import CachedPersistence, DEFAULT_TENANT_CACHE_TTL, DEFAULT_TENANT_CACHE_SIZE, \
+    DEFAULT_TENANT_CACHE_VERSION_SECONDS
+from eventlet import GreenPool, Timeout
 from eventlet.greenthread import spawn_after
 import logging
-from .leasehandler.constants import SUCCESS_OK, ERR_UNKNOWN, ERR_NOT_FOUND
+import time
+from .leasehandler.constants import SUCCESS_OK, ERR_UNKNOWN, ERR_NOT_FOUND, VM_STATUS_ACTIVE, VM_STATUS_SHUTOFF
+from .leasehandler.constants import INVENTORY_PER_TENANT, INVENTORY_BULK, INVENTORY_INCREMENTAL
+from mors import metrics, tracing
 from mors.constants import LOGGER_PREFIX
 
 logger = logging.getLogger(LOGGER_PREFIX+__name__)
 DEFAULT_ACTION = 'power off'
 
-def get_tenant_lease_data(data):
-    """
-    Simple function to transform tenant database proxy object into an externally
-    consumable dictionary.
-    :param data: database row object
-    """
-    return {'vm_lease_policy': {'tenant_uuid': data['tenant_uuid'],
-                                'expiry_mins': data['expiry_mins'],
-                                'action': data['action'],
-                                'created_at': data['created_at'],
-                                'created_by': data['created_by'],
-                                'updated_at': data['updated_at'],
-                                'updated_by': data['updated_by']}}
-
-
-def get_vm_lease_data(data):
-    """
-    Simple function to transform instance database proxy object into an externally
-    consumable dictionary.
-    :param data: database row object
-    """
-    return {'instance_uuid': data['instance_uuid'],
-            'tenant_uuid': data['tenant_uuid'],
-            'expiry': data['expiry'],
-            'action': data['action'],
-            'created_at': data['created_at'],
-            'created_by': data['created_by'],
-            'updated_at': data['updated_at'],
-            'updated_by': data['updated_by']}
-
+# Scheduler modes, 'poll' scans all tenants every sleep_seconds while 'event' sleeps until
+# the next lease expiry known to the expiry index, rescanning everything at least every
+# max_sleep_seconds
+SCHEDULER_POLL = 'poll'
+SCHEDULER_EVENT = 'event'
+DEFAULT_MAX_SLEEP_SECONDS = 3600
+
+DEFAULT_HEARTBEAT_TIMEOUT = 180
+
+# A successful power off in the action ledger is trusted for this long when the VM status
+# is unknown, after that the VM is powered off again
+DEFAULT_ACTION_RECHECK_SECONDS = 3600
+
+DEFAULT_DB_PING_TIMEOUT = 2
+DEFAULT_DB_PING_CACHE_SECONDS = 5
+
+# Number of slowest tenants reported in the scheduler cycle summary
+SLOWEST_TENANTS_IN_SUMMARY = 5
+
+SCHEDULER_CYCLE_DURATION = metrics.REGISTRY.histogram(
+    'mors_scheduler_cycle_duration_seconds', 'Duration of scheduler cycles',
+    buckets=(0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0))
+SCHEDULER_CYCLE_ERRORS = metrics.REGISTRY.counter(
+    'mors_scheduler_cycle_errors_total', 'Scheduler cycles that failed')
+SCHEDULER_TENANTS = metrics.REGISTRY.counter(
+    'mors_scheduler_tenants_processed_total', 'Tenants processed by the scheduler')
+SCHEDULER_VMS_EVALUATED = metrics.REGISTRY.counter(
+    'mors_scheduler_vms_evaluated_total', 'VMs evaluated against their leases by the scheduler')
+SCHEDULER_VMS_ACTIONED = metrics.REGISTRY.counter(
+    'mors_scheduler_vms_actioned_total', 'VMs deleted or powered off by the scheduler', ('action',))
+SCHEDULER_VMS_ALREADY_ENFORCED = metrics.REGISTRY.counter(
+    'mors_scheduler_vms_already_enforced_total', 'Expired VMs skipped because they are already powered off')
+# Report the scheduler state of the lease manager that called register_metrics
+SCHEDULER_LAST_CYCLE = dict((key, metrics.REGISTRY.gauge('mors_scheduler_last_cycle_%s' % key,
+                                                         'Value of %s in the last scheduler cycle' % key))
+                            for key in ('tenants', 'vms', 'deleted', 'powered_off'))
 
 class LeaseManager:
     """
@@ -64,11 +80,63 @@ class LeaseManager:
     through an object 'leasehandler'.
     """
     def __init__(self, conf):
-        self.domain_mgr = DbPersistence(conf.get("DEFAULT", "db_conn"))
+        self.domain_mgr = CachedPersistence(
+            DbPersistence(conf.get("DEFAULT", "db_conn"),
+                          conf.getint("DEFAULT", "db_delete_batch_size", fallback=DEFAULT_DELETE_BATCH_SIZE),
+                          pool_size=conf.getint("DEFAULT", "db_pool_size", fallback=DEFAULT_POOL_SIZE),
+                          max_overflow=conf.getint("DEFAULT", "db_max_overflow", fallback=DEFAULT_MAX_OVERFLOW),
+                          pool_timeout=conf.getfloat("DEFAULT", "db_pool_timeout", fallback=DEFAULT_POOL_TIMEOUT),
+                          pool_recycle=conf.getint("DEFAULT", "db_pool_recycle", fallback=DEFAULT_POOL_RECYCLE),
+                          pool_pre_ping=conf.getboolean("DEFAULT", "db_pool_pre_ping", fallback=False)),
+            conf.getfloat("DEFAULT", "tenant_cache_ttl", fallback=DEFAULT_TENANT_CACHE_TTL),
+            conf.getint("DEFAULT", "tenant_cache_size", fallback=DEFAULT_TENANT_CACHE_SIZE),
+            conf.getfloat("DEFAULT", "tenant_cache_version_seconds", fallback=DEFAULT_TENANT_CACHE_VERSION_SECONDS))
         self.lease_handler = get_lease_handler(conf)
         self.sleep_seconds = conf.getint("DEFAULT", "sleep_seconds")
+        self.inventory_mode = conf.get("DEFAULT", "inventory_mode", fallback=INVENTORY_PER_TENANT)
+        self.scheduler_concurrency = max(1, conf.getint("DEFAULT", "scheduler_concurrency", fallback=1))
+        self.scheduler_mode = conf.get("DEFAULT", "scheduler_mode", fallback=SCHEDULER_POLL)
+        self.max_sleep_seconds = conf.getint("DEFAULT", "max_sleep_seconds", fallback=DEFAULT_MAX_SLEEP_SECONDS)
+        # Finds the VMs past the tenant default policy, see mors.evaluation
+        self.get_expired_vms = get_evaluator(conf.get("DEFAULT", "evaluation_engine", fallback=ENGINE_PYTHON))
+        self.action_recheck_seconds = conf.getint("DEFAULT", "action_recheck_seconds",
+                                                  fallback=DEFAULT_ACTION_RECHECK_SECONDS)
+        self.expiry_index = ExpiryIndex() if self.scheduler_mode == SCHEDULER_EVENT else None
+        self.coordinator = None
+        if conf.getboolean("DEFAULT", "scheduler_sharding", fallback=False):
+            self.coordinator = SchedulerCoordinator(
+                self.domain_mgr,
+                conf.get("DEFAULT", "scheduler_member_id", fallback=None) or get_default_member_id(),
+                conf.getint("DEFAULT", "scheduler_heartbeat_timeout", fallback=DEFAULT_HEARTBEAT_TIMEOUT),
+                conf.getfloat("DEFAULT", "scheduler_fence_seconds", fallback=DEFAULT_FENCE_SECONDS))
         self.last_run_time = None
+        self.last_full_scan_time = None
+        self.next_run_time = None
+        self.last_cycle_tenant_timings = {}
         self.scheduler_running = False
+        # Published at the end of every scheduler cycle for the health endpoints
+        self.scheduler_state = {'last_run_time': None,
+                                'last_run_duration': None,
+                                'tenants': 0,
+                                'failed_tenants': 0,
+                                'vms': 0,
+                                'deleted': 0,
+                                'powered_off': 0,
+                                'last_error': None}
+        self._cycle_tenants = 0
+        self._cycle_vms = 0
+        self._cycle_failed_tenants = 0
+        self._cycle_deleted = 0
+        self._cycle_powered_off = 0
+        # Action ledger changes of the cycle, written at its end, see _record_cycle_actions
+        self._cycle_actions = {}
+        self._cycle_removed_actions = []
+        self.db_ping_timeout = conf.getfloat("DEFAULT", "db_ping_timeout", fallback=DEFAULT_DB_PING_TIMEOUT)
+        self.db_ping_cache_seconds = conf.getfloat("DEFAULT", "db_ping_cache_seconds",
+                                                   fallback=DEFAULT_DB_PING_CACHE_SECONDS)
+        self._db_health = None
+        self._db_health_checked_at = 0
+        self._scheduler_timer = None
 
     def add_tenant_lease(self, context, tenant_obj):
         logger.info("Adding tenant lease %s", tenant_obj)
@@ -82,6 +150,7 @@ class LeaseManager:
             action,                                                             
             context.user_id,                                                    
             datetime.utcnow())
+        self._index_tenant_changed(tenant_obj['tenant_uuid'])
 
     def update_tenant_lease(self, context, tenant_obj):
         logger.info("Update tenant lease %s", tenant_obj)
@@ -91,37 +160,55 @@ class LeaseManager:
             tenant_obj['action'],
             context.user_id,
             datetime.utcnow())
+        self._index_tenant_changed(tenant_obj['tenant_uuid'])
 
     def delete_tenant_lease(self, context, tenant_id):
         logger.info("Delete tenant lease %s", tenant_id)
-        return self.domain_mgr.delete_tenant_lease(tenant_id)
+        ret = self.domain_mgr.delete_tenant_lease(tenant_id)
+        if self.expiry_index is not None:
+            self.expiry_index.remove_tenant(tenant_id)
+        return ret
 
-    def get_tenant_leases(self, context):
+    def get_tenant_leases(self, context, limit=None, marker=None, action=None):
         logger.debug("Getting all tenant lease")
-        all_tenants = self.domain_mgr.get_all_tenant_leases()
-        all_tenants = [get_tenant_lease_data(x) for x in all_tenants]
+        all_tenants = self.domain_mgr.get_tenant_leases_page(limit, marker, action)
         logger.debug("Getting all tenant lease %s", all_tenants)
         return all_tenants
 
+    def iter_tenant_leases(self, context, action=None):
+        """
+        Generator over all tenant leases, rows are read from the database as they are consumed
+        """
+        return self.domain_mgr.iter_tenant_leases(action)
+
     def get_tenant_lease(self, context, tenant_id):
+        """
+        :return: TenantLeaseRecord or None
+        """
         data = self.domain_mgr.get_tenant_lease(tenant_id)
         logger.debug("Getting tenant lease %s", data)
-        if data:
-            return get_tenant_lease_data(data)
-        return {}
+        return data
 
-    def get_tenant_and_associated_instance_leases(self, context, tenant_uuid):
+    def get_tenant_and_associated_instance_leases(self, context, tenant_uuid, limit=None, marker=None,
+                                                  expires_before=None, action=None):
+        """
+        :return: tuple of the TenantLeaseRecord or None and a page of InstanceLeaseRecords
+        """
         logger.debug("Getting tenant and instances leases %s", tenant_uuid)
-        return {
-            'tenant_lease': self.get_tenant_lease(context, tenant_uuid),
-            'all_vms':
-                [get_vm_lease_data(x) for x in self.domain_mgr.get_instance_leases_by_tenant(tenant_uuid)]
-        }
+        return (self.get_tenant_lease(context, tenant_uuid),
+                self.domain_mgr.get_instance_leases_page(tenant_uuid, limit, marker, expires_before, action))
+
+    def iter_instance_leases(self, context, tenant_uuid, expires_before=None, action=None):
+        """
+        Generator over the instance leases of a tenant, rows are read from the database as they are consumed
+        """
+        return self.domain_mgr.iter_instance_leases(tenant_uuid, expires_before, action)
 
     def get_instance_lease(self, context, instance_id):
+        """
+        :return: InstanceLeaseRecord or None
+        """
         data = self.domain_mgr.get_instance_lease(instance_id)
-        if data:
-            data = get_vm_lease_data(data)
         logger.debug("Get instance lease %s %s", instance_id, data)
         return data
 
@@ -143,6 +230,8 @@ class LeaseManager:
                                            action,                                   
                                            context.user_id,                          
                                            current_time)  
+        self._index_instance_changed(instance_lease_obj['instance_uuid'], tenant_uuid,
+                                     instance_lease_obj['expiry'])
 
     def update_instance_lease(self, context, tenant_uuid, instance_lease_obj):
         logger.info("Update instance lease %s", instance_lease_obj)
@@ -153,11 +242,11 @@ class LeaseManager:
 
         tenant_lease = self.domain_mgr.get_tenant_lease(tenant_uuid)
         if tenant_lease:
-            max_expiry = current_time + timedelta(minutes=tenant_lease['expiry_mins'])
+            max_expiry = current_time + timedelta(minutes=tenant_lease.expiry_mins)
             if instance_lease_obj['expiry'] > max_expiry:
                 raise ValueError(
                     "Expiry exceeds tenant policy maximum of %d minutes"
-                    % tenant_lease['expiry_mins'])
+                    % tenant_lease.expiry_mins)
 
         self.domain_mgr.update_instance_lease(instance_lease_obj['instance_uuid'],
                                             tenant_uuid,
@@ -165,108 +254,525 @@ class LeaseManager:
                                             instance_lease_obj['action'],
                                             context.user_id,
                                             current_time)
-        
+        self._index_instance_changed(instance_lease_obj['instance_uuid'], tenant_uuid,
+                                     instance_lease_obj['expiry'])
+
+    def _validate_instance_leases(self, tenant_uuid, instance_lease_objs, current_time, update):
+        """
+        Validate a batch of instance leases against the tenant policy, which is loaded once.
+        :return: tuple of the list of per item results and the list of valid lease objects
+        """
+        tenant_lease = self.domain_mgr.get_tenant_lease(tenant_uuid)
+        max_expiry = None
+        if tenant_lease:
+            max_expiry = current_time + timedelta(minutes=tenant_lease.expiry_mins)
+        instance_uuids = [x.get('instance_uuid') for x in instance_lease_objs if isinstance(x, dict)]
+        existing_ids = set(self.domain_mgr.get_existing_instance_lease_ids(
+            [x for x in instance_uuids if x]))
+
+        results = []
+        valid_objs = []
+        seen_ids = set()
+        for instance_lease_obj in instance_lease_objs:
+            instance_uuid = instance_lease_obj.get('instance_uuid') if isinstance(instance_lease_obj, dict) else None
+            error = None
+            if not instance_uuid:
+                error = "Missing instance_uuid"
+            elif instance_uuid in seen_ids:
+                error = "Duplicate instance_uuid in request"
+            elif not isinstance(instance_lease_obj.get('expiry'), datetime):
+                error = "Missing or invalid expiry"
+            elif instance_lease_obj['expiry'] <= current_time:
+                error = "Expiry time must be in the future"
+            elif max_expiry and instance_lease_obj['expiry'] > max_expiry:
+                error = "Expiry exceeds tenant policy maximum of %d minutes" % tenant_lease.expiry_mins
+            elif update and 'action' not in instance_lease_obj:
+                error = "Missing action"
+            elif update and instance_uuid not in existing_ids:
+                error = "Not found"
+            elif not update and instance_uuid in existing_ids:
+                error = "Already exists"
+
+            if instance_uuid:
+                seen_ids.add(instance_uuid)
+            if error:
+                results.append({'instance_uuid': instance_uuid, 'success': False, 'error': error})
+            else:
+                results.append({'instance_uuid': instance_uuid, 'success': True})
+                valid_objs.append(instance_lease_obj)
+        return results, valid_objs
+
+    def add_instance_leases(self, context, tenant_uuid, instance_lease_objs):
+        """
+        Add a batch of instance leases in a single transaction, invalid items are skipped
+        :return: list of per item results
+        """
+        logger.info("Add %d instance leases for tenant %s", len(instance_lease_objs), tenant_uuid)
+        current_time = datetime.utcnow()
+        results, valid_objs = self._validate_instance_leases(tenant_uuid, instance_lease_objs,
+                                                             current_time, False)
+        if valid_objs:
+            self.domain_mgr.add_instance_leases(
+                [{'instance_uuid': x['instance_uuid'],
+                  'tenant_uuid': tenant_uuid,
+                  'expiry': x['expiry'],
+                  'action': x.get('action', DEFAULT_ACTION),
+                  'created_by': context.user_id,
+                  'created_at': current_time} for x in valid_objs])
+            for x in valid_objs:
+                self._index_instance_changed(x['instance_uuid'], tenant_uuid, x['expiry'])
+        return results
+
+    def update_instance_leases(self, context, tenant_uuid, instance_lease_objs):
+        """
+        Update a batch of instance leases in a single transaction, invalid items are skipped
+        :return: list of per item results
+        """
+        logger.info("Update %d instance leases for tenant %s", len(instance_lease_objs), tenant_uuid)
+        current_time = datetime.utcnow()
+        results, valid_objs = self._validate_instance_leases(tenant_uuid, instance_lease_objs,
+                                                             current_time, True)
+        if valid_objs:
+            self.domain_mgr.update_instance_leases(
+                [{'instance_uuid': x['instance_uuid'],
+                  'tenant_uuid': tenant_uuid,
+                  'expiry': x['expiry'],
+                  'action': x['action'],
+                  'updated_by': context.user_id,
+                  'updated_at': current_time} for x in valid_objs])
+            for x in valid_objs:
+                self._index_instance_changed(x['instance_uuid'], tenant_uuid, x['expiry'])
+        return results
 
     def delete_instance_lease(self, context, instance_uuid):
         logger.info("Delete instance lease %s", instance_uuid)
         self.domain_mgr.delete_instance_leases([instance_uuid])
+        if self.expiry_index is not None:
+            self.expiry_index.remove(INSTANCE, instance_uuid)
+
+    def _index_instance_changed(self, instance_uuid, tenant_uuid, expiry):
+        if self.expiry_index is not None:
+            if self.expiry_index.push_instance(instance_uuid, expiry, tenant_uuid):
+                self._wake_scheduler(expiry)
+
+    def _index_tenant_changed(self, tenant_uuid):
+        # The next expiry under the new policy is only known after looking at the
+        # tenant VMs, so make the tenant due right away
+        if self.expiry_index is not None:
+            now = datetime.utcnow()
+            self.expiry_index.push_tenant(tenant_uuid, now)
+            self._wake_scheduler(now)
+
+    def _wake_scheduler(self, due):
+        """
+        Move the next scheduler run earlier when 'due' comes before it. A running cycle
+        picks up the change when it schedules the next run.
+        """
+        if self.scheduler_running or self._scheduler_timer is None:
+            return
+        if self.next_run_time is not None and due >= self.next_run_time:
+            return
+        self._scheduler_timer.cancel()
+        self._schedule_run(max(0, (due - datetime.utcnow()).total_seconds()))
+
+    def _schedule_run(self, delay):
+        self.next_run_time = datetime.utcnow() + timedelta(seconds=delay)
+        self._scheduler_timer = spawn_after(delay, self.run)
+
+    def _get_next_run_delay(self):
+        if self.expiry_index is None or self.last_full_scan_time is None:
+            return self.sleep_seconds
+        now = datetime.utcnow()
+        next_run = self.last_full_scan_time + timedelta(seconds=self.max_sleep_seconds)
+        next_due = self.expiry_index.next_due()
+        if next_due is not None and next_due < next_run:
+            next_run = next_due
+        logger.debug("Next scheduler run at %s, %d entries in the expiry index", next_run, len(self.expiry_index))
+        return max(0, (next_run - now).total_seconds())
+
+    def register_metrics(self):
+        for key, gauge in SCHEDULER_LAST_CYCLE.items():
+            gauge.set_function(lambda key=key: self.scheduler_state[key])
+        self.domain_mgr.register_metrics()
 
     def start(self):
-        spawn_after(self.sleep_seconds, self.run)
+        self.register_metrics()
+        if self.coordinator is not None:
+            self._heartbeat()
+        self._schedule_run(self.sleep_seconds)
+
+    def _heartbeat(self):
+        # Heartbeats run on their own so that long sleeps in event mode do not expire the member
+        try:
+            self.coordinator.heartbeat()
+        except Exception:
+            logger.exception("Scheduler heartbeat failed")
+        finally:
+            spawn_after(self.coordinator.heartbeat_timeout / 3.0, self._heartbeat)
+
+    def _owns_tenant(self, tenant_uuid):
+        return self.coordinator is None or self.coordinator.owns(tenant_uuid)
+
+    def _still_owns_tenant(self, tenant_uuid):
+        # Checked again right before acting, a member may have joined or expired since the cycle started
+        if self.coordinator is None:
+            return True
+        with tracing.TRACER.span('coordinator.fence', tenant_uuid=tenant_uuid):
+            return self.coordinator.fence(tenant_uuid)
 
     # Could have used a generator here, would save memory but wonder if it is a good idea given the error conditions
     # This is a simple implementation which goes and deletes VMs one by one
-    def _get_vms_to_delete_or_poweroff_for_tenant(self, tenant_uuid, expiry_mins, action):
+    def _get_vms_to_delete_or_poweroff_for_tenant(self, tenant_uuid, expiry_mins, action, tenant_vms=None,
+                                                  instance_leases=None, ledger=None):
         vms_to_delete = []
         vms_to_poweroff = []
         do_not_delete = set()
         now = datetime.utcnow()
         add_seconds = timedelta(seconds=expiry_mins*60)
-        instance_leases = self.get_tenant_and_associated_instance_leases(None, tenant_uuid)['all_vms']
+        tracer = tracing.TRACER
+        if instance_leases is None:
+            # The expiry check is done by the database, unexpired leases only come back as ids
+            with tracer.span('db.instance_leases', tenant_uuid=tenant_uuid):
+                expired_leases = self.domain_mgr.get_expired_instance_leases_by_tenant(tenant_uuid, now)
+                unexpired_leases = self.domain_mgr.get_unexpired_instance_leases_by_tenant(tenant_uuid, now)
+        else:
+            expired_leases = [x for x in instance_leases if now > x.expiry]
+            unexpired_leases = [x for x in instance_leases if now <= x.expiry]
         vm_lease_ids = set()
-        for i_lease in instance_leases:
-            vm_lease_ids.add(i_lease['instance_uuid'])
-            if now > i_lease['expiry']:
-                if i_lease['action'] == 'delete':
-                     logger.info("Explicit lease for %s queueing for deletion", i_lease['instance_uuid'])
-                     vms_to_delete.append(i_lease)
-                else:
-                     logger.info("Explicit lease for %s queueing up to Power off", i_lease['instance_uuid'])
-                     vms_to_poweroff.append(i_lease)
+        for i_lease in expired_leases:
+            vm_lease_ids.add(i_lease.instance_uuid)
+            if i_lease.action == 'delete':
+                 logger.info("Explicit lease for %s queueing for deletion", i_lease.instance_uuid)
+                 vms_to_delete.append(i_lease)
             else:
-                do_not_delete.add(i_lease['instance_uuid'])
-                logger.debug("Ignoring vm, vm not expired yet %s", i_lease['instance_uuid'])
+                 logger.info("Explicit lease for %s queueing up to Power off", i_lease.instance_uuid)
+                 vms_to_poweroff.append(i_lease)
+        for i_lease in unexpired_leases:
+            vm_lease_ids.add(i_lease.instance_uuid)
+            do_not_delete.add(i_lease.instance_uuid)
+            logger.debug("Ignoring vm, vm not expired yet %s", i_lease.instance_uuid)
+
+        if tenant_vms is None:
+            with tracer.span('inventory.tenant', tenant_uuid=tenant_uuid) as span:
+                tenant_vms = self.lease_handler.get_all_vms(tenant_uuid, action)
+                span.set_attribute('vm_count', len(tenant_vms))
+        self._cycle_vms += len(tenant_vms)
+        SCHEDULER_VMS_EVALUATED.inc(len(tenant_vms))
+        with tracer.span('evaluate', tenant_uuid=tenant_uuid, vm_count=len(tenant_vms),
+                         lease_count=len(vm_lease_ids)):
+            self._evaluate_tenant_vms(tenant_vms, vm_lease_ids, now, add_seconds, action,
+                                      vms_to_delete, vms_to_poweroff)
+
+        if self.expiry_index is not None:
+            self._index_tenant(tenant_uuid, now, add_seconds, unexpired_leases, tenant_vms, vm_lease_ids)
+        if vms_to_poweroff:
+            vms_to_poweroff = self._skip_powered_off_vms(tenant_uuid, vms_to_poweroff, tenant_vms, now, ledger or {})
+        return (vms_to_delete, vms_to_poweroff)
 
-        tenant_vms = self.lease_handler.get_all_vms(tenant_uuid)
-        # Fetch all instance UUIDs that have explicit VM leases and skip them for tenant-level enforcement
+    def _skip_powered_off_vms(self, tenant_uuid, vms_to_poweroff, tenant_vms, now, ledger):
+        """
+        Drop the VMs that are already powered off. VMs listed as SHUTOFF are skipped and
+        VMs listed as ACTIVE are running again and powered off. For any other status, or a
+        VM missing from the listing, the action ledger is checked: a successful power off
+        within action_recheck_seconds is not repeated.
+        :param ledger: dictionary of instance_uuid to the ledger entries of the tenant, as
+                       loaded at the start of the cycle
+        """
+        vm_status = dict((vm.instance_uuid, vm.status) for vm in tenant_vms)
+        recheck_after = now - timedelta(seconds=self.action_recheck_seconds)
+        remaining = []
+        for vm in vms_to_poweroff:
+            status = vm_status.get(vm.instance_uuid)
+            if status == VM_STATUS_ACTIVE:
+                remaining.append(vm)
+            elif status != VM_STATUS_SHUTOFF:
+                entry = ledger.get(vm.instance_uuid)
+                if entry is None or entry.action != 'power off' or entry.result != SUCCESS_OK or \
+                        entry.acted_at < recheck_after:
+                    remaining.append(vm)
+        skipped = len(vms_to_poweroff) - len(remaining)
+        if skipped:
+            logger.debug("Skipping %d VMs of tenant %s that are already powered off", skipped, tenant_uuid)
+            SCHEDULER_VMS_ALREADY_ENFORCED.inc(skipped)
+        return remaining
+
+    def _evaluate_tenant_vms(self, tenant_vms, vm_lease_ids, now, add_seconds, action,
+                             vms_to_delete, vms_to_poweroff):
+        """
+        Apply the tenant default policy to the VMs without an explicit lease
+        """
+        for vm in self.get_expired_vms(tenant_vms, vm_lease_ids, now, add_seconds):
+            if action == 'delete':
+                 logger.info("Instance %s queued up for deletion, creation date %s", vm.instance_uuid,
+                        vm.created_at)
+                 vms_to_delete.append(vm)
+            else:
+                 logger.info("Instance %s queued up to Power off, creation date %s", vm.instance_uuid,
+                        vm.created_at)
+                 vms_to_poweroff.append(vm)
+
+    def _index_tenant(self, tenant_uuid, now, add_seconds, unexpired_leases, tenant_vms, vm_lease_ids):
+        """
+        Record the next expiry of the unexpired instance leases and of the tenant default policy.
+        VMs created after 'now' cannot expire before now + expiry_mins, which bounds the
+        tenant entry when no listed VM expires earlier.
+        """
+        for i_lease in unexpired_leases:
+            self.expiry_index.push_instance(i_lease.instance_uuid, i_lease.expiry, tenant_uuid)
+        next_expiry = now + add_seconds
         for vm in tenant_vms:
-            #If VM has an explicit VM lease, skip applying tenant default policy to it
-            if vm['instance_uuid'] in vm_lease_ids:
-                logger.debug("Skipping VM %s due to explicit VM lease", vm['instance_uuid'])
+            if vm.instance_uuid in vm_lease_ids:
                 continue
-            expiry_date = vm['created_at'] + add_seconds
-            if now > expiry_date:
-                if action == 'delete':
-                     logger.info("Instance %s queued up for deletion, creation date %s", vm['instance_uuid'],
-                            vm['created_at'])
-                     vms_to_delete.append(vm)
-                else:
-                     logger.info("Instance %s queued up to Power off, creation date %s", vm['instance_uuid'],
-                            vm['created_at'])
-                     vms_to_poweroff.append(vm)
-            else:
-                logger.debug("Ignoring vm, vm not expired yet or already powered off or deleted %s, %s", vm['instance_uuid'],
-                             vm['created_at'])
+            expiry_date = vm.created_at + add_seconds
+            if now <= expiry_date < next_expiry:
+                next_expiry = expiry_date
+        self.expiry_index.push_tenant(tenant_uuid, next_expiry)
 
-        return (vms_to_delete, vms_to_poweroff)
+    def _delete_or_poweroff_vms_for_tenant(self, t_lease, tenant_vms=None, instance_leases=None, ledger=None):
+        tenant_vms_to_delete, tenant_vms_to_poweroff = self._get_vms_to_delete_or_poweroff_for_tenant(t_lease.tenant_uuid, t_lease.expiry_mins, t_lease.action, tenant_vms, instance_leases, ledger)
 
-    def _delete_or_poweroff_vms_for_tenant(self, t_lease):
-        tenant_vms_to_delete, tenant_vms_to_poweroff = self._get_vms_to_delete_or_poweroff_for_tenant(t_lease['tenant_uuid'], t_lease['expiry_mins'], t_lease['action'])
+        if (tenant_vms_to_delete or tenant_vms_to_poweroff) and not self._still_owns_tenant(t_lease.tenant_uuid):
+            logger.info("Tenant %s moved to another scheduler replica, leaving its VMs to it", t_lease.tenant_uuid)
+            return
 
         # Only collect VMs to be deleted for removal from DB
         vms_to_remove_from_db = []
+        failed_vms = 0
         
         # Process VMs marked for deletion
+        tracer = tracing.TRACER
         if tenant_vms_to_delete:
-            result = self.lease_handler.delete_vms(tenant_vms_to_delete)
+            with tracer.span('delete_vms', tenant_uuid=t_lease.tenant_uuid, vm_count=len(tenant_vms_to_delete)):
+                result = self.lease_handler.delete_vms(tenant_vms_to_delete)
             for vm_result in result.items():  
                 # If either the VM has been successfully deleted or has already been deleted
                 if vm_result[1] == SUCCESS_OK or vm_result[1] == ERR_NOT_FOUND:
                     vms_to_remove_from_db.append(vm_result[0])
+                else:
+                    failed_vms += 1
+                if vm_result[1] == SUCCESS_OK:
+                    self._cycle_deleted += 1
+                    SCHEDULER_VMS_ACTIONED.inc(labels=('delete',))
  
         # Process VMs marked for power off
         if tenant_vms_to_poweroff:
-            result = self.lease_handler.poweroff_vms(tenant_vms_to_poweroff)
+            with tracer.span('poweroff_vms', tenant_uuid=t_lease.tenant_uuid,
+                             vm_count=len(tenant_vms_to_poweroff)):
+                result = self.lease_handler.poweroff_vms(tenant_vms_to_poweroff)
             for vm_result in result.items():
                 # Note: We don't remove power-off VMs from the database
                 # so they can be tracked and managed properly 
                 # only remove leases for VMs that were deleted 
                 if vm_result[1] == ERR_NOT_FOUND:
                     vms_to_remove_from_db.append(vm_result[0])
-            
+                else:
+                    # The ledger keeps the next cycles from powering off the same VMs again
+                    self._cycle_actions[vm_result[0]] = (t_lease.tenant_uuid, vm_result[1])
+                    if vm_result[1] == SUCCESS_OK:
+                        self._cycle_powered_off += 1
+                        SCHEDULER_VMS_ACTIONED.inc(labels=('power off',))
+                    else:
+                        failed_vms += 1
+            self._cycle_removed_actions.extend(vms_to_remove_from_db)
+
         
         # Only remove VMs that were deleted from the database
         if vms_to_remove_from_db:
             logger.info("Removing deleted VMs from db: %s", vms_to_remove_from_db)
-            self.domain_mgr.delete_instance_leases(vms_to_remove_from_db)
+            with tracer.span('db.delete_instance_leases', tenant_uuid=t_lease.tenant_uuid,
+                             vm_count=len(vms_to_remove_from_db)):
+                self.domain_mgr.delete_instance_leases(vms_to_remove_from_db)
+
+        if failed_vms and self.expiry_index is not None:
+            # Retry after sleep_seconds as in poll mode instead of waiting for the next full scan
+            logger.info("Retrying %d VMs of tenant %s in %d seconds", failed_vms, t_lease.tenant_uuid,
+                        self.sleep_seconds)
+            self.expiry_index.push_tenant(t_lease.tenant_uuid,
+                                          datetime.utcnow() + timedelta(seconds=self.sleep_seconds),
+                                          keep_earlier=True)
+
+    def _get_inventory_snapshot(self, tenant_leases):
+        """
+        In bulk and incremental inventory modes fetch the VMs of all tenants once for this cycle.
+        :return: dictionary of tenant_uuid to vms, None when VMs should be listed per tenant
+        """
+        if self.inventory_mode not in (INVENTORY_BULK, INVENTORY_INCREMENTAL) or not tenant_leases:
+            return None
+        # The listing can only be filtered for the lease action when all the tenants share it
+        actions = set(x.action for x in tenant_leases)
+        inventory = self.lease_handler.get_all_vms_by_tenant(actions.pop() if len(actions) == 1 else None)
+        logger.debug("Fetched inventory of %d VMs across %d tenants",
+                     sum(len(vms) for vms in inventory.values()), len(inventory))
+        return inventory
+
+    def _enforce_tenant_lease(self, t_lease, tenant_vms, instance_leases, ledger, parent_span=None):
+        """
+        Enforce the leases of a single tenant, a failure is logged and does not affect other tenants.
+        :param parent_span: tracing span of the scheduler cycle, tenants run in their own green threads
+        :return: tuple of tenant_uuid and the seconds spent on the tenant
+        """
+        start = time.time()
+        try:
+            with tracing.TRACER.span('tenant', parent=parent_span, tenant_uuid=t_lease.tenant_uuid):
+                self._delete_or_poweroff_vms_for_tenant(t_lease, tenant_vms, instance_leases, ledger)
+        except Exception:
+            logger.exception("Lease enforcement failed for tenant %s", t_lease.tenant_uuid)
+            self._cycle_failed_tenants += 1
+            if self.expiry_index is not None:
+                # Retry the tenant later instead of waiting for the next full scan
+                self.expiry_index.push_tenant(t_lease.tenant_uuid,
+                                              datetime.utcnow() + timedelta(seconds=self.sleep_seconds))
+        return t_lease.tenant_uuid, time.time() - start
+
+    def _enforce_tenant_leases(self, tenant_leases, inventory, instance_leases, ledger):
+        """
+        Enforce the leases of all tenants, up to scheduler_concurrency tenants at a time.
+        :param tenant_leases: tenant lease rows
+        :param inventory: dictionary of tenant_uuid to vms or None to list VMs per tenant
+        :param instance_leases: dictionary of tenant_uuid to instance lease rows or None
+                                to query the instance leases per tenant
+        :param ledger: dictionary of tenant_uuid to its action ledger entries
+        """
+        start = time.time()
+        tenant_vms = []
+        tenant_instance_leases = []
+        for t_lease in tenant_leases:
+            if inventory is not None:
+                tenant_vms.append(inventory.get(t_lease.tenant_uuid, []))
+            else:
+                tenant_vms.append(None)
+            if instance_leases is not None:
+                tenant_instance_leases.append(instance_leases.get(t_lease.tenant_uuid, []))
+            else:
+                tenant_instance_leases.append(None)
+
+        tenant_ledgers = [ledger.get(x.tenant_uuid, {}) for x in tenant_leases]
+
+        pool = GreenPool(self.scheduler_concurrency)
+        parents = [tracing.TRACER.current_span()] * len(tenant_leases)
+        timings = dict(pool.imap(self._enforce_tenant_lease, tenant_leases, tenant_vms, tenant_instance_leases,
+                                 tenant_ledgers, parents))
+        self.last_cycle_tenant_timings = timings
+
+        for tenant_uuid, seconds in timings.items():
+            logger.debug("Tenant %s processed in %.2fs", tenant_uuid, seconds)
+        slowest = sorted(timings.items(), key=lambda x: x[1], reverse=True)[:SLOWEST_TENANTS_IN_SUMMARY]
+        logger.info("Scheduler cycle processed %d tenants in %.2fs with concurrency %d, slowest: %s",
+                    len(timings), time.time() - start, self.scheduler_concurrency,
+                    ", ".join("%s (%.2fs)" % x for x in slowest))
+
+    def _get_due_tenants(self):
+        """
+        In event mode return the tenants with a due entry in the expiry index, or None when
+        a full scan of all tenants is needed. In poll mode every run is a full scan.
+        """
+        if self.expiry_index is None:
+            return None
+        now = datetime.utcnow()
+        if self.last_full_scan_time is None or \
+                now >= self.last_full_scan_time + timedelta(seconds=self.max_sleep_seconds):
+            # The full scan rebuilds the index from the database and the tenant VMs
+            self.expiry_index.clear()
+            self.last_full_scan_time = now
+            return None
+        due_tenants = self.expiry_index.pop_due(now)
+        logger.debug("Tenants due in this scheduler run: %s", due_tenants)
+        return due_tenants
+
+    def _run_cycle(self, cycle_span):
+        tracer = tracing.TRACER
+        ring = None
+        if self.coordinator is not None:
+            with tracer.span('coordinator.refresh'):
+                if self.coordinator.refresh():
+                    # Tenants moved between replicas, the expiry index is rebuilt by a full scan
+                    self.last_full_scan_time = None
+            ring = self.coordinator.ring
+
+        # Delete the cleanup
+        due_tenants = self._get_due_tenants()
+        cycle_span.set_attribute('full_scan', due_tenants is None)
+        if due_tenants is None:
+            # Full scan, all the leases are loaded at once instead of per tenant
+            with tracer.span('db.get_all_tenant_and_instance_leases'):
+                tenant_leases, instance_leases = self.domain_mgr.get_all_tenant_and_instance_leases(
+                    self._owns_tenant if self.coordinator is not None else None)
+            with tracer.span('inventory.snapshot', tenant_count=len(tenant_leases)) as span:
+                inventory = self._get_inventory_snapshot(tenant_leases)
+                if inventory is not None:
+                    span.set_attribute('vm_count', sum(len(vms) for vms in inventory.values()))
+        else:
+            with tracer.span('db.get_all_tenant_leases'):
+                tenant_leases = [x for x in self.domain_mgr.get_all_tenant_leases()
+                                 if x.tenant_uuid in due_tenants and self._owns_tenant(x.tenant_uuid)]
+            instance_leases = None
+            inventory = None
+        # Older ledger entries are not trusted anymore, see _skip_powered_off_vms
+        recheck_after = datetime.utcnow() - timedelta(seconds=self.action_recheck_seconds)
+        ledger = {}
+        if tenant_leases:
+            # Full scans of an unsharded scheduler read the whole ledger, otherwise only the cycle tenants
+            tenant_uuids = None
+            if due_tenants is not None or self.coordinator is not None:
+                tenant_uuids = [x.tenant_uuid for x in tenant_leases]
+            with tracer.span('db.get_instance_actions_by_tenant'):
+                ledger = self.domain_mgr.get_instance_actions_by_tenant(recheck_after, tenant_uuids)
+        self._cycle_tenants = len(tenant_leases)
+        cycle_span.set_attribute('tenant_count', self._cycle_tenants)
+        SCHEDULER_TENANTS.inc(self._cycle_tenants)
+        with tracer.span('enforce_tenant_leases', tenant_count=self._cycle_tenants):
+            self._enforce_tenant_leases(tenant_leases, inventory, instance_leases, ledger)
+        self._record_cycle_actions(recheck_after)
+        cycle_span.set_attribute('vm_count', self._cycle_vms)
+        if ring is not None and self.coordinator.ring is not ring:
+            # The ring changed while fencing, the next run rebuilds the expiry index
+            self.last_full_scan_time = None
+
+    def _record_cycle_actions(self, recheck_after):
+        """
+        Write the action ledger changes of all the tenants of the cycle in one transaction,
+        which also drops the entries older than action_recheck_seconds
+        """
+        if not self._cycle_actions and not self._cycle_removed_actions:
+            return
+        with tracing.TRACER.span('db.record_instance_actions', vm_count=len(self._cycle_actions)):
+            self.domain_mgr.record_instance_actions('power off', self._cycle_actions, datetime.utcnow(),
+                                                    self._cycle_removed_actions, recheck_after)
 
     def run(self):
+        error = None
+        start = time.time()
+        self._cycle_tenants = 0
+        self._cycle_vms = 0
+        self._cycle_failed_tenants = 0
+        self._cycle_deleted = 0
+        self._cycle_powered_off = 0
+        self._cycle_actions = {}
+        self._cycle_removed_actions = []
         try:
             self.scheduler_running = True
             self.last_run_time = datetime.utcnow()
-            
-            # Delete the cleanup
-            tenant_leases = self.domain_mgr.get_all_tenant_leases()
-            for t_lease in tenant_leases:
-                self._delete_or_poweroff_vms_for_tenant(t_lease)
-            
+            with tracing.TRACER.span('scheduler.cycle', root=True) as cycle_span:
+                self._run_cycle(cycle_span)
             logger.debug("Scheduler run completed at %s", self.last_run_time)
         except Exception as e:
             logger.error("Scheduler run failed: %s", str(e))
+            error = str(e)
+            SCHEDULER_CYCLE_ERRORS.inc()
             raise
         finally:
+            duration = time.time() - start
+            SCHEDULER_CYCLE_DURATION.observe(duration)
+            self.scheduler_state = {'last_run_time': self.last_run_time,
+                                    'last_run_duration': duration,
+                                    'tenants': self._cycle_tenants,
+                                    'failed_tenants': self._cycle_failed_tenants,
+                                    'vms': self._cycle_vms,
+                                    'deleted': self._cycle_deleted,
+                                    'powered_off': self._cycle_powered_off,
+                                    'last_error': error}
             self.scheduler_running = False
-            spawn_after(self.sleep_seconds, self.run)
+            self._schedule_run(self._get_next_run_delay())
 
     def is_scheduler_healthy(self):
         """
@@ -281,6 +787,8 @@ class LeaseManager:
         time_since_last_run = (current_time - self.last_run_time).total_seconds()
 
         max_expected_interval = self.sleep_seconds * 2
+        if self.expiry_index is not None:
+            max_expected_interval = max(self.sleep_seconds, self.max_sleep_seconds) * 2
         
         if time_since_last_run > max_expected_interval:
             return False, f"Scheduler last ran {time_since_last_run:.0f}s ago, expected within {max_expected_interval}s"
@@ -294,24 +802,39 @@ class LeaseManager:
 
     def _estimate_max_scheduler_runtime(self):
         """Race condition that migh happen if VMs are being deleted or powered off"""
+        # total vms, as seen by the last scheduler cycle so that health probes never
+        # hit the database or list VMs
+        total_vms = self.scheduler_state['vms']
+
+        # Estimate: 0.5s per VM operation + 10s base overhead + 50% safety buffer
+        estimated_time = (total_vms * 0.5) + 10
+        safety_buffer = estimated_time * 0.5
+        max_runtime = estimated_time + safety_buffer
+
+        # Set bounds minimum 30s, maximum 300s (5 minutes)
+        return max(30, min(300, max_runtime))
+
+    def get_scheduler_state(self):
+        state = dict(self.scheduler_state)
+        if state['last_run_time']:
+            state['last_run_time'] = state['last_run_time'].isoformat()
+        return state
+
+    def is_db_healthy(self):
+        """
+        Check that the database answers a trivial query within db_ping_timeout seconds.
+        The result is reused for db_ping_cache_seconds.
+        """
+        now = time.time()
+        if self._db_health is not None and now - self._db_health_checked_at < self.db_ping_cache_seconds:
+            return self._db_health
         try:
-            # total vms
-            total_vms = 0
-            tenant_leases = self.domain_mgr.get_all_tenant_leases()
-            
-            for t_lease in tenant_leases:
-                # Vm count
-                tenant_vms = self.lease_handler.get_all_vms(t_lease['tenant_uuid'])
-                total_vms += len(tenant_vms)
-            
-            # Estimate: 0.5s per VM operation + 10s base overhead + 50% safety buffer
-            estimated_time = (total_vms * 0.5) + 10
-            safety_buffer = estimated_time * 0.5
-            max_runtime = estimated_time + safety_buffer
-            
-            # Set bounds minimum 30s, maximum 300s (5 minutes)
-            return max(30, min(300, max_runtime))
-            
+            with Timeout(self.db_ping_timeout):
+                self.domain_mgr.ping()
+            self._db_health = (True, "Database is reachable")
+        except Timeout:
+            self._db_health = (False, "Database ping timed out after %ss" % self.db_ping_timeout)
         except Exception as e:
-            logger.warning("Could not estimate scheduler runtime: %s", str(e))
-            return 120
+            self._db_health = (False, "Database ping failed: %s" % e)
+        self._db_health_checked_at = now
+        return self._db_health
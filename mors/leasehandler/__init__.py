@@ -15,10 +15,16 @@ limitations under the License.
 """
 from .nova_lease_handler import NovaLeaseHandler
 from .fake_lease_handler import FakeLeaseHandler
+from .inventory_cache import CachedLeaseHandler
 
 
 def get_lease_handler(conf):
     if conf.get("DEFAULT", "lease_handler") == "test":
-        return FakeLeaseHandler(conf)
+        lease_handler = FakeLeaseHandler(conf)
     else:
-        return NovaLeaseHandler(conf)
+        lease_handler = NovaLeaseHandler(conf)
+    # Listings are reused until the next poll, poll cycles list the VMs again while the runs
+    # in between (due tenants in event mode) reuse the listing of the last cycle
+    return CachedLeaseHandler(lease_handler,
+                              conf.getint("DEFAULT", "inventory_cache_ttl",
+                                          fallback=conf.getint("DEFAULT", "sleep_seconds")))
@@ -0,0 +1,84 @@
+"""
+Copyright 2016 Platform9 Systems Inc.(http://www.platform9.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import logging
+import time
+
+import eventlet
+from eventlet import GreenPool
+
+from mors import tracing
+from mors.constants import LOGGER_PREFIX
+from .constants import ERR_UNKNOWN
+
+logger = logging.getLogger(LOGGER_PREFIX+__name__)
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter for green threads. Tokens are refilled at 'rate'
+    per second up to 'capacity', each acquire consumes one token and sleeps
+    until one is available.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1, rate))
+        self.tokens = self.capacity
+        self.last_refill = time.time()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self):
+        self._refill()
+        while self.tokens < 1:
+            eventlet.sleep((1 - self.tokens) / self.rate)
+            self._refill()
+        self.tokens -= 1
+
+
+class ActionExecutor:
+    """
+    Runs a VM action (delete, power off) over a list of VMs with a bounded number
+    of green threads. When rate_limit is set, the rate is shared by all the
+    callers of the executor.
+    """
+    def __init__(self, workers=1, rate_limit=0):
+        self.workers = max(1, workers)
+        self.rate_limiter = TokenBucket(rate_limit) if rate_limit > 0 else None
+
+    def _run_action(self, action, vm, parent_span):
+        if self.rate_limiter:
+            self.rate_limiter.acquire()
+        with tracing.TRACER.attach(parent_span):
+            try:
+                return vm.instance_uuid, action(vm.instance_uuid)
+            except Exception:
+                # One failing call must not lose the results of the other VMs
+                logger.exception("Action failed for vm %s", vm.instance_uuid)
+                return vm.instance_uuid, ERR_UNKNOWN
+
+    def run(self, action, vms):
+        """
+        Run the action for each of the vms
+        :param action: callable taking an instance uuid and returning a result code
+        :param vms: list of vms
+        :return: dictionary of vm_id to result, ERR_UNKNOWN for the calls that raised
+        """
+        pool = GreenPool(self.workers)
+        parent_span = tracing.TRACER.current_span()
+        return dict(pool.imap(lambda vm: self._run_action(action, vm, parent_span), vms))
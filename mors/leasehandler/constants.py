@@ -17,3 +17,22 @@ limitations under the License.
 SUCCESS_OK = 0
 ERR_NOT_FOUND = 1
 ERR_UNKNOWN = 2
+
+# Inventory modes, 'tenant' lists the VMs of each leased tenant separately, 'bulk' lists
+# every VM once per scheduler cycle and groups them by tenant and 'incremental' keeps the
+# bulk inventory in memory and refreshes it with the servers changed since the last sync
+INVENTORY_PER_TENANT = 'tenant'
+INVENTORY_BULK = 'bulk'
+INVENTORY_INCREMENTAL = 'incremental'
+
+# Nova server statuses the scheduler acts on, VMs without a known status are checked
+# against the action ledger
+VM_STATUS_ACTIVE = 'ACTIVE'
+VM_STATUS_SHUTOFF = 'SHUTOFF'
+VM_STATUS_ERROR = 'ERROR'
+
+# Status filters pushed down to the VM listings per lease action. Nova stops running VMs
+# and VMs in error, the other statuses cannot be powered off. Nova has no filter on the
+# creation time, changes-before filters on the update time which a restart or resize
+# moves forward.
+ACTION_STATUS_FILTERS = {'power off': (VM_STATUS_ACTIVE, VM_STATUS_ERROR)}
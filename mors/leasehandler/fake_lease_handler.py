@@ -14,18 +14,45 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 from . import constants
+import eventlet
 import logging
+from collections import Counter
 from datetime import datetime
+from mors.records import VmRecord
 
 # @TODO: Need to move this to a test folder
 
 class FakeLeaseHandler:
+    """
+    In memory lease handler for tests and benchmarks. fake_handler_latency adds a
+    delay in seconds to every call and the calls are counted per method.
+    """
     # Singleton tenants
     tenants = {}
 
     def __init__(self,conf):
         self.logger = logging.getLogger("test-lease-handler")
-        pass
+        self.latency = conf.getfloat("DEFAULT", "fake_handler_latency", fallback=0)
+        self.calls = Counter()
+        self.powered_off = set()
+
+    def _call(self, name):
+        self.calls[name] += 1
+        if self.latency:
+            eventlet.sleep(self.latency)
+
+    @classmethod
+    def generate_fleet(cls, tenant_count, vms_per_tenant, created_at):
+        """
+        Replace the tenants with tenant_count tenants of vms_per_tenant VMs each, named
+        tenant-<i> and tenant-<i>-vm-<j>
+        """
+        cls.tenants = {}
+        for i in range(tenant_count):
+            tenant_uuid = "tenant-%d" % i
+            cls.tenants[tenant_uuid] = [VmRecord("%s-vm-%d" % (tenant_uuid, j), tenant_uuid, created_at=created_at)
+                                        for j in range(vms_per_tenant)]
+        return cls.tenants
 
     def add_tenant_data(self, tenant_id, instances):
         FakeLeaseHandler.tenants[tenant_id] = instances
@@ -34,19 +61,42 @@ class FakeLeaseHandler:
     def get_tenant_data(self, tenant_id):
         return FakeLeaseHandler.tenants[tenant_id]
 
-    def get_all_vms(self, tenant_uuid):
-        return FakeLeaseHandler.tenants[tenant_uuid]
+    @staticmethod
+    def _filter(vms, action):
+        # VMs without a status are taken as running
+        statuses = constants.ACTION_STATUS_FILTERS.get(action)
+        if statuses is None:
+            return vms
+        return [x for x in vms if (x.status or constants.VM_STATUS_ACTIVE) in statuses]
+
+    def get_all_vms(self, tenant_uuid, action=None):
+        self._call('get_all_vms')
+        return self._filter(FakeLeaseHandler.tenants[tenant_uuid], action)
+
+    def get_all_vms_by_tenant(self, action=None):
+        self._call('get_all_vms_by_tenant')
+        return dict((tenant_uuid, self._filter(vms, action)) for tenant_uuid, vms in FakeLeaseHandler.tenants.items())
 
     def delete_vm(self, tenant_uuid, vm_id):
         vms = FakeLeaseHandler.tenants[tenant_uuid]
-        new_vm_data = [x for x in vms if x['instance_uuid'] != vm_id]
+        new_vm_data = [x for x in vms if x.instance_uuid != vm_id]
         FakeLeaseHandler.tenants[tenant_uuid] = new_vm_data
 
 
     def delete_vms(self, vms):
         result = {}
         for vm in vms:
+            self._call('delete_vm')
             self.logger.info("Deleting VM  vm %s", vm)
-            self.delete_vm(vm['tenant_uuid'], vm['instance_uuid'])
-            result[vm['instance_uuid']] = constants.SUCCESS_OK
+            self.delete_vm(vm.tenant_uuid, vm.instance_uuid)
+            result[vm.instance_uuid] = constants.SUCCESS_OK
+        return result
+
+    def poweroff_vms(self, vms):
+        result = {}
+        for vm in vms:
+            self._call('poweroff_vm')
+            self.logger.info("Powering off VM %s", vm)
+            self.powered_off.add(vm.instance_uuid)
+            result[vm.instance_uuid] = constants.SUCCESS_OK
         return result
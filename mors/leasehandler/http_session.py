@@ -0,0 +1,88 @@
+"""
+Copyright 2016 Platform9 Systems Inc.(http://www.platform9.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import requests
+from keystoneauth1.identity import v3
+from keystoneauth1.session import TCPKeepAliveAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from mors import metrics
+
+DEFAULT_HTTP_POOL_SIZE = 10
+
+HTTP_REQUESTS = metrics.REGISTRY.counter(
+    'mors_openstack_http_requests_total', 'HTTP requests sent to Keystone and Nova')
+HTTP_CONNECTIONS = metrics.REGISTRY.counter(
+    'mors_openstack_http_connections_total', 'HTTP connections opened to Keystone and Nova, '
+                                             'requests beyond this count reused a pooled connection')
+TOKEN_REQUESTS = metrics.REGISTRY.counter(
+    'mors_keystone_token_requests_total', 'Keystone tokens requested')
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        HTTP_CONNECTIONS.inc()
+        return super(_CountingHTTPConnectionPool, self)._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        HTTP_CONNECTIONS.inc()
+        return super(_CountingHTTPSConnectionPool, self)._new_conn()
+
+
+class PooledAdapter(TCPKeepAliveAdapter):
+    """
+    keystoneauth keep-alive adapter whose connection pools count the connections they open
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        super(PooledAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': _CountingHTTPConnectionPool,
+                                                   'https': _CountingHTTPSConnectionPool}
+
+
+class Password(v3.Password):
+    """
+    Keystone v3 password plugin that refreshes its token 'refresh_seconds' before the
+    token expires and counts the tokens it requests
+    """
+    def __init__(self, refresh_seconds, **kwargs):
+        super(Password, self).__init__(**kwargs)
+        self.MIN_TOKEN_LIFE_SECONDS = refresh_seconds
+
+    def get_auth_ref(self, session, **kwargs):
+        TOKEN_REQUESTS.inc()
+        return super(Password, self).get_auth_ref(session, **kwargs)
+
+
+def get_pooled_session(pool_size=DEFAULT_HTTP_POOL_SIZE):
+    """
+    requests session keeping up to pool_size connections alive per host
+    """
+    http_session = requests.Session()
+    adapter = PooledAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    http_session.mount('http://', adapter)
+    http_session.mount('https://', adapter)
+    http_session.hooks['response'].append(lambda response, *args, **kwargs: HTTP_REQUESTS.inc())
+    return http_session
+
+
+def get_connection_stats():
+    requests_sent = HTTP_REQUESTS.get()
+    connections = HTTP_CONNECTIONS.get()
+    return {'requests': requests_sent,
+            'connections': connections,
+            'token_requests': TOKEN_REQUESTS.get(),
+            'reuse_rate': 1 - float(connections) / requests_sent if requests_sent else 0.0}
@@ -0,0 +1,76 @@
+"""
+Copyright 2016 Platform9 Systems Inc.(http://www.platform9.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import logging
+
+from mors.cache import TTLCache
+from mors.constants import LOGGER_PREFIX
+
+logger = logging.getLogger(LOGGER_PREFIX+__name__)
+
+ALL_TENANTS_KEY = '*'
+
+
+class CachedLeaseHandler:
+    """
+    Lease handler wrapper that keeps the VM listings of the wrapped handler in a TTL
+    cache. Delete and power off invalidate the listings of the affected tenants. A listing
+    that fails raises and is not cached, an empty list is only cached for a tenant without
+    VMs. Everything else is delegated to the wrapped handler.
+    """
+    def __init__(self, lease_handler, ttl):
+        self.lease_handler = lease_handler
+        self.cache = TTLCache(ttl)
+        # Listings are cached per lease action, they can filter on it
+        self.actions = set([None])
+
+    def __getattr__(self, name):
+        return getattr(self.lease_handler, name)
+
+    def get_all_vms(self, tenant_uuid, action=None):
+        vms = self.cache.get((tenant_uuid, action))
+        if vms is None:
+            vms = self.lease_handler.get_all_vms(tenant_uuid, action)
+            self.actions.add(action)
+            self.cache.set((tenant_uuid, action), vms)
+        return vms
+
+    def get_all_vms_by_tenant(self, action=None):
+        tenant_vms = self.cache.get((ALL_TENANTS_KEY, action))
+        if tenant_vms is None:
+            tenant_vms = self.lease_handler.get_all_vms_by_tenant(action)
+            self.actions.add(action)
+            self.cache.set((ALL_TENANTS_KEY, action), tenant_vms)
+        return tenant_vms
+
+    def invalidate(self, vms):
+        for tenant_uuid in set(vm.tenant_uuid for vm in vms) | set([ALL_TENANTS_KEY]):
+            for action in self.actions:
+                self.cache.invalidate((tenant_uuid, action))
+
+    def delete_vms(self, vms):
+        try:
+            return self.lease_handler.delete_vms(vms)
+        finally:
+            self.invalidate(vms)
+
+    def poweroff_vms(self, vms):
+        try:
+            return self.lease_handler.poweroff_vms(vms)
+        finally:
+            self.invalidate(vms)
+
+    def cache_stats(self):
+        return self.cache.stats()
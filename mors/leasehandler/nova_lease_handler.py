@@ -15,43 +15,99 @@ limitations under the License.
 """
 
 from novaclient import client
+import functools
 import logging
 import time
 import novaclient
-from keystoneauth1.identity import v3
+from six.moves.urllib.parse import urlencode
 from keystoneauth1 import session
 from keystoneauth1 import exceptions as ks_exceptions
-from datetime import datetime
+from datetime import datetime, timedelta
+from .action_executor import ActionExecutor
+from .http_session import Password, get_pooled_session, DEFAULT_HTTP_POOL_SIZE
 from .constants import SUCCESS_OK, ERR_NOT_FOUND, ERR_UNKNOWN
+from .constants import INVENTORY_PER_TENANT, INVENTORY_INCREMENTAL, ACTION_STATUS_FILTERS
+from mors import metrics, tracing
 from mors.constants import LOGGER_PREFIX
+from mors.records import VmRecord
 
 logger = logging.getLogger(LOGGER_PREFIX+__name__)
 
+NOVA_REQUEST_DURATION = metrics.REGISTRY.histogram(
+    'mors_nova_request_duration_seconds', 'Duration of Nova API calls', ('operation',))
+NOVA_REQUEST_ERRORS = metrics.REGISTRY.counter(
+    'mors_nova_request_errors_total', 'Nova API calls that raised an error', ('operation',))
+
+
+def _call_nova(operation, function, *args, vm_count=None, **kwargs):
+    """
+    Call a novaclient function, recording its latency and errors under 'operation'
+    and tracing it as a 'nova.<operation>' span
+    :param vm_count: function of the result returning the number of VMs it holds, set
+                     as the 'vm_count' attribute of the span
+    """
+    labels = (operation,)
+    start = time.monotonic()
+    try:
+        with tracing.TRACER.span('nova.' + operation) as span:
+            result = function(*args, **kwargs)
+            if vm_count is not None:
+                span.set_attribute('vm_count', vm_count(result))
+            return result
+    except Exception:
+        NOVA_REQUEST_ERRORS.inc(labels=labels)
+        raise
+    finally:
+        NOVA_REQUEST_DURATION.observe(time.monotonic() - start, labels)
+
 DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 
 def get_vm_data(data):
-    return {'instance_uuid': data.id,
-            'tenant_uuid': data.tenant_id,
-            'created_at': datetime.strptime(data.created, DATE_FORMAT)}
+    """
+    :param data: server of a detailed listing, as decoded from the response body
+    """
+    return VmRecord(data['id'], data['tenant_id'], data['status'], created=data['created'])
+
+
+def _get_search_opts(action, **search_opts):
+    statuses = ACTION_STATUS_FILTERS.get(action)
+    if statuses is not None:
+        # Repeated status parameters, Nova lists the servers in any of them
+        search_opts['status'] = list(statuses)
+    return search_opts
 
 MAX_AUTH_RETRIES = 3
 AUTH_RETRY_DELAY = 5
+DEFAULT_INVENTORY_PAGE_SIZE = 1000
+DEFAULT_INVENTORY_RESYNC_SECONDS = 3600
+# Tokens are treated as expired this many seconds early. The first call inside that window
+# fetches the new token inline, there is no background refresh, but a token never expires
+# while a listing or an action is in flight.
+DEFAULT_TOKEN_REFRESH_SECONDS = 300
+# Overlap between incremental syncs, covers clock skew with nova and in flight updates
+INVENTORY_SYNC_OVERLAP = timedelta(seconds=60)
 
 class NovaLeaseHandler:
     def __init__(self, conf):
         self.conf = conf
         self.keystone_sess = self.get_keystone_session()
         self.pf9_project_id = self._get_project_id_with_retry()
+        # Nova calls share the keystone session, its token and its pooled connections
         self.nova_client = client.Client(self.conf.get("nova", "version"),
-                             username=self.conf.get("nova", "user_name"),
-                             region_name=self.conf.get("nova", "region_name"),
-                             tenant_id=self.pf9_project_id,
-                             api_key=self.conf.get("nova", "password"),
-                             auth_url=self.conf.get("nova", "auth_url"),
-                             insecure=True, connection_pool=False,
-                             project_domain_name="default",
-                             user_domain_name="default",
-                             endpoint_type="internal")
+                                         session=self.keystone_sess,
+                                         region_name=self.conf.get("nova", "region_name"),
+                                         endpoint_type="internal")
+        self.inventory_page_size = self.conf.getint("nova", "inventory_page_size",
+                                                    fallback=DEFAULT_INVENTORY_PAGE_SIZE)
+        self.inventory_mode = self.conf.get("DEFAULT", "inventory_mode", fallback=INVENTORY_PER_TENANT)
+        self.inventory_resync_seconds = self.conf.getint("nova", "inventory_resync_seconds",
+                                                         fallback=DEFAULT_INVENTORY_RESYNC_SECONDS)
+        # Incremental inventory, instance_uuid to vm
+        self.inventory = {}
+        self.inventory_synced_at = None
+        self.inventory_full_sync_at = None
+        self.action_executor = ActionExecutor(self.conf.getint("nova", "action_workers", fallback=1),
+                                              self.conf.getfloat("nova", "action_rate_limit", fallback=0))
 
     def _get_nova_client(self):
         return self.nova_client
@@ -96,28 +152,109 @@ class NovaLeaseHandler:
              'user_domain_id': 'default',
              'project_domain_id': 'default'
         }
-        auth = v3.Password(**auth_params)
-        return session.Session(auth=auth)
+        auth = Password(self.conf.getint('nova', 'token_refresh_seconds', fallback=DEFAULT_TOKEN_REFRESH_SECONDS),
+                        **auth_params)
+        # Enough connections for every action worker to keep its own connection alive
+        pool_size = max(self.conf.getint('nova', 'http_pool_size', fallback=DEFAULT_HTTP_POOL_SIZE),
+                        self.conf.getint('nova', 'action_workers', fallback=1))
+        return session.Session(auth=auth, session=get_pooled_session(pool_size),
+                               verify=not self.conf.getboolean('nova', 'insecure', fallback=True))
 
-    def get_all_vms(self, tenant_uuid):
+    def get_all_vms(self, tenant_uuid, action=None):
         """
         Get all vms for a given tenant
         :param tenant_uuid:
-        :return: an iteratble that returns a set of vms (each vm has a UUID and a created_at field)
+        :param action: only list the vms this lease action can apply to
+        :return: an iteratble that returns a set of vms (each vm has a UUID, a status and a created_at field)
+        :raises: the Nova error when the vms cannot be listed, an empty list means the tenant has no vms
         """
         try:
-            with self._get_nova_client() as nova:
-                vms = nova.servers.list(search_opts={'all_tenants':1, 'tenant_id':tenant_uuid})
-                return [get_vm_data(x) for x in vms]
+            nova = self._get_nova_client()
+            return [get_vm_data(x) for x in self._list_all_servers(nova, _get_search_opts(action, tenant_id=tenant_uuid))]
         except Exception as e:
             logger.exception("Error getting list of vms for tenant %s", tenant_uuid)
+            raise
 
-        return []
+    def _list_all_servers(self, nova, search_opts):
+        """
+        Generator over the servers of all tenants matching search_opts, fetched in pages
+        of inventory_page_size servers. The response bodies are read directly, building
+        novaclient resources for every server would cost more than parsing the servers.
+        """
+        params = dict(search_opts, all_tenants=1, limit=self.inventory_page_size)
+        while True:
+            # The raw client returns (response, body), the servers are counted from the body
+            body = _call_nova('servers.list', nova.client.get,
+                              '/servers/detail?' + urlencode(sorted(params.items()), doseq=True),
+                              vm_count=lambda result: len(result[1]['servers']))[1]
+            servers = body['servers']
+            for server in servers:
+                yield server
+            # Nova links the next page when this one is full
+            if not servers or not any(x.get('rel') == 'next' for x in body.get('servers_links', [])):
+                break
+            params['marker'] = servers[-1]['id']
+
+    def get_all_vms_by_tenant(self, action=None):
+        """
+        Get all vms across every tenant with a single paginated listing, or from the
+        incrementally synced inventory in incremental inventory mode
+        :param action: only list the vms this lease action can apply to
+        :return: dictionary of tenant_uuid to the vms of that tenant
+        :raises: the Nova error when the vms cannot be listed or synced
+        """
+        if self.inventory_mode == INVENTORY_INCREMENTAL:
+            self._sync_inventory()
+            statuses = ACTION_STATUS_FILTERS.get(action)
+            vms = [x for x in self.inventory.values() if statuses is None or x.status in statuses]
+        else:
+            try:
+                nova = self._get_nova_client()
+                vms = [get_vm_data(x) for x in self._list_all_servers(nova, _get_search_opts(action))]
+            except Exception as e:
+                logger.exception("Error getting list of vms for all tenants")
+                raise
+        tenant_vms = {}
+        for vm in vms:
+            tenant_vms.setdefault(vm.tenant_uuid, []).append(vm)
+        return tenant_vms
+
+    def _sync_inventory(self):
+        """
+        Refresh the inventory with the servers changed since the last sync, deleted servers
+        are evicted. A full listing is done every inventory_resync_seconds to correct drift.
+        """
+        now = datetime.utcnow()
+        full_sync = self.inventory_full_sync_at is None or \
+            now - self.inventory_full_sync_at >= timedelta(seconds=self.inventory_resync_seconds)
+        try:
+            nova = self._get_nova_client()
+            if full_sync:
+                self.inventory = dict((x['id'], get_vm_data(x)) for x in self._list_all_servers(nova, {}))
+                self.inventory_full_sync_at = now
+                logger.info("Full inventory sync found %d VMs", len(self.inventory))
+            else:
+                changes_since = self.inventory_synced_at - INVENTORY_SYNC_OVERLAP
+                changed = deleted = 0
+                for vm in self._list_all_servers(nova, {'changes-since': changes_since.strftime(DATE_FORMAT)}):
+                    if vm['status'] == 'DELETED':
+                        deleted += 1
+                        self.inventory.pop(vm['id'], None)
+                    else:
+                        changed += 1
+                        self.inventory[vm['id']] = get_vm_data(vm)
+                logger.debug("Incremental inventory sync since %s, %d changed and %d deleted VMs",
+                             changes_since, changed, deleted)
+            self.inventory_synced_at = now
+        except Exception as e:
+            logger.exception("Error syncing VM inventory, a full sync will be done next time")
+            self.inventory_full_sync_at = None
+            raise
 
     def _poweroff_vm(self, nova, vm_uuid):
         try:
             logger.info("powering off VM %s", vm_uuid)
-            nova.servers.stop(vm_uuid)
+            _call_nova('stop', nova.servers.stop, vm_uuid)
             return SUCCESS_OK
         except novaclient.exceptions.NotFound:
             return ERR_NOT_FOUND
@@ -132,7 +269,7 @@ class NovaLeaseHandler:
     def _delete_vm(self, nova, vm_uuid):
         try:
             logger.info("Deleting VM %s", vm_uuid)
-            nova.servers.delete(vm_uuid)
+            _call_nova('delete', nova.servers.delete, vm_uuid)
             return SUCCESS_OK
         except novaclient.exceptions.NotFound:
             return ERR_NOT_FOUND
@@ -149,9 +286,8 @@ class NovaLeaseHandler:
         """
         result = {}
         try:
-            with self._get_nova_client() as nova:
-                for vm in vms:
-                    result[vm['instance_uuid']] = self._poweroff_vm(nova, vm['instance_uuid'])
+            nova = self._get_nova_client()
+            result = self.action_executor.run(functools.partial(self._poweroff_vm, nova), vms)
             return result
         except Exception as e:
             logger.exception("Error powering off vm %s", vms)
@@ -166,9 +302,8 @@ class NovaLeaseHandler:
         """
         result = {}
         try:
-            with self._get_nova_client() as nova:
-                for vm in vms:
-                    result[vm['instance_uuid']] = self._delete_vm(nova, vm['instance_uuid'])
+            nova = self._get_nova_client()
+            result = self.action_executor.run(functools.partial(self._delete_vm, nova), vms)
             return result
         except Exception as e:
             logger.exception("Error deleting vm %s", vms)
@@ -0,0 +1,173 @@
+"""
+Copyright 2016 Platform9 Systems Inc.(http://www.platform9.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import bisect
+
+# Upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Counter:
+    """
+    Monotonic counter, one value per tuple of label values.
+    samples() returns (name suffix, label dictionary, value) tuples.
+    """
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        # Counters without labels are reported from zero
+        self._values = {} if labelnames else {(): 0}
+
+    def inc(self, amount=1, labels=()):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, labels=()):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        return [('', dict(zip(self.labelnames, labels)), value) for labels, value in self._values.items()]
+
+
+class Gauge:
+    """
+    Value read from 'function' when the gauge is collected. A gauge without a
+    function has no samples until its owner sets one.
+    """
+    def __init__(self, name, documentation, function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = ()
+        self.function = function
+
+    def set_function(self, function):
+        self.function = function
+
+    def get(self, labels=()):
+        return self.function() if self.function is not None else None
+
+    def samples(self):
+        if self.function is None:
+            return []
+        return [('', {}, self.function())]
+
+
+class Histogram:
+    """
+    Histogram of observed values, one histogram per tuple of label values. Only the
+    count of the bucket an observation falls in is incremented, the cumulative counts
+    are computed when the histogram is collected.
+    """
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value, labels=()):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def get(self, labels=()):
+        """
+        :return: dictionary with the count, sum and cumulative bucket counts
+        """
+        entry = self._values.get(labels)
+        if entry is None:
+            return {'count': 0, 'sum': 0.0, 'buckets': {}}
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets + (float('inf'),), entry[0]):
+            cumulative += count
+            buckets[bound] = cumulative
+        return {'count': entry[2], 'sum': entry[1], 'buckets': buckets}
+
+    def samples(self):
+        samples = []
+        for labels in self._values:
+            value = self.get(labels)
+            label_dict = dict(zip(self.labelnames, labels))
+            for bound, count in value['buckets'].items():
+                samples.append(('_bucket', dict(label_dict, le=bound), count))
+            samples.append(('_sum', label_dict, value['sum']))
+            samples.append(('_count', label_dict, value['count']))
+        return samples
+
+
+class Registry:
+    """
+    Named collection of metrics, registering a name again replaces the metric
+    """
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, function=None):
+        return self.register(Gauge(name, documentation, function))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def metrics(self):
+        return list(self._metrics.values())
+
+
+REGISTRY = Registry()
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _format_value(value).replace('\\', '\\\\')
+                                          .replace('"', '\\"').replace('\n', '\\n'))
+                             for name, value in labels.items())
+
+
+def render(registry=REGISTRY):
+    """
+    Render the metrics of a registry in the Prometheus text exposition format
+    """
+    lines = []
+    for metric in registry.metrics():
+        metric_type = {Counter: 'counter', Gauge: 'gauge', Histogram: 'histogram'}[type(metric)]
+        lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+        lines.append('# TYPE %s %s' % (metric.name, metric_type))
+        for suffix, labels, value in metric.samples():
+            lines.append('%s%s%s %s' % (metric.name, suffix, _format_labels(labels), _format_value(value)))
+    return '\n'.join(lines) + '\n'
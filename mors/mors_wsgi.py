@@ -13,14 +13,20 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from .lease_manager import LeaseManager
 from .context_util import enforce, get_context, error_handler
+from . import metrics, serialization, tracing
+from .serialization import DATE_FORMAT, format_datetime, stream_json_list, stream_ndjson
 from flask.json import JSONEncoder
 from datetime import datetime
+import itertools
+import json
+import time
 
-DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 APP_NAME = "MORS"
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/jsonl')
+MAX_PAGE_SIZE = 1000
 
 
 health_app = Flask("mors_health")
@@ -30,7 +36,7 @@ class CustomJSONEncoder(JSONEncoder):
     def default(self, obj):
         try:
             if isinstance(obj, datetime):
-                return obj.strftime(DATE_FORMAT)
+                return format_datetime(obj)
             iterable = iter(obj)
         except TypeError:
             pass
@@ -45,13 +51,93 @@ app.json_encoder = CustomJSONEncoder
 
 lease_manager = None
 
+API_REQUEST_DURATION = metrics.REGISTRY.histogram(
+    'mors_api_request_duration_seconds', 'Duration of API requests until the response headers',
+    ('method', 'route', 'status'))
+
+
+@app.before_request
+def _start_request_timer():
+    g.request_start = time.monotonic()
+
+
+@app.after_request
+def _record_request_duration(response):
+    start = g.get('request_start')
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        API_REQUEST_DURATION.observe(time.monotonic() - start, (request.method, route, str(response.status_code)))
+    return response
+
+
+def _get_page_args():
+    """
+    Read the keyset pagination arguments, 'limit' is capped at MAX_PAGE_SIZE and
+    'marker' is the last id of the previous page
+    """
+    limit = request.args.get('limit')
+    if limit is not None:
+        limit = int(limit)
+        if limit <= 0:
+            raise ValueError("limit must be a positive integer")
+        limit = min(limit, MAX_PAGE_SIZE)
+    return limit, request.args.get('marker')
+
+
+def _wants_ndjson():
+    return request.accept_mimetypes.best_match(('application/json',) + NDJSON_MIMETYPES) in NDJSON_MIMETYPES
+
+
+def _stream_list(items, key, prefix=None, empty=b'{}'):
+    """
+    Stream a full listing instead of building it in memory, as a JSON object with the
+    items under 'key' or as NDJSON with one item per line when the client accepts it.
+    The first chunk is produced before the response is returned, so a failing query still
+    goes through error_handler and the error status. Once the status and headers are sent
+    an error while reading the remaining rows can only end the response early, the client
+    then gets a 200 with a truncated document.
+    """
+    if _wants_ndjson():
+        chunks, mimetype = stream_ndjson(items), NDJSON_MIMETYPES[0]
+    else:
+        chunks, mimetype = stream_json_list(items, key, prefix, empty), 'application/json'
+    first = next(chunks, None)
+    if first is None:
+        return Response(b'', mimetype=mimetype)
+    return Response(itertools.chain([first], chunks), mimetype=mimetype)
+
+
+def _tenant_lease_dict(tenant_lease):
+    """
+    API representation of a TenantLeaseRecord, an empty object when there is none
+    """
+    if tenant_lease is None:
+        return {}
+    return {'vm_lease_policy': tenant_lease.to_dict()}
+
+
+def _get_next_marker(items, limit, get_id):
+    if limit and len(items) == limit:
+        return get_id(items[-1])
+    return None
+
+
 @enforce(required=['admin'])
 @app.route("/v1/tenant/", methods=['GET'], strict_slashes=False)
 @error_handler
 def get_all_tenants():
-    all_tenants = lease_manager.get_tenant_leases(get_context())
+    limit, marker = _get_page_args()
+    if limit is None:
+        all_tenants = lease_manager.iter_tenant_leases(get_context(), request.args.get('action'))
+        return _stream_list((_tenant_lease_dict(x) for x in all_tenants), 'all_tenants')
+    all_tenants = [_tenant_lease_dict(x) for x in
+                   lease_manager.get_tenant_leases(get_context(), limit, marker, request.args.get('action'))]
     if all_tenants:
-        return jsonify({"all_tenants":all_tenants})
+        result = {"all_tenants": all_tenants}
+        next_marker = _get_next_marker(all_tenants, limit, lambda x: x['vm_lease_policy']['tenant_uuid'])
+        if next_marker:
+            result['next_marker'] = next_marker
+        return jsonify(result)
     else:
         return jsonify({}), 200, {'ContentType': 'application/json'}
 
@@ -62,7 +148,7 @@ def get_tenant(tenant_id):
     tenant_lease = lease_manager.get_tenant_lease(get_context(), tenant_id)
     if not tenant_lease:
         return jsonify({'success': False}), 404, {'ContentType': 'application/json'}
-    return jsonify(tenant_lease)
+    return jsonify(_tenant_lease_dict(tenant_lease))
 
 
 @enforce(required=['admin'])
@@ -89,10 +175,55 @@ def delete_tenant_lease(tenant_id):
 @app.route("/v1/tenant/<tenant_id>/instances/", methods=['GET'], strict_slashes=False)
 @error_handler
 def get_tenant_and_instances(tenant_id):
-    instances = lease_manager.get_tenant_and_associated_instance_leases(get_context(), tenant_id)
-    if not instances:
-        return jsonify({'success': False}), 404, {'ContentType': 'application/json'}
-    return jsonify(instances)
+    limit, marker = _get_page_args()
+    expires_before = request.args.get('expires_before')
+    if expires_before:
+        expires_before = datetime.strptime(expires_before, DATE_FORMAT)
+    if limit is None:
+        tenant_lease = lease_manager.get_tenant_lease(get_context(), tenant_id)
+        instances = lease_manager.iter_instance_leases(get_context(), tenant_id, expires_before,
+                                                       request.args.get('action'))
+        return _stream_list((x.to_dict() for x in instances), 'all_vms',
+                            prefix={'tenant_lease': _tenant_lease_dict(tenant_lease)}, empty=None)
+    tenant_lease, instances = lease_manager.get_tenant_and_associated_instance_leases(
+        get_context(), tenant_id, limit, marker, expires_before, request.args.get('action'))
+    result = {'tenant_lease': _tenant_lease_dict(tenant_lease),
+              'all_vms': [x.to_dict() for x in instances]}
+    next_marker = _get_next_marker(instances, limit, lambda x: x.instance_uuid)
+    if next_marker:
+        result['next_marker'] = next_marker
+    return jsonify(result)
+
+def _get_instance_lease_list():
+    """
+    Read a list of instance leases from the request, either a JSON array or NDJSON
+    with one lease per line. Expiry dates are converted, invalid ones are left as is
+    for the per item validation to report.
+    """
+    if request.mimetype in NDJSON_MIMETYPES:
+        lease_objs = [json.loads(line) for line in request.get_data(as_text=True).splitlines() if line.strip()]
+    else:
+        lease_objs = request.get_json(force=True)
+    if not isinstance(lease_objs, list):
+        raise ValueError("Expected a list of instance leases")
+    for lease_obj in lease_objs:
+        try:
+            lease_obj['expiry'] = datetime.strptime(lease_obj['expiry'], DATE_FORMAT)
+        except (KeyError, TypeError, ValueError):
+            pass
+    return lease_objs
+
+@enforce(required=['_member_'])
+@app.route("/v1/tenant/<tenant_id>/instances/", methods=['PUT', 'POST'], strict_slashes=False)
+@error_handler
+def add_update_vm_leases(tenant_id):
+    lease_objs = _get_instance_lease_list()
+    if request.method == "POST":
+        results = lease_manager.add_instance_leases(get_context(), tenant_id, lease_objs)
+    else:
+        results = lease_manager.update_instance_leases(get_context(), tenant_id, lease_objs)
+    return jsonify({'success': all(x['success'] for x in results), 'results': results}), 200, \
+        {'ContentType': 'application/json'}
 
 # --- Instance related ---
 @enforce(required=['_member_'])
@@ -101,7 +232,7 @@ def get_tenant_and_instances(tenant_id):
 def get_vm_lease(tenant_id, instance_id):
     lease_info = lease_manager.get_instance_lease(get_context(), instance_id)
     if lease_info:
-        return jsonify(lease_info), 200, {'ContentType': 'application/json'}
+        return jsonify(lease_info.to_dict()), 200, {'ContentType': 'application/json'}
     else:
         return jsonify({'error': 'Not found'}), 404, {'ContentType': 'application/json'}
 
@@ -129,6 +260,8 @@ def add_update_vm_lease(tenant_id, instance_id):
 
 def start_server(conf):
     global lease_manager
+    serialization.configure(conf.get("DEFAULT", "json_serializer", fallback=serialization.SERIALIZER_JSON))
+    tracing.configure(conf)
     lease_manager = LeaseManager(conf)
     lease_manager.start()
 
@@ -151,15 +284,25 @@ def health_app_factory(global_config, **local_conf):
     def liveness_check():
         return jsonify({"status": "alive", "service": APP_NAME}), 200
 
+    @health_app.route("/metrics", methods=["GET"])
+    def metrics_endpoint():
+        return Response(metrics.render(), content_type=metrics.PROMETHEUS_CONTENT_TYPE)
+
     @health_app.route("/ready", methods=["GET"])
     def readiness_check():
+        # Only looks at state published by the scheduler and a cached database ping,
+        # so the probe cost does not depend on the number of leases or VMs
         try:
             if lease_manager is None:
                 return jsonify(
                     {"status": "not ready", "reason": "lease_manager not initialized"}
                 ), 503
 
-            lease_manager.domain_mgr.get_all_tenant_leases()
+            db_healthy, db_status = lease_manager.is_db_healthy()
+            if not db_healthy:
+                return jsonify(
+                    {"status": "not ready", "reason": f"Database unhealthy: {db_status}"}
+                ), 503
 
             scheduler_healthy, scheduler_status = lease_manager.is_scheduler_healthy()
             if not scheduler_healthy:
@@ -172,9 +315,13 @@ def health_app_factory(global_config, **local_conf):
                     "status": "ready",
                     "service": APP_NAME,
                     "scheduler_status": scheduler_status,
+                    "inventory_cache": lease_manager.lease_handler.cache_stats(),
+                    "tenant_cache": lease_manager.domain_mgr.cache_stats(),
+                    "db_pool": lease_manager.domain_mgr.pool_stats(),
                     "last_scheduler_run": lease_manager.last_run_time.isoformat()
                     if lease_manager.last_run_time
                     else None,
+                    "scheduler": lease_manager.get_scheduler_state(),
                 }
             ), 200
         except Exception as e:
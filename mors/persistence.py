@@ -15,14 +15,42 @@ limitations under the License.
 """
 import functools
 import logging
+import time
 
 from sqlalchemy import Table, MetaData
+from sqlalchemy import select, literal, and_, bindparam
 from sqlalchemy import create_engine
+from sqlalchemy import exc
 from sqlalchemy.pool import QueuePool
+from mors import metrics
 from mors.constants import LOGGER_PREFIX
+from mors.records import TenantLeaseRecord, InstanceLeaseRecord
 
 logger = logging.getLogger(LOGGER_PREFIX+__name__)
 
+DEFAULT_DELETE_BATCH_SIZE = 500
+# Values bound per IN clause of the queries on a list of uuids, below the 999 bound
+# parameters older SQLite versions accept
+DEFAULT_IN_CLAUSE_SIZE = 500
+# SQLAlchemy QueuePool defaults
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+DEFAULT_POOL_TIMEOUT = 30
+DEFAULT_POOL_RECYCLE = -1
+
+DB_POOL_CHECKOUT_WAIT = metrics.REGISTRY.histogram(
+    'mors_db_pool_checkout_wait_seconds', 'Time waited to check out a connection from the pool')
+DB_POOL_TIMEOUTS = metrics.REGISTRY.counter(
+    'mors_db_pool_timeouts_total', 'Connection checkouts that timed out waiting for the pool')
+DB_QUERY_DURATION = metrics.REGISTRY.histogram(
+    'mors_db_query_duration_seconds', 'Duration of DbPersistence calls, including the connection checkout',
+    ('method',))
+# The pool gauges report the pool of the persistence that called register_metrics
+DB_POOL_SIZE = metrics.REGISTRY.gauge('mors_db_pool_size', 'Configured size of the connection pool')
+DB_POOL_IN_USE = metrics.REGISTRY.gauge('mors_db_pool_in_use', 'Connections checked out of the pool')
+DB_POOL_OVERFLOW = metrics.REGISTRY.gauge('mors_db_pool_overflow', 'Connections open beyond the pool size')
+TENANT_LEASE_VERSION = 'tenant_lease'
+
 
 def db_connect(transaction=False):
     """
@@ -32,6 +60,7 @@ def db_connect(transaction=False):
     """
 
     def _db_connect(fun):
+        labels = (getattr(fun, '__name__', fun.__class__.__name__),)
         if hasattr(fun, '__name__'):
             fun.__name__ = 'method_decorator(%s)' % fun.__name__
         else:
@@ -40,7 +69,8 @@ def db_connect(transaction=False):
         @functools.wraps(fun)
         def newfun(self, *args, **kwargs):
             trans = None
-            conn = self.engine.connect()
+            start = time.monotonic()
+            conn = self._connect()
             if transaction:
                 trans = conn.begin()
             try:
@@ -55,6 +85,7 @@ def db_connect(transaction=False):
                 raise
             finally:
                 conn.close()
+                DB_QUERY_DURATION.observe(time.monotonic() - start, labels)
 
         return newfun
 
@@ -62,25 +93,156 @@ def db_connect(transaction=False):
 
 
 class DbPersistence:
-    def __init__(self, db_conn_string):
-        self.engine = create_engine(db_conn_string, poolclass=QueuePool)
+    def __init__(self, db_conn_string, delete_batch_size=DEFAULT_DELETE_BATCH_SIZE, pool_size=DEFAULT_POOL_SIZE,
+                 max_overflow=DEFAULT_MAX_OVERFLOW, pool_timeout=DEFAULT_POOL_TIMEOUT,
+                 pool_recycle=DEFAULT_POOL_RECYCLE, pool_pre_ping=False, in_clause_size=DEFAULT_IN_CLAUSE_SIZE):
+        self.delete_batch_size = delete_batch_size
+        self.in_clause_size = in_clause_size
+        self.engine = create_engine(db_conn_string, poolclass=QueuePool, pool_size=pool_size,
+                                    max_overflow=max_overflow, pool_timeout=pool_timeout,
+                                    pool_recycle=pool_recycle, pool_pre_ping=pool_pre_ping)
         self.metadata = MetaData(bind=self.engine)
         self.tenant_lease = Table('tenant_lease', self.metadata, autoload=True)
         self.instance_lease = Table('instance_lease', self.metadata, autoload=True)
+        self.scheduler_member = Table('scheduler_member', self.metadata, autoload=True)
+        self.lease_version = Table('lease_version', self.metadata, autoload=True)
+        self.instance_action = Table('instance_action', self.metadata, autoload=True)
+        # Lease queries select the columns in the order of the record fields
+        self.tenant_lease_columns = [self.tenant_lease.c[x] for x in TenantLeaseRecord.FIELDS]
+        self.instance_lease_columns = [self.instance_lease.c[x] for x in InstanceLeaseRecord.FIELDS]
+        # The scheduler snapshot only reads the fields it enforces, the audit columns are
+        # not fetched and no time stamps are parsed for them
+        self.instance_lease_enforced_columns = self.instance_lease_columns[:4]
+
+    def _connect(self):
+        start = time.monotonic()
+        try:
+            return self.engine.connect()
+        except exc.TimeoutError:
+            DB_POOL_TIMEOUTS.inc()
+            raise
+        finally:
+            DB_POOL_CHECKOUT_WAIT.observe(time.monotonic() - start)
+
+    def register_metrics(self):
+        """
+        Report the pool of this instance in the pool gauges, only the persistence of the
+        running service should do so
+        """
+        DB_POOL_SIZE.set_function(self.engine.pool.size)
+        DB_POOL_IN_USE.set_function(self.engine.pool.checkedout)
+        DB_POOL_OVERFLOW.set_function(self._get_pool_overflow)
+
+    def _get_pool_overflow(self):
+        # QueuePool counts overflow from -pool_size while the pool is filling up
+        return max(0, self.engine.pool.overflow())
+
+    def pool_stats(self):
+        checkout_wait = DB_POOL_CHECKOUT_WAIT.get()
+        return {'size': self.engine.pool.size(),
+                'in_use': self.engine.pool.checkedout(),
+                'overflow': self._get_pool_overflow(),
+                'timeouts': DB_POOL_TIMEOUTS.get(),
+                'checkout_count': checkout_wait['count'],
+                'checkout_wait_seconds': checkout_wait['sum'],
+                'checkout_wait_buckets': {str(k): v for k, v in checkout_wait['buckets'].items()}}
+
+    @db_connect(transaction=False)
+    def ping(self, conn):
+        return conn.execute(select([literal(1)])).scalar()
+
+    def _bump_tenant_lease_version(self, conn):
+        conn.execute(self.lease_version.update().where(
+            self.lease_version.c.name == TENANT_LEASE_VERSION).values(version=self.lease_version.c.version + 1))
+
+    @db_connect(transaction=False)
+    def get_tenant_lease_version(self, conn):
+        """
+        Version stamp of the tenant_lease table, incremented by every tenant lease write
+        """
+        return conn.execute(select([self.lease_version.c.version]).where(
+            self.lease_version.c.name == TENANT_LEASE_VERSION)).scalar()
 
     @db_connect(transaction=False)
     def get_all_tenant_leases(self, conn):
-        return conn.execute(self.tenant_lease.select()).fetchall()
+        return [TenantLeaseRecord(*x) for x in conn.execute(select(self.tenant_lease_columns))]
+
+    @db_connect(transaction=False)
+    def get_all_tenant_and_instance_leases(self, conn, owns_tenant=None):
+        """
+        All tenant leases and the instance leases of those tenants, with two queries
+        on a single connection. The instance leases only have their instance_uuid, tenant_uuid,
+        expiry and action set.
+        :param owns_tenant: optional predicate on the tenant_uuid, the leases of the other
+                            tenants are left out and their instance leases are not read. The
+                            instance leases are then read in_clause_size tenants at a time.
+        :return: tuple of the tenant leases and a dictionary of tenant_uuid to its instance leases
+        """
+        tenant_leases = [TenantLeaseRecord(*x) for x in conn.execute(select(self.tenant_lease_columns))]
+        if owns_tenant is None:
+            conditions = [self.instance_lease.c.tenant_uuid.in_(select([self.tenant_lease.c.tenant_uuid]))]
+        else:
+            tenant_leases = [x for x in tenant_leases if owns_tenant(x.tenant_uuid)]
+            tenant_uuids = [x.tenant_uuid for x in tenant_leases]
+            conditions = [self.instance_lease.c.tenant_uuid.in_(chunk) for chunk in self._in_chunks(tenant_uuids)]
+        instance_leases = {}
+        for condition in conditions:
+            for row in conn.execute(select(self.instance_lease_enforced_columns).where(condition)):
+                lease = InstanceLeaseRecord(*row)
+                instance_leases.setdefault(lease.tenant_uuid, []).append(lease)
+        return tenant_leases, instance_leases
+
+    def _in_chunks(self, values):
+        """
+        Split a list of values for IN clauses of at most in_clause_size values
+        """
+        return [values[start:start + self.in_clause_size] for start in range(0, len(values), self.in_clause_size)]
+
+    def _iter_records(self, query, record_class):
+        """
+        Generator over the rows of a query as records, read through a server side cursor where
+        the driver supports it. The connection is held until the generator is exhausted or closed.
+        """
+        conn = self._connect()
+        try:
+            for row in conn.execution_options(stream_results=True).execute(query):
+                yield record_class(*row)
+        finally:
+            conn.close()
+
+    def _tenant_leases_query(self, limit=None, marker=None, action=None):
+        query = select(self.tenant_lease_columns)
+        if marker:
+            query = query.where(self.tenant_lease.c.tenant_uuid > marker)
+        if action:
+            query = query.where(self.tenant_lease.c.action == action)
+        query = query.order_by(self.tenant_lease.c.tenant_uuid)
+        if limit:
+            query = query.limit(limit)
+        return query
+
+    @db_connect(transaction=False)
+    def get_tenant_leases_page(self, conn, limit=None, marker=None, action=None):
+        """
+        Tenant leases ordered by tenant_uuid, starting after the 'marker' tenant_uuid
+        """
+        return [TenantLeaseRecord(*x) for x in conn.execute(self._tenant_leases_query(limit, marker, action))]
+
+    def iter_tenant_leases(self, action=None):
+        return self._iter_records(self._tenant_leases_query(action=action), TenantLeaseRecord)
 
     @db_connect(transaction=False)
     def get_tenant_lease(self, conn, tenant_uuid):
-        return conn.execute(self.tenant_lease.select(self.tenant_lease.c.tenant_uuid == tenant_uuid)).first()
+        row = conn.execute(select(self.tenant_lease_columns).where(
+            self.tenant_lease.c.tenant_uuid == tenant_uuid)).first()
+        return TenantLeaseRecord(*row) if row else None
 
     @db_connect(transaction=True)
     def add_tenant_lease(self, conn, tenant_uuid, expiry_mins, action, created_by, created_at):
         logger.debug("Adding tenant lease %s %d %s %s %s", tenant_uuid, expiry_mins, action, str(created_at), created_by)
         conn.execute(self.tenant_lease.insert(), tenant_uuid=tenant_uuid, expiry_mins=expiry_mins,
                      action=action, created_at=created_at, created_by=created_by)
+        self._bump_tenant_lease_version(conn)
 
     @db_connect(transaction=True)
     def update_tenant_lease(self, conn, tenant_uuid, expiry_mins, action, updated_by, updated_at):
@@ -89,23 +251,91 @@ class DbPersistence:
             self.tenant_lease.c.tenant_uuid == tenant_uuid).
                      values(expiry_mins=expiry_mins, action=action,
                             updated_at=updated_at, updated_by=updated_by))
+        self._bump_tenant_lease_version(conn)
 
-    @db_connect(transaction=True)
-    def delete_tenant_lease(self, conn, tenant_uuid):
+    def delete_tenant_lease(self, tenant_uuid):
+        """
+        Delete the tenant lease and then its instance leases in chunks of delete_batch_size,
+        each chunk in its own transaction so that row locks are held briefly. Deleting
+        the tenant lease first means a failure part way leaves instance leases that are no
+        longer enforced, calling this again removes them.
+        """
         # Should we just soft delete ?
         logger.debug("Deleting tenant lease %s", tenant_uuid)
+        self._delete_tenant_lease_row(tenant_uuid)
+        deleted = 0
+        while True:
+            count = self._delete_instance_lease_chunk_by_tenant(tenant_uuid)
+            if not count:
+                break
+            deleted += count
+            logger.info("Deleted %d instance leases of tenant %s", deleted, tenant_uuid)
+
+    @db_connect(transaction=True)
+    def _delete_tenant_lease_row(self, conn, tenant_uuid):
         conn.execute(self.tenant_lease.delete().where(self.tenant_lease.c.tenant_uuid == tenant_uuid))
-        conn.execute(self.instance_lease.delete().where(self.instance_lease.c.tenant_uuid == tenant_uuid))
+        self._bump_tenant_lease_version(conn)
+
+    @db_connect(transaction=True)
+    def _delete_instance_lease_chunk_by_tenant(self, conn, tenant_uuid):
+        instance_uuids = [x[0] for x in conn.execute(select([self.instance_lease.c.instance_uuid]).where(
+                self.instance_lease.c.tenant_uuid == tenant_uuid).limit(self.delete_batch_size))]
+        if instance_uuids:
+            conn.execute(self.instance_lease.delete().where(self.instance_lease.c.instance_uuid.in_(instance_uuids)))
+        return len(instance_uuids)
 
     @db_connect(transaction=False)
     def get_instance_leases_by_tenant(self, conn, tenant_uuid):
-        return conn.execute(self.instance_lease.select(
-                self.instance_lease.c.tenant_uuid == tenant_uuid)).fetchall()
+        return [InstanceLeaseRecord(*x) for x in conn.execute(select(self.instance_lease_columns).where(
+                self.instance_lease.c.tenant_uuid == tenant_uuid))]
+
+    def _instance_leases_query(self, tenant_uuid, limit=None, marker=None, expires_before=None, action=None):
+        query = select(self.instance_lease_columns).where(self.instance_lease.c.tenant_uuid == tenant_uuid)
+        if marker:
+            query = query.where(self.instance_lease.c.instance_uuid > marker)
+        if expires_before:
+            query = query.where(self.instance_lease.c.expiry < expires_before)
+        if action:
+            query = query.where(self.instance_lease.c.action == action)
+        query = query.order_by(self.instance_lease.c.instance_uuid)
+        if limit:
+            query = query.limit(limit)
+        return query
+
+    @db_connect(transaction=False)
+    def get_instance_leases_page(self, conn, tenant_uuid, limit=None, marker=None, expires_before=None,
+                                 action=None):
+        """
+        Instance leases of a tenant ordered by instance_uuid, starting after the 'marker' instance_uuid
+        """
+        return [InstanceLeaseRecord(*x) for x in conn.execute(
+            self._instance_leases_query(tenant_uuid, limit, marker, expires_before, action))]
+
+    def iter_instance_leases(self, tenant_uuid, expires_before=None, action=None):
+        return self._iter_records(self._instance_leases_query(tenant_uuid, expires_before=expires_before,
+                                                              action=action), InstanceLeaseRecord)
+
+    @db_connect(transaction=False)
+    def get_expired_instance_leases_by_tenant(self, conn, tenant_uuid, now):
+        return [InstanceLeaseRecord(*x) for x in conn.execute(select(self.instance_lease_columns).where(and_(
+                self.instance_lease.c.tenant_uuid == tenant_uuid,
+                self.instance_lease.c.expiry < now)))]
+
+    @db_connect(transaction=False)
+    def get_unexpired_instance_leases_by_tenant(self, conn, tenant_uuid, now):
+        """
+        Only the instance_uuid and expiry of the leases that have not expired yet
+        """
+        return conn.execute(select([self.instance_lease.c.instance_uuid,
+                                    self.instance_lease.c.expiry]).where(and_(
+                self.instance_lease.c.tenant_uuid == tenant_uuid,
+                self.instance_lease.c.expiry >= now))).fetchall()
 
     @db_connect(transaction=False)
     def get_instance_lease(self, conn, instance_uuid):
-        return conn.execute(self.instance_lease.select((
-                        self.instance_lease.c.instance_uuid == instance_uuid))).first()
+        row = conn.execute(select(self.instance_lease_columns).where(
+            self.instance_lease.c.instance_uuid == instance_uuid)).first()
+        return InstanceLeaseRecord(*row) if row else None
 
     @db_connect(transaction=True)
     def add_instance_lease(self, conn, instance_uuid, tenant_uuid, expiry, action, created_by, created_at):
@@ -122,8 +352,122 @@ class DbPersistence:
                      (tenant_uuid=tenant_uuid, expiry=expiry, action=action,
                       updated_at=updated_at, updated_by=updated_by))
 
+    @db_connect(transaction=False)
+    def get_existing_instance_lease_ids(self, conn, instance_uuids):
+        if not instance_uuids:
+            return []
+        return [x[0] for x in conn.execute(select([self.instance_lease.c.instance_uuid]).where(
+                self.instance_lease.c.instance_uuid.in_(instance_uuids)))]
+
+    @db_connect(transaction=True)
+    def add_instance_leases(self, conn, leases):
+        """
+        Insert several instance leases with a single executemany
+        :param leases: list of dictionaries with the instance_lease columns
+        """
+        logger.debug("Adding %d instance leases", len(leases))
+        conn.execute(self.instance_lease.insert(), leases)
+
     @db_connect(transaction=True)
-    def delete_instance_leases(self, conn, instance_uuids):
-        # Delete 10 at a time, should we soft delete
+    def update_instance_leases(self, conn, leases):
+        """
+        Update several instance leases with a single executemany
+        :param leases: list of dictionaries with instance_uuid and the instance_lease columns to update
+        """
+        logger.debug("Updating %d instance leases", len(leases))
+        params = []
+        for lease in leases:
+            lease = dict(lease)
+            lease['lease_instance_uuid'] = lease.pop('instance_uuid')
+            params.append(lease)
+        conn.execute(self.instance_lease.update().where(
+            self.instance_lease.c.instance_uuid == bindparam('lease_instance_uuid')), params)
+
+    def delete_instance_leases(self, instance_uuids):
+        """
+        Delete instance leases in chunks of delete_batch_size, each chunk in its own transaction
+        """
+        # should we soft delete
         logger.debug("Deleting instance leases %s", str(instance_uuids))
+        instance_uuids = list(instance_uuids)
+        for start in range(0, len(instance_uuids), self.delete_batch_size):
+            chunk = instance_uuids[start:start + self.delete_batch_size]
+            self._delete_instance_lease_chunk(chunk)
+            if len(instance_uuids) > self.delete_batch_size:
+                logger.info("Deleted %d of %d instance leases", start + len(chunk), len(instance_uuids))
+
+    @db_connect(transaction=True)
+    def _delete_instance_lease_chunk(self, conn, instance_uuids):
         conn.execute(self.instance_lease.delete().where(self.instance_lease.c.instance_uuid.in_(instance_uuids)))
+
+    @db_connect(transaction=True)
+    def heartbeat_scheduler_member(self, conn, member_id, hostname, now):
+        result = conn.execute(self.scheduler_member.update().where(
+            self.scheduler_member.c.member_id == member_id).values(heartbeat_at=now))
+        if not result.rowcount:
+            logger.info("Registering scheduler member %s", member_id)
+            conn.execute(self.scheduler_member.insert(), member_id=member_id, hostname=hostname,
+                         started_at=now, heartbeat_at=now)
+
+    @db_connect(transaction=False)
+    def get_live_scheduler_members(self, conn, heartbeat_after):
+        return [x[0] for x in conn.execute(select([self.scheduler_member.c.member_id]).where(
+                self.scheduler_member.c.heartbeat_at >= heartbeat_after).order_by(
+                self.scheduler_member.c.member_id))]
+
+    @db_connect(transaction=True)
+    def delete_expired_scheduler_members(self, conn, heartbeat_before):
+        return conn.execute(self.scheduler_member.delete().where(
+            self.scheduler_member.c.heartbeat_at < heartbeat_before)).rowcount
+
+    @db_connect(transaction=False)
+    def get_instance_actions(self, conn, instance_uuids):
+        """
+        Ledger entries of the last action taken on the given instances
+        :return: dictionary of instance_uuid to ledger row
+        """
+        instance_uuids = list(instance_uuids)
+        actions = {}
+        for chunk in self._in_chunks(instance_uuids):
+            for row in conn.execute(self.instance_action.select().where(
+                    self.instance_action.c.instance_uuid.in_(chunk))):
+                actions[row['instance_uuid']] = row
+        return actions
+
+    @db_connect(transaction=False)
+    def get_instance_actions_by_tenant(self, conn, acted_after, tenant_uuids=None):
+        """
+        Ledger entries of the actions taken since 'acted_after', read once per scheduler cycle
+        :param tenant_uuids: optional list of tenants, only their entries are read, in_clause_size
+                             tenants at a time
+        :return: dictionary of tenant_uuid to a dictionary of instance_uuid to ledger row
+        """
+        query = self.instance_action.select().where(self.instance_action.c.acted_at >= acted_after)
+        if tenant_uuids is None:
+            queries = [query]
+        else:
+            queries = [query.where(self.instance_action.c.tenant_uuid.in_(chunk))
+                       for chunk in self._in_chunks(list(tenant_uuids))]
+        actions = {}
+        for query in queries:
+            for row in conn.execute(query):
+                actions.setdefault(row['tenant_uuid'], {})[row['instance_uuid']] = row
+        return actions
+
+    @db_connect(transaction=True)
+    def record_instance_actions(self, conn, action, results, now, remove=(), acted_before=None):
+        """
+        Replace the ledger entries of the instances in 'results' with the action taken
+        and its result, the entries of the instances in 'remove' are dropped
+        :param results: dictionary of instance_uuid to a tuple of its tenant_uuid and the action result
+        :param acted_before: also drop the entries of the actions taken before this time
+        """
+        if acted_before is not None:
+            conn.execute(self.instance_action.delete().where(self.instance_action.c.acted_at < acted_before))
+        instance_uuids = list(results) + list(remove)
+        for chunk in self._in_chunks(instance_uuids):
+            conn.execute(self.instance_action.delete().where(self.instance_action.c.instance_uuid.in_(chunk)))
+        if results:
+            conn.execute(self.instance_action.insert(), [
+                {'instance_uuid': instance_uuid, 'tenant_uuid': tenant_uuid, 'action': action,
+                 'result': result, 'acted_at': now} for instance_uuid, (tenant_uuid, result) in results.items()])
@@ -0,0 +1,104 @@
+"""
+Copyright 2016 Platform9 Systems Inc.(http://www.platform9.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import logging
+import time
+
+from mors.cache import TTLCache
+from mors.constants import LOGGER_PREFIX
+
+logger = logging.getLogger(LOGGER_PREFIX+__name__)
+
+ALL_TENANTS_KEY = '*'
+DEFAULT_TENANT_CACHE_TTL = 30
+DEFAULT_TENANT_CACHE_SIZE = 10000
+DEFAULT_TENANT_CACHE_VERSION_SECONDS = 5
+
+# Cached in place of None so that lookups of tenants without a lease are cached too
+_NO_LEASE = object()
+
+
+class CachedPersistence:
+    """
+    DbPersistence wrapper that keeps tenant lease policies in an LRU/TTL cache.
+    Tenant lease writes through this wrapper invalidate the cached entries. Writes by
+    other replicas are detected with the tenant lease version stamp of the database,
+    which is read at most once every 'version_seconds', the whole cache is dropped
+    when it changes. Everything else is delegated to the wrapped persistence.
+    """
+    def __init__(self, domain_mgr, ttl=DEFAULT_TENANT_CACHE_TTL, max_size=DEFAULT_TENANT_CACHE_SIZE,
+                 version_seconds=DEFAULT_TENANT_CACHE_VERSION_SECONDS):
+        self.domain_mgr = domain_mgr
+        self.cache = TTLCache(ttl, max_size)
+        self.version_seconds = version_seconds
+        self.version = None
+        self.version_checked_at = 0
+
+    def __getattr__(self, name):
+        return getattr(self.domain_mgr, name)
+
+    def _check_version(self):
+        now = time.time()
+        if now - self.version_checked_at < self.version_seconds:
+            return
+        version = self.domain_mgr.get_tenant_lease_version()
+        self.version_checked_at = now
+        if version != self.version:
+            if self.version is not None:
+                logger.debug("Tenant lease version changed from %s to %s, clearing cache",
+                             self.version, version)
+            self.cache.clear()
+            self.version = version
+
+    def get_tenant_lease(self, tenant_uuid):
+        self._check_version()
+        data = self.cache.get(tenant_uuid)
+        if data is None:
+            data = self.domain_mgr.get_tenant_lease(tenant_uuid)
+            self.cache.set(tenant_uuid, _NO_LEASE if data is None else data)
+        return None if data is _NO_LEASE else data
+
+    def get_all_tenant_leases(self):
+        self._check_version()
+        tenant_leases = self.cache.get(ALL_TENANTS_KEY)
+        if tenant_leases is None:
+            tenant_leases = self.domain_mgr.get_all_tenant_leases()
+            self.cache.set(ALL_TENANTS_KEY, tenant_leases)
+        return tenant_leases
+
+    def invalidate(self, tenant_uuid):
+        self.cache.invalidate(tenant_uuid)
+        self.cache.invalidate(ALL_TENANTS_KEY)
+
+    def add_tenant_lease(self, tenant_uuid, *args):
+        try:
+            return self.domain_mgr.add_tenant_lease(tenant_uuid, *args)
+        finally:
+            self.invalidate(tenant_uuid)
+
+    def update_tenant_lease(self, tenant_uuid, *args):
+        try:
+            return self.domain_mgr.update_tenant_lease(tenant_uuid, *args)
+        finally:
+            self.invalidate(tenant_uuid)
+
+    def delete_tenant_lease(self, tenant_uuid):
+        try:
+            return self.domain_mgr.delete_tenant_lease(tenant_uuid)
+        finally:
+            self.invalidate(tenant_uuid)
+
+    def cache_stats(self):
+        return self.cache.stats()
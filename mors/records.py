@@ -0,0 +1,99 @@
+"""
+Copyright 2016 Platform9 Systems Inc.(http://www.platform9.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from datetime import datetime
+
+from mors.serialization import DATE_FORMAT
+
+
+class Record:
+    """
+    Base of the compact records the scheduler and the API work with instead of per row
+    dictionaries, FIELDS are the public fields in constructor order. Records are turned
+    into dictionaries only when they are serialized.
+    """
+    __slots__ = ()
+    FIELDS = ()
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(getattr(self, x) == getattr(other, x) for x in self.FIELDS)
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, ", ".join("%s=%r" % (x, getattr(self, x)) for x in self.FIELDS))
+
+    def to_dict(self):
+        return dict((x, getattr(self, x)) for x in self.FIELDS)
+
+
+class TenantLeaseRecord(Record):
+    """
+    Tenant default policy, VMs without an explicit lease expire expiry_mins after their creation
+    """
+    __slots__ = FIELDS = ('tenant_uuid', 'expiry_mins', 'action', 'created_at', 'created_by',
+                          'updated_at', 'updated_by')
+
+    def __init__(self, tenant_uuid, expiry_mins, action, created_at=None, created_by=None,
+                 updated_at=None, updated_by=None):
+        self.tenant_uuid = tenant_uuid
+        self.expiry_mins = expiry_mins
+        self.action = action
+        self.created_at = created_at
+        self.created_by = created_by
+        self.updated_at = updated_at
+        self.updated_by = updated_by
+
+
+class InstanceLeaseRecord(Record):
+    """
+    Explicit lease of a VM
+    """
+    __slots__ = FIELDS = ('instance_uuid', 'tenant_uuid', 'expiry', 'action', 'created_at', 'created_by',
+                          'updated_at', 'updated_by')
+
+    def __init__(self, instance_uuid, tenant_uuid, expiry, action, created_at=None, created_by=None,
+                 updated_at=None, updated_by=None):
+        self.instance_uuid = instance_uuid
+        self.tenant_uuid = tenant_uuid
+        self.expiry = expiry
+        self.action = action
+        self.created_at = created_at
+        self.created_by = created_by
+        self.updated_at = updated_at
+        self.updated_by = updated_by
+
+
+class VmRecord(Record):
+    """
+    VM of the inventory, with the fields the scheduler needs. Records of a Nova listing
+    keep the creation time as formatted by Nova in 'created' and only parse it when
+    created_at is first read, the numpy evaluation engine parses them all at once.
+    """
+    __slots__ = ('instance_uuid', 'tenant_uuid', 'status', 'created', 'created_at')
+    FIELDS = ('instance_uuid', 'tenant_uuid', 'status', 'created_at')
+
+    def __init__(self, instance_uuid, tenant_uuid, status=None, created_at=None, created=None):
+        self.instance_uuid = instance_uuid
+        self.tenant_uuid = tenant_uuid
+        self.status = status
+        self.created = created
+        if created_at is not None or created is None:
+            self.created_at = created_at
+
+    def __getattr__(self, name):
+        # Only called while the created_at slot is unset, reads of the parsed value stay plain slot reads
+        if name != 'created_at':
+            raise AttributeError(name)
+        self.created_at = datetime.strptime(self.created, DATE_FORMAT)
+        return self.created_at
@@ -0,0 +1,111 @@
+"""
+Copyright 2016 Platform9 Systems Inc.(http://www.platform9.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import functools
+import json
+import logging
+from datetime import datetime
+
+from mors.constants import LOGGER_PREFIX
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(LOGGER_PREFIX+__name__)
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+SERIALIZER_JSON = 'json'
+SERIALIZER_ORJSON = 'orjson'
+
+
+# Leases created or updated together share timestamps, so formatting is cached
+@functools.lru_cache(maxsize=4096)
+def format_datetime(value):
+    return value.strftime(DATE_FORMAT)
+
+
+def _default(obj):
+    if isinstance(obj, datetime):
+        return format_datetime(obj)
+    raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, default=_default, separators=(',', ':')).encode('utf-8')
+
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj, default=_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+
+dumps = _json_dumps
+
+
+def configure(serializer):
+    """
+    Select the serializer used by dumps, orjson is only used when it is installed
+    """
+    global dumps
+    if serializer == SERIALIZER_ORJSON:
+        if orjson is not None:
+            dumps = _orjson_dumps
+            return
+        logger.warning("orjson is not installed, using the json module for serialization")
+    dumps = _json_dumps
+
+
+def stream_json_list(items, key, prefix=None, empty=b'{}', chunk_items=100):
+    """
+    Generator writing a JSON object whose 'key' member is the list of items, without
+    building the whole document in memory. Items are written 'chunk_items' at a time.
+    :param items: iterable of serializable objects
+    :param prefix: dictionary of other members written before the list
+    :param empty: document written when there are no items, None to write an empty list
+    An error raised by 'items' after the first chunk ends the document early.
+    """
+    items = iter(items)
+    first = next(items, None)
+    if first is None and empty is not None:
+        yield empty
+        return
+    head = dumps(prefix or {})[:-1]
+    if len(head) > 1:
+        head += b','
+    chunk = [head + dumps(key) + b':[']
+    if first is not None:
+        chunk.append(dumps(first))
+        for item in items:
+            chunk.append(b',' + dumps(item))
+            if len(chunk) >= chunk_items:
+                yield b''.join(chunk)
+                chunk = []
+    chunk.append(b']}')
+    yield b''.join(chunk)
+
+
+def stream_ndjson(items, chunk_items=100):
+    """
+    Generator writing one JSON document per line for each of the items
+    """
+    chunk = []
+    for item in items:
+        chunk.append(dumps(item) + b'\n')
+        if len(chunk) >= chunk_items:
+            yield b''.join(chunk)
+            chunk = []
+    if chunk:
+        yield b''.join(chunk)
@@ -0,0 +1,196 @@
+"""
+Copyright 2016 Platform9 Systems Inc.(http://www.platform9.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import contextlib
+import logging
+import random
+import time
+import uuid
+
+from eventlet.corolocal import local
+
+from mors import serialization
+from mors.constants import LOGGER_PREFIX
+
+logger = logging.getLogger(LOGGER_PREFIX+__name__)
+
+EXPORTER_JSONL = 'jsonl'
+EXPORTER_LOG = 'log'
+DEFAULT_TRACING_FILE = '/var/log/pf9/pf9-mors-traces.jsonl'
+DEFAULT_SAMPLE_RATE = 1.0
+
+
+class Span:
+    """
+    Timed phase of a trace, exported when the 'with' block ends
+    """
+    def __init__(self, tracer, name, trace_id, parent_id, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start = None
+        self.duration = None
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self.tracer._push(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.duration = time.time() - self.start
+        self.tracer._pop()
+        if exc_value is not None:
+            self.error = repr(exc_value)
+        self.tracer.export(self)
+        return False
+
+    def to_dict(self):
+        return {'trace_id': self.trace_id,
+                'span_id': self.span_id,
+                'parent_id': self.parent_id,
+                'name': self.name,
+                'start': self.start,
+                'duration': self.duration,
+                'attributes': self.attributes,
+                'error': self.error}
+
+
+class _NoopSpan:
+    """
+    Span returned when tracing is off or the trace is not sampled
+    """
+    def set_attribute(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class JsonLinesExporter:
+    """
+    Appends every finished span as one JSON document per line to a file
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'ab')
+
+    def export(self, span):
+        self._file.write(serialization.dumps(span.to_dict()) + b'\n')
+        self._file.flush()
+
+
+class LogExporter:
+    def export(self, span):
+        logger.info("Span %s %.3fs %s", span.name, span.duration, span.attributes)
+
+
+class Tracer:
+    """
+    Creates spans and hands the finished ones to the exporter. Sampling is decided
+    once per trace when the root span is created, the spans of a trace that is not
+    sampled cost a single call returning NOOP_SPAN. The current span is tracked per
+    green thread, work handed to another green thread passes its parent explicitly
+    with span(parent=...) or attach().
+    """
+    def __init__(self, exporter=None, sample_rate=DEFAULT_SAMPLE_RATE):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self._local = local()
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _push(self, span):
+        self._stack().append(span)
+
+    def _pop(self):
+        self._stack().pop()
+
+    def current_span(self):
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def span(self, name, parent=None, root=False, **attributes):
+        """
+        :param parent: parent span, defaults to the current span of this green thread
+        :param root: start a new trace when there is no parent, otherwise spans without
+                     a parent are not recorded
+        """
+        if self.exporter is None:
+            return NOOP_SPAN
+        if parent is None:
+            parent = self.current_span()
+        if parent is NOOP_SPAN:
+            return NOOP_SPAN
+        if parent is not None:
+            return Span(self, name, parent.trace_id, parent.span_id, attributes)
+        if not root or random.random() >= self.sample_rate:
+            return NOOP_SPAN
+        return Span(self, name, uuid.uuid4().hex, None, attributes)
+
+    @contextlib.contextmanager
+    def attach(self, span):
+        """
+        Make 'span' the current span of this green thread for the 'with' block
+        """
+        if span is None or span is NOOP_SPAN:
+            yield
+            return
+        self._push(span)
+        try:
+            yield
+        finally:
+            self._pop()
+
+    def export(self, span):
+        try:
+            self.exporter.export(span)
+        except Exception:
+            logger.exception("Failed to export span %s", span.name)
+
+
+TRACER = Tracer()
+
+
+def configure(conf):
+    """
+    Set up the exporter and sampling rate of TRACER, tracing is off without an exporter
+    """
+    exporter_name = conf.get("DEFAULT", "tracing_exporter", fallback="")
+    if exporter_name == EXPORTER_JSONL:
+        TRACER.exporter = JsonLinesExporter(conf.get("DEFAULT", "tracing_file", fallback=DEFAULT_TRACING_FILE))
+    elif exporter_name == EXPORTER_LOG:
+        TRACER.exporter = LogExporter()
+    else:
+        if exporter_name:
+            logger.warning("Unknown tracing exporter %s, tracing is off", exporter_name)
+        TRACER.exporter = None
+    TRACER.sample_rate = conf.getfloat("DEFAULT", "tracing_sample_rate", fallback=DEFAULT_SAMPLE_RATE)
@@ -0,0 +1,17 @@
+# Copyright Platform9 Systems Inc. 2016
+from sqlalchemy import Index, MetaData, Table
+
+INDEX_NAME = 'ix_instance_lease_tenant_uuid_expiry'
+
+
+def upgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    table = Table('instance_lease', meta, autoload=True)
+    # Also serves lookups by tenant_uuid alone, being the leftmost column
+    Index(INDEX_NAME, table.c.tenant_uuid, table.c.expiry).create(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    table = Table('instance_lease', meta, autoload=True)
+    Index(INDEX_NAME, table.c.tenant_uuid, table.c.expiry).drop(migrate_engine)
@@ -0,0 +1,22 @@
+# Copyright Platform9 Systems Inc. 2016
+from sqlalchemy import Table, Column, String, MetaData, DateTime
+
+meta = MetaData()
+
+scheduler_member = Table(
+    'scheduler_member', meta,
+    Column('member_id', String(255), primary_key=True),
+    Column('hostname', String(255)),
+    Column('started_at', DateTime),
+    Column('heartbeat_at', DateTime)
+)
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    scheduler_member.create()
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    scheduler_member.drop()
@@ -0,0 +1,21 @@
+# Copyright Platform9 Systems Inc. 2016
+from sqlalchemy import Table, Column, String, Integer, MetaData
+
+meta = MetaData()
+
+lease_version = Table(
+    'lease_version', meta,
+    Column('name', String(64), primary_key=True),
+    Column('version', Integer, nullable=False)
+)
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    lease_version.create()
+    migrate_engine.execute(lease_version.insert(), name='tenant_lease', version=0)
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    lease_version.drop()
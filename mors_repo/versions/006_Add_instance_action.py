@@ -0,0 +1,25 @@
+# Copyright Platform9 Systems Inc. 2016
+from sqlalchemy import Table, Column, Index, Integer, String, MetaData, DateTime
+
+meta = MetaData()
+
+instance_action = Table(
+    'instance_action', meta,
+    Column('instance_uuid', String(40), primary_key=True),
+    Column('tenant_uuid', String(40)),
+    Column('action', String(40)),
+    Column('result', Integer),
+    Column('acted_at', DateTime),
+    # Old entries are pruned by acted_at
+    Index('ix_instance_action_acted_at', 'acted_at')
+)
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    instance_action.create()
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    instance_action.drop()
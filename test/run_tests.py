@@ -16,7 +16,9 @@ limitations under the License.
 def run_tests():
     from proboscis import TestProgram
 
-    import test_api, test_persistence
+    import test_api, test_persistence, test_expiry_index, test_coordination, test_metrics, test_tracing, test_nova_lease_handler, \
+        test_evaluation, test_scheduler, test_action_executor, \
+        test_inventory_cache, test_health
 
     # Run Proboscis and exit.
     TestProgram().run_and_exit()
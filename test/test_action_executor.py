@@ -0,0 +1,85 @@
+"""
+Copyright 2016 Platform9 Systems Inc.(http://www.platform9.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import time
+
+import eventlet
+from proboscis import test
+from proboscis.asserts import assert_equal, assert_true
+from mors.leasehandler.action_executor import ActionExecutor
+from mors.leasehandler.constants import SUCCESS_OK, ERR_UNKNOWN
+from mors.records import VmRecord
+
+
+def _get_vms(count):
+    return [VmRecord("vm-%d" % i, "tenant-1") for i in range(count)]
+
+
+@test
+def test_rate_limit():
+    rate = 100
+    calls = []
+
+    def action(vm_uuid):
+        calls.append(time.time())
+        return SUCCESS_OK
+
+    executor = ActionExecutor(workers=8, rate_limit=rate)
+    result = executor.run(action, _get_vms(150))
+    assert_equal(len(result), 150)
+    # The bucket starts full with 'rate' tokens, then refills at 'rate' per second,
+    # so no interval between two calls holds more calls than that allows
+    capacity = executor.rate_limiter.capacity
+    for i in range(len(calls)):
+        for j in range(i + 1, len(calls)):
+            assert_true(j - i + 1 <= capacity + rate * (calls[j] - calls[i]) + 1)
+    assert_true(calls[-1] - calls[0] >= (150 - capacity - 1) / rate)
+
+
+@test
+def test_serial_without_workers_or_rate():
+    order = []
+    in_flight = [0, 0]
+
+    def action(vm_uuid):
+        in_flight[0] += 1
+        in_flight[1] = max(in_flight)
+        eventlet.sleep(0.001)
+        order.append(vm_uuid)
+        in_flight[0] -= 1
+        return SUCCESS_OK
+
+    executor = ActionExecutor(workers=1, rate_limit=0)
+    vms = _get_vms(10)
+    result = executor.run(action, vms)
+    assert_equal(executor.rate_limiter, None)
+    # Same as the serial loop, one call at a time in listing order
+    assert_equal(in_flight[1], 1)
+    assert_equal(order, [vm.instance_uuid for vm in vms])
+    assert_equal(result, dict((vm.instance_uuid, SUCCESS_OK) for vm in vms))
+
+
+@test
+def test_failed_call_has_a_result():
+    def action(vm_uuid):
+        if vm_uuid == "vm-3":
+            raise RuntimeError("Nova is unavailable")
+        return SUCCESS_OK
+
+    vms = _get_vms(8)
+    result = ActionExecutor(workers=4).run(action, vms)
+    assert_equal(sorted(result.keys()), sorted(vm.instance_uuid for vm in vms))
+    assert_equal(result["vm-3"], ERR_UNKNOWN)
+    assert_equal(sum(1 for x in result.values() if x == SUCCESS_OK), 7)
@@ -14,6 +14,7 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 import os
+import json
 import sys;
 import time;
 import eventlet
@@ -29,6 +30,7 @@ from proboscis.asserts import assert_equal
 from proboscis import test
 import shutil
 from mors.leasehandler.fake_lease_handler import FakeLeaseHandler
+from mors.records import VmRecord
 
 from six.moves.configparser import ConfigParser
 try:
@@ -73,15 +75,15 @@ def _setup_lease_handler():
     now = datetime.now()
     dt = timedelta(days=3)
     creation_time = now - dt
-    t1_vms = [{'instance_uuid': 'instance-123-t1', 'tenant_uuid': tenant_id1, 'created_at': creation_time},
-              {'instance_uuid': 'instance-456-t1', 'tenant_uuid': tenant_id1, 'created_at': now},
-              {'instance_uuid': instance_id1, 'tenant_uuid': tenant_id1, 'created_at': now},
-              {'instance_uuid': instance_id2, 'tenant_uuid': tenant_id1, 'created_at': now}]
+    t1_vms = [VmRecord('instance-123-t1', tenant_id1, created_at=creation_time),
+              VmRecord('instance-456-t1', tenant_id1, created_at=now),
+              VmRecord(instance_id1, tenant_id1, created_at=now),
+              VmRecord(instance_id2, tenant_id1, created_at=now)]
     fakeLeaseHandler.add_tenant_data(tenant_id1, t1_vms)
 
-    t2_vms = [{'instance_uuid': 'instance-123-t2', 'tenant_uuid': tenant_id2, 'created_at': creation_time},
-              {'instance_uuid': 'instance-456-t2', 'tenant_uuid': tenant_id2, 'created_at': now},
-              {'instance_uuid': instance_id3, 'tenant_uuid': tenant_id2, 'created_at': now}]
+    t2_vms = [VmRecord('instance-123-t2', tenant_id2, created_at=creation_time),
+              VmRecord('instance-456-t2', tenant_id2, created_at=now),
+              VmRecord(instance_id3, tenant_id2, created_at=now)]
     fakeLeaseHandler.add_tenant_data(tenant_id2, t2_vms)
 
 
@@ -283,3 +285,90 @@ def test_get_all_instances_for_tenant2():
                      headers=headers)
     logger.debug(r.text)
     assert_equal(r.status_code, 200)
+
+
+@test(depends_on=[test_get_all_instances_for_tenant2])
+def test_create_instances_batch():
+    expiry_str = datetime.strftime(datetime.utcnow() + timedelta(minutes=2), DATE_FORMAT)
+    too_late_str = datetime.strftime(datetime.utcnow() + timedelta(days=4), DATE_FORMAT)
+    r = requests.post('http://127.0.0.1:' + port + '/v1/tenant/' + tenant_id1 + '/instances/',
+                      json=[{"instance_uuid": "batch-1", "expiry": expiry_str, "action": action1},
+                            {"instance_uuid": "batch-2", "expiry": expiry_str, "action": action2},
+                            {"instance_uuid": "batch-3", "expiry": too_late_str, "action": action1}],
+                      headers=headers)
+    logger.debug(r.text)
+    assert_equal(r.status_code, 200)
+    assert_equal([x['success'] for x in r.json()['results']], [True, True, False])
+
+    r = requests.get('http://127.0.0.1:' + port + '/v1/tenant/' + tenant_id1 + '/instance/batch-2',
+                     headers=headers)
+    assert_equal(r.status_code, 200)
+    assert_equal(r.json()['action'], action2)
+
+
+@test(depends_on=[test_create_instances_batch])
+def test_update_instances_batch_ndjson():
+    expiry_str = datetime.strftime(datetime.utcnow() + timedelta(minutes=1), DATE_FORMAT)
+    body = "\n".join([
+        json.dumps({"instance_uuid": "batch-1", "expiry": expiry_str, "action": action2}),
+        json.dumps({"instance_uuid": "batch-4", "expiry": expiry_str, "action": action2})])
+    r = requests.put('http://127.0.0.1:' + port + '/v1/tenant/' + tenant_id1 + '/instances/',
+                     data=body, headers=dict(headers, **{'Content-Type': 'application/x-ndjson'}))
+    logger.debug(r.text)
+    assert_equal(r.status_code, 200)
+    assert_equal(r.json()['results'],
+                 [{"instance_uuid": "batch-1", "success": True},
+                  {"instance_uuid": "batch-4", "success": False, "error": "Not found"}])
+
+
+@test(depends_on=[test_update_instances_batch_ndjson])
+def test_get_instances_paginated():
+    url = 'http://127.0.0.1:' + port + '/v1/tenant/' + tenant_id1 + '/instances/'
+    r = requests.get(url, params={'limit': 1, 'action': action2}, headers=headers)
+    logger.debug(r.text)
+    assert_equal(r.status_code, 200)
+    assert_equal([x['instance_uuid'] for x in r.json()['all_vms']], ['batch-1'])
+    assert_equal(r.json()['next_marker'], 'batch-1')
+
+    r = requests.get(url, params={'limit': 1, 'action': action2, 'marker': 'batch-1'}, headers=headers)
+    logger.debug(r.text)
+    assert_equal([x['instance_uuid'] for x in r.json()['all_vms']], ['batch-2'])
+
+    r = requests.get(url, params={'limit': 'none'}, headers=headers)
+    assert_equal(r.status_code, 422)
+
+
+@test(depends_on=[test_get_instances_paginated])
+def test_get_instances_streamed():
+    url = 'http://127.0.0.1:' + port + '/v1/tenant/' + tenant_id1 + '/instances/'
+    r = requests.get(url, params={'action': action2}, headers=headers)
+    logger.debug(r.text)
+    assert_equal(r.status_code, 200)
+    assert_equal(r.json()['tenant_lease']['vm_lease_policy']['tenant_uuid'], tenant_id1)
+    assert_equal([x['instance_uuid'] for x in r.json()['all_vms']], ['batch-1', 'batch-2'])
+
+    r = requests.get(url, params={'action': action2}, headers=dict(headers, Accept='application/x-ndjson'))
+    logger.debug(r.text)
+    assert_equal(r.headers['Content-Type'], 'application/x-ndjson')
+    assert_equal([json.loads(line)['instance_uuid'] for line in r.text.splitlines()], ['batch-1', 'batch-2'])
+
+
+@test(depends_on=[test_get_instances_streamed])
+def test_get_instances_streamed_error():
+    from mors import mors_wsgi
+
+    def iter_instance_leases(*args):
+        raise ValueError("Invalid lease filter")
+        yield
+
+    # The query fails before the first row, the error goes through error_handler
+    mors_wsgi.lease_manager.iter_instance_leases = iter_instance_leases
+    try:
+        url = 'http://127.0.0.1:' + port + '/v1/tenant/' + tenant_id1 + '/instances/'
+        for accept in ('application/json', 'application/x-ndjson'):
+            r = requests.get(url, headers=dict(headers, Accept=accept))
+            logger.debug(r.text)
+            assert_equal(r.status_code, 422)
+            assert_equal(r.json(), {'error': 'Invalid lease filter'})
+    finally:
+        del mors_wsgi.lease_manager.iter_instance_leases
@@ -0,0 +1,150 @@
+"""
+Copyright 2016 Platform9 Systems Inc.(http://www.platform9.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from proboscis import test
+from proboscis.asserts import assert_equal, assert_true
+from migrate.versioning.api import upgrade, version_control
+from datetime import datetime, timedelta
+from six.moves.configparser import ConfigParser
+from mors.lease_manager import LeaseManager
+from mors.leasehandler.constants import SUCCESS_OK
+from mors.leasehandler.fake_lease_handler import FakeLeaseHandler
+from mors.records import VmRecord
+import os
+
+TEST_DB = "test/test_coordination.db"
+DB_URL = "sqlite:///" + TEST_DB
+HEARTBEAT_TIMEOUT = 30
+tenants = ["shard-tenant-%d" % i for i in range(40)]
+lease_managers = []
+
+
+def _get_conf(member_id):
+    conf = ConfigParser()
+    conf.read_dict({"DEFAULT": {"db_conn": DB_URL,
+                                "lease_handler": "test",
+                                "sleep_seconds": "60",
+                                "scheduler_sharding": "True",
+                                "scheduler_member_id": member_id,
+                                "scheduler_heartbeat_timeout": str(HEARTBEAT_TIMEOUT)}})
+    return conf
+
+
+def _get_owners():
+    owners = {}
+    for lm in lease_managers:
+        for tenant in tenants:
+            if lm.coordinator.owns(tenant):
+                owners.setdefault(tenant, []).append(lm.coordinator.member_id)
+    return owners
+
+
+@test
+def setup_coordination():
+    if os.path.exists(TEST_DB):
+        os.remove(TEST_DB)
+    version_control(DB_URL, "./mors_repo")
+    upgrade(DB_URL, "./mors_repo")
+    for i in range(3):
+        lease_managers.append(LeaseManager(_get_conf("member-%d" % i)))
+
+    now = datetime.utcnow()
+    created_at = now - timedelta(days=1)
+    for tenant in tenants:
+        lease_managers[0].domain_mgr.add_tenant_lease(tenant, 60, "delete", "a@xyz.com", now)
+        FakeLeaseHandler.tenants[tenant] = [VmRecord(tenant + "-vm", tenant, created_at=created_at)]
+
+
+@test(depends_on=[setup_coordination])
+def test_tenants_partitioned():
+    now = datetime.utcnow()
+    for lm in lease_managers:
+        lm.coordinator.refresh(now)
+    # The first members only saw themselves, refresh until everyone sees all members
+    for lm in lease_managers:
+        lm.coordinator.refresh(now)
+
+    owners = _get_owners()
+    assert_equal(sorted(owners.keys()), sorted(tenants))
+    assert_true(all(len(x) == 1 for x in owners.values()))
+    assert_equal(len(set(x[0] for x in owners.values())), 3)
+
+
+@test(depends_on=[test_tenants_partitioned])
+def test_scheduler_runs_do_not_overlap():
+    deleted = []
+
+    def delete_vms(vms):
+        deleted.extend(vm.instance_uuid for vm in vms)
+        return dict((vm.instance_uuid, SUCCESS_OK) for vm in vms)
+
+    for lm in lease_managers:
+        lm.lease_handler.delete_vms = delete_vms
+        lm.run()
+        lm._scheduler_timer.cancel()
+    assert_equal(sorted(deleted), sorted(tenant + "-vm" for tenant in tenants))
+
+
+@test(depends_on=[test_scheduler_runs_do_not_overlap])
+def test_rebalance_on_expired_heartbeat():
+    before = _get_owners()
+    # member-2 stops heartbeating while the others keep going
+    later = datetime.utcnow() + timedelta(seconds=HEARTBEAT_TIMEOUT + 1)
+    lease_managers[1].coordinator.heartbeat(later)
+    lease_managers[0].coordinator.refresh(later)
+    lease_managers[1].coordinator.refresh(later)
+    del lease_managers[2]
+
+    after = _get_owners()
+    assert_equal(sorted(after.keys()), sorted(tenants))
+    assert_true(all(len(x) == 1 for x in after.values()))
+    # Only the tenants of the expired member move
+    for tenant in tenants:
+        if before[tenant][0] != "member-2":
+            assert_equal(after[tenant], before[tenant])
+
+
+@test(depends_on=[test_rebalance_on_expired_heartbeat])
+def test_fencing_on_member_join():
+    lm = lease_managers[0]
+    owned_at_start = set(x for x in tenants if lm.coordinator.owns(x))
+    created_at = datetime.utcnow() - timedelta(days=1)
+    for tenant in tenants:
+        FakeLeaseHandler.tenants[tenant] = [VmRecord(tenant + "-vm", tenant, created_at=created_at)]
+    new_member = LeaseManager(_get_conf("member-3"))
+    get_all_vms = lm.lease_handler.lease_handler.get_all_vms
+    deleted = []
+
+    def joining_get_all_vms(tenant_uuid, action=None):
+        # member-3 joins once the cycle of member-0 is under way
+        new_member.coordinator.heartbeat()
+        return get_all_vms(tenant_uuid, action)
+
+    def delete_vms(vms):
+        deleted.extend(vm.tenant_uuid for vm in vms)
+        return dict((vm.instance_uuid, SUCCESS_OK) for vm in vms)
+
+    lm.lease_handler.lease_handler.get_all_vms = joining_get_all_vms
+    lm.lease_handler.delete_vms = delete_vms
+    lm.coordinator.fence_seconds = 0
+    lm.run()
+    lm._scheduler_timer.cancel()
+    # The tenants moved to member-3 were left alone, member-0 acted on the ones it kept
+    assert_true("member-3" in lm.coordinator.ring.members)
+    kept = set(x for x in owned_at_start if lm.coordinator.owns(x))
+    assert_true(0 < len(kept) < len(owned_at_start))
+    assert_equal(sorted(deleted), sorted(kept))
+    assert_equal(lm.last_full_scan_time, None)
+    os.remove(TEST_DB)
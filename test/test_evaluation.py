@@ -0,0 +1,54 @@
+"""
+Copyright 2016 Platform9 Systems Inc.(http://www.platform9.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from proboscis import test
+from proboscis.asserts import assert_equal
+from datetime import datetime, timedelta
+from mors import evaluation
+from mors.records import VmRecord
+from mors.serialization import DATE_FORMAT
+
+
+def _make_vms(count, now):
+    # Creation times as listed by Nova around the one day cutoff, including VMs created exactly at it
+    return [VmRecord("vm-%d" % i, "tenant-1", "ACTIVE",
+                     created=(now - timedelta(days=1, seconds=(i % 7) - 3)).strftime(DATE_FORMAT))
+            for i in range(count)]
+
+
+@test
+def test_engines_agree():
+    now = datetime.utcnow().replace(microsecond=0)
+    add_seconds = timedelta(days=1)
+    vms = _make_vms(3000, now)
+    lease_ids = set("vm-%d" % i for i in range(0, len(vms), 5))
+    expired = evaluation.get_expired_vms(vms, lease_ids, now, add_seconds)
+    assert_equal(len(expired), len([x for x in vms if x.created_at < now - add_seconds and
+                                    x.instance_uuid not in lease_ids]))
+    evaluator = evaluation.get_evaluator(evaluation.ENGINE_NUMPY)
+    assert_equal(evaluator(vms, lease_ids, now, add_seconds), expired)
+    assert_equal(evaluator(vms, set(), now, add_seconds), evaluation.get_expired_vms(vms, set(), now, add_seconds))
+    later = now + timedelta(microseconds=500000)
+    assert_equal(evaluator(vms, lease_ids, later, add_seconds),
+                 evaluation.get_expired_vms(vms, lease_ids, later, add_seconds))
+    assert_equal(evaluator([], lease_ids, now, add_seconds), [])
+    # Parsed creation times are evaluated the same
+    parsed = [VmRecord(x.instance_uuid, x.tenant_uuid, x.status, x.created_at) for x in vms]
+    assert_equal(evaluator(parsed, lease_ids, now, add_seconds), expired)
+
+
+@test
+def test_unknown_engine():
+    assert_equal(evaluation.get_evaluator("fortran"), evaluation.get_expired_vms)
@@ -0,0 +1,63 @@
+"""
+Copyright 2016 Platform9 Systems Inc.(http://www.platform9.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from datetime import datetime, timedelta
+from proboscis import test
+from proboscis.asserts import assert_equal, assert_true, assert_false
+from mors.expiry_index import ExpiryIndex, INSTANCE
+
+
+@test
+def test_expiry_index_order():
+    now = datetime.utcnow()
+    index = ExpiryIndex()
+    assert_equal(index.next_due(), None)
+    assert_true(index.push_instance("instance-1", now + timedelta(minutes=5), "tenant-1"))
+    assert_true(index.push_tenant("tenant-2", now + timedelta(minutes=1)))
+    assert_false(index.push_instance("instance-3", now + timedelta(minutes=10), "tenant-3"))
+    assert_equal(index.next_due(), now + timedelta(minutes=1))
+    assert_equal(len(index), 3)
+
+    assert_equal(index.pop_due(now), set())
+    assert_equal(index.pop_due(now + timedelta(minutes=5)), {"tenant-1", "tenant-2"})
+    assert_equal(index.next_due(), now + timedelta(minutes=10))
+    assert_equal(len(index), 1)
+
+
+@test
+def test_expiry_index_update_and_remove():
+    now = datetime.utcnow()
+    index = ExpiryIndex()
+    index.push_instance("instance-1", now + timedelta(minutes=1), "tenant-1")
+    index.push_instance("instance-2", now + timedelta(minutes=2), "tenant-1")
+    index.push_tenant("tenant-1", now + timedelta(minutes=3))
+    index.push_instance("instance-3", now + timedelta(minutes=4), "tenant-2")
+
+    # Moving an entry later leaves a stale heap item that must be skipped
+    index.push_instance("instance-1", now + timedelta(minutes=5), "tenant-1")
+    assert_equal(index.next_due(), now + timedelta(minutes=2))
+
+    index.remove(INSTANCE, "instance-2")
+    assert_equal(index.next_due(), now + timedelta(minutes=3))
+
+    # A retry does not postpone an earlier tenant entry
+    assert_false(index.push_tenant("tenant-1", now + timedelta(minutes=6), keep_earlier=True))
+    assert_equal(index.next_due(), now + timedelta(minutes=3))
+
+    index.remove_tenant("tenant-1")
+    assert_equal(len(index), 1)
+    assert_equal(index.next_due(), now + timedelta(minutes=4))
+    assert_equal(index.pop_due(now + timedelta(minutes=10)), {"tenant-2"})
+    assert_equal(index.next_due(), None)
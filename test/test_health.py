@@ -0,0 +1,116 @@
+"""
+Copyright 2016 Platform9 Systems Inc.(http://www.platform9.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import eventlet
+from proboscis import test
+from proboscis.asserts import assert_equal, assert_true
+from migrate.versioning.api import upgrade, version_control
+from six.moves.configparser import ConfigParser
+from mors import mors_wsgi
+from mors.lease_manager import LeaseManager
+import os
+
+TEST_DB = "test/test_health.db"
+DB_URL = "sqlite:///" + TEST_DB
+DB_PING_CACHE_SECONDS = 30
+client = None
+lease_manager = None
+
+
+def _get_ready():
+    # The readiness probe reads the lease manager of the API, which test_api may have started
+    previous = mors_wsgi.lease_manager
+    mors_wsgi.lease_manager = lease_manager
+    try:
+        return client.get('/ready')
+    finally:
+        mors_wsgi.lease_manager = previous
+
+
+def _count_pings(ping):
+    pings = []
+
+    def counting_ping():
+        pings.append(1)
+        return ping()
+    lease_manager.domain_mgr.ping = counting_ping
+    return pings
+
+
+@test
+def setup_health():
+    global client, lease_manager
+    if os.path.exists(TEST_DB):
+        os.remove(TEST_DB)
+    version_control(DB_URL, "./mors_repo")
+    upgrade(DB_URL, "./mors_repo")
+    conf = ConfigParser()
+    conf.read_dict({"DEFAULT": {"db_conn": DB_URL,
+                                "lease_handler": "test",
+                                "sleep_seconds": "60",
+                                "db_ping_timeout": "0.1",
+                                "db_ping_cache_seconds": str(DB_PING_CACHE_SECONDS)}})
+    lease_manager = LeaseManager(conf)
+    lease_manager.run()
+    lease_manager._scheduler_timer.cancel()
+    client = mors_wsgi.health_app_factory({}).test_client()
+
+
+@test(depends_on=[setup_health])
+def test_ready_reads_published_state():
+    handler = lease_manager.lease_handler.lease_handler
+    handler.calls.clear()
+    for _ in range(3):
+        r = _get_ready()
+        assert_equal(r.status_code, 200)
+        assert_equal(r.get_json()['scheduler'], lease_manager.get_scheduler_state())
+    # The probe never lists VMs
+    assert_equal(sum(handler.calls.values()), 0)
+
+
+@test(depends_on=[setup_health])
+def test_db_ping_cached():
+    ping = lease_manager.domain_mgr.ping
+    pings = _count_pings(ping)
+    try:
+        lease_manager._db_health = None
+        for _ in range(3):
+            assert_equal(_get_ready().status_code, 200)
+        assert_equal(len(pings), 1)
+        # The cached result is used for db_ping_cache_seconds
+        lease_manager._db_health_checked_at -= DB_PING_CACHE_SECONDS
+        assert_equal(_get_ready().status_code, 200)
+        assert_equal(len(pings), 2)
+    finally:
+        del lease_manager.domain_mgr.ping
+
+
+@test(depends_on=[test_db_ping_cached, test_ready_reads_published_state])
+def test_db_ping_timeout():
+    def slow_ping():
+        eventlet.sleep(1)
+
+    lease_manager.domain_mgr.ping = slow_ping
+    try:
+        lease_manager._db_health = None
+        r = _get_ready()
+        assert_equal(r.status_code, 503)
+        assert_true("timed out" in r.get_json()['reason'])
+    finally:
+        del lease_manager.domain_mgr.ping
+        lease_manager._db_health = None
+    assert_equal(_get_ready().status_code, 200)
+    lease_manager.domain_mgr.engine.dispose()
+    os.remove(TEST_DB)
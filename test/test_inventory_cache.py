@@ -0,0 +1,103 @@
+"""
+Copyright 2016 Platform9 Systems Inc.(http://www.platform9.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import time
+
+from proboscis import test
+from proboscis.asserts import assert_equal, assert_raises
+from six.moves.configparser import ConfigParser
+from datetime import datetime
+from mors.leasehandler import get_lease_handler
+from mors.leasehandler.fake_lease_handler import FakeLeaseHandler
+from mors.leasehandler.inventory_cache import CachedLeaseHandler
+from mors.records import VmRecord
+
+TENANT = "cache-tenant"
+
+
+def _get_conf(**options):
+    defaults = {"lease_handler": "test", "sleep_seconds": "60"}
+    defaults.update(options)
+    conf = ConfigParser()
+    conf.read_dict({"DEFAULT": defaults})
+    return conf
+
+
+def _get_cached_handler(ttl):
+    FakeLeaseHandler.tenants[TENANT] = [VmRecord(TENANT + "-vm-%d" % i, TENANT, created_at=datetime.utcnow())
+                                        for i in range(3)]
+    return CachedLeaseHandler(FakeLeaseHandler(_get_conf()), ttl)
+
+
+@test
+def test_default_ttl_is_the_scheduler_period():
+    assert_equal(get_lease_handler(_get_conf()).cache.ttl, 60)
+    assert_equal(get_lease_handler(_get_conf(sleep_seconds="300")).cache.ttl, 300)
+    assert_equal(get_lease_handler(_get_conf(inventory_cache_ttl="10")).cache.ttl, 10)
+
+
+@test
+def test_cache_hit():
+    handler = _get_cached_handler(60)
+    vms = handler.get_all_vms(TENANT)
+    assert_equal(handler.get_all_vms(TENANT), vms)
+    handler.get_all_vms_by_tenant()
+    handler.get_all_vms_by_tenant()
+    assert_equal(handler.lease_handler.calls['get_all_vms'], 1)
+    assert_equal(handler.lease_handler.calls['get_all_vms_by_tenant'], 1)
+    # Listings for another action are cached separately
+    handler.get_all_vms(TENANT, "power off")
+    assert_equal(handler.lease_handler.calls['get_all_vms'], 2)
+    assert_equal(handler.cache_stats()['hits'], 2)
+
+
+@test
+def test_cache_expiry():
+    handler = _get_cached_handler(0.05)
+    handler.get_all_vms(TENANT)
+    time.sleep(0.1)
+    handler.get_all_vms(TENANT)
+    assert_equal(handler.lease_handler.calls['get_all_vms'], 2)
+
+
+@test
+def test_cache_invalidation():
+    handler = _get_cached_handler(60)
+    vms = handler.get_all_vms(TENANT)
+    handler.get_all_vms(TENANT, "power off")
+    handler.get_all_vms_by_tenant()
+    handler.delete_vms(vms[:1])
+    # Every listing of the tenant and the listing of all tenants are fetched again
+    assert_equal(len(handler.get_all_vms(TENANT)), 2)
+    assert_equal(len(handler.get_all_vms(TENANT, "power off")), 2)
+    assert_equal(len(handler.get_all_vms_by_tenant()[TENANT]), 2)
+    assert_equal(handler.lease_handler.calls['get_all_vms'], 4)
+    assert_equal(handler.lease_handler.calls['get_all_vms_by_tenant'], 2)
+
+
+@test
+def test_failed_listing_is_not_cached():
+    handler = _get_cached_handler(60)
+    get_all_vms = handler.lease_handler.get_all_vms
+    failures = [RuntimeError("Nova is unavailable")]
+
+    def failing_get_all_vms(tenant_uuid, action=None):
+        if failures:
+            raise failures.pop()
+        return get_all_vms(tenant_uuid, action)
+
+    handler.lease_handler.get_all_vms = failing_get_all_vms
+    assert_raises(RuntimeError, handler.get_all_vms, TENANT)
+    assert_equal(len(handler.get_all_vms(TENANT)), 3)
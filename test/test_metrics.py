@@ -0,0 +1,56 @@
+"""
+Copyright 2016 Platform9 Systems Inc.(http://www.platform9.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from proboscis import test
+from proboscis.asserts import assert_equal, assert_true
+from mors.metrics import Registry, render
+
+
+@test
+def test_histogram_buckets():
+    registry = Registry()
+    histogram = registry.histogram('test_duration_seconds', 'Test durations', ('operation',), buckets=(0.1, 1.0))
+    histogram.observe(0.05, ('list',))
+    histogram.observe(0.1, ('list',))
+    histogram.observe(5, ('list',))
+    value = histogram.get(('list',))
+    assert_equal(value['count'], 3)
+    assert_equal(value['buckets'], {0.1: 2, 1.0: 2, float('inf'): 3})
+    assert_equal(histogram.get(('delete',))['count'], 0)
+
+
+@test
+def test_render():
+    registry = Registry()
+    registry.counter('test_errors_total', 'Test errors', ('operation',)).inc(labels=('say "hi"',))
+    registry.gauge('test_in_use', 'Test gauge', lambda: 3)
+    registry.histogram('test_duration_seconds', 'Test durations', buckets=(1.0,)).observe(0.5)
+    text = render(registry)
+    assert_true('# TYPE test_errors_total counter\n' in text)
+    assert_true('test_errors_total{operation="say \\"hi\\""} 1\n' in text)
+    assert_true('test_in_use 3\n' in text)
+    assert_true('test_duration_seconds_bucket{le="1.0"} 1\n' in text)
+    assert_true('test_duration_seconds_bucket{le="+Inf"} 1\n' in text)
+    assert_true('test_duration_seconds_count 1\n' in text)
+
+
+@test
+def test_gauge_without_function():
+    registry = Registry()
+    gauge = registry.gauge('test_in_use', 'Test gauge')
+    assert_equal(gauge.get(), None)
+    assert_true('\ntest_in_use ' not in render(registry))
+    gauge.set_function(lambda: 5)
+    assert_true('test_in_use 5\n' in render(registry))
@@ -0,0 +1,123 @@
+"""
+Copyright 2016 Platform9 Systems Inc.(http://www.platform9.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from proboscis import test
+from proboscis.asserts import assert_equal, assert_true
+from six.moves.configparser import ConfigParser
+from mors.leasehandler.constants import SUCCESS_OK, ERR_NOT_FOUND, INVENTORY_BULK, INVENTORY_INCREMENTAL
+from mors.leasehandler.http_session import get_connection_stats
+from mors.leasehandler.nova_lease_handler import NovaLeaseHandler
+import requests
+import socket
+import subprocess
+import sys
+import time
+
+STANDIN = "benchmark/openstack_standin.py"
+standin = None
+port = None
+handler = None
+
+
+def _get_free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    free_port = sock.getsockname()[1]
+    sock.close()
+    return free_port
+
+
+def _get_stats():
+    return requests.get("http://127.0.0.1:%d/standin/stats" % port).json()
+
+
+@test
+def setup_standin():
+    global standin, port, handler
+    port = _get_free_port()
+    standin = subprocess.Popen([sys.executable, STANDIN, "--port", str(port), "--tenants", "3",
+                                "--vms-per-tenant", "5", "--shutoff-ratio", "0"],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            _get_stats()
+            break
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    conf = ConfigParser()
+    conf.read_dict({"DEFAULT": {"inventory_mode": "bulk"},
+                    "nova": {"user_name": "mors", "password": "standin", "version": "2",
+                             "auth_url": "http://127.0.0.1:%d/v3" % port, "region_name": "RegionOne",
+                             "inventory_page_size": "4"}})
+    handler = NovaLeaseHandler(conf)
+
+
+@test(depends_on=[setup_standin])
+def test_list_vms():
+    assert_equal(len(handler.get_all_vms("tenant-1")), 5)
+    inventory = handler.get_all_vms_by_tenant()
+    assert_equal(sorted((tenant, len(vms)) for tenant, vms in inventory.items()),
+                 [("tenant-0", 5), ("tenant-1", 5), ("tenant-2", 5)])
+    # Pages of 4 servers following the next links, 2 for the tenant and 4 for all 15 servers
+    assert_equal(_get_stats()["servers.list"], 2 + 4)
+
+
+@test(depends_on=[test_list_vms])
+def test_poweroff_and_delete_vms():
+    vms = handler.get_all_vms("tenant-0")
+    assert_equal(set(handler.poweroff_vms(vms[:2]).values()), {SUCCESS_OK})
+    # Already stopped servers answer with a vm_state stopped conflict
+    assert_equal(set(handler.poweroff_vms(vms[:2]).values()), {SUCCESS_OK})
+    assert_equal(set(handler.delete_vms(vms[2:]).values()), {SUCCESS_OK})
+    assert_equal(set(handler.delete_vms(vms[2:]).values()), {ERR_NOT_FOUND})
+    assert_equal(sorted(x.status for x in handler.get_all_vms("tenant-0")), ["SHUTOFF", "SHUTOFF"])
+    # Only running servers are listed for the power off action
+    assert_equal(handler.get_all_vms("tenant-0", "power off"), [])
+    assert_equal(len(handler.get_all_vms("tenant-1", "power off")), 5)
+    # Keystone and Nova calls share one token and reuse pooled connections
+    assert_equal(_get_stats()["token"], 1)
+    connections = get_connection_stats()
+    assert_true(connections["connections"] < connections["requests"])
+
+
+@test(depends_on=[test_poweroff_and_delete_vms])
+def test_incremental_inventory():
+    handler.inventory_mode = INVENTORY_INCREMENTAL
+    try:
+        inventory = handler.get_all_vms_by_tenant()
+        # 3 servers of tenant-0 were deleted by the previous test
+        assert_equal(len(handler.inventory), 12)
+        deleted, stopped = inventory["tenant-1"][:2]
+        assert_equal(handler.delete_vms([deleted]), {deleted.instance_uuid: SUCCESS_OK})
+        assert_equal(handler.poweroff_vms([stopped]), {stopped.instance_uuid: SUCCESS_OK})
+
+        requests.delete("http://127.0.0.1:%d/standin/stats" % port)
+        inventory = handler.get_all_vms_by_tenant()
+        # Only the servers changed since the full sync were listed
+        assert_true(_get_stats()["servers_listed"] < 12)
+        assert_true(deleted.instance_uuid not in handler.inventory)
+        assert_equal(handler.inventory[stopped.instance_uuid].status, "SHUTOFF")
+        assert_equal(len(inventory["tenant-1"]), 4)
+        assert_equal([vm.instance_uuid for vm in handler.get_all_vms_by_tenant("power off")["tenant-1"]],
+                     [vm.instance_uuid for vm in inventory["tenant-1"] if vm.status == "ACTIVE"])
+    finally:
+        handler.inventory_mode = INVENTORY_BULK
+
+
+@test(depends_on=[test_incremental_inventory], always_run=True)
+def teardown_standin():
+    if standin is not None:
+        standin.kill()
+        standin.wait()
@@ -15,6 +15,7 @@ limitations under the License.
 """
 from proboscis import test
 from mors.persistence import DbPersistence
+from mors.persistence_cache import CachedPersistence
 import uuid
 import logging
 from migrate.versioning.api import upgrade,create,version_control
@@ -138,3 +139,139 @@ def test_apis():
                                              instance["updated_at"])
 
     _verify_instance_lease(instances)
+
+@test(depends_on=[test_apis])
+def test_expiry_queries():
+    now = datetime.utcnow()
+    db_persistence.add_instance_lease("instance-3", "tenant-3", now - timedelta(seconds=60),
+                                      "delete", "f@xyz.com", now)
+    db_persistence.add_instance_lease("instance-4", "tenant-3", now + timedelta(seconds=60),
+                                      "power off", "f@xyz.com", now)
+
+    expired = db_persistence.get_expired_instance_leases_by_tenant("tenant-3", now)
+    assert ([x.instance_uuid for x in expired] == ["instance-3"])
+    assert (expired[0].action == "delete")
+
+    unexpired = db_persistence.get_unexpired_instance_leases_by_tenant("tenant-3", now)
+    assert ([x.instance_uuid for x in unexpired] == ["instance-4"])
+    assert (unexpired[0].expiry == now + timedelta(seconds=60))
+
+@test(depends_on=[test_expiry_queries])
+def test_get_all_tenant_and_instance_leases():
+    tenant_leases, instance_leases = db_persistence.get_all_tenant_and_instance_leases()
+    assert (sorted(x.tenant_uuid for x in tenant_leases) == ["tenant-1", "tenant-2"])
+    assert ([x.instance_uuid for x in instance_leases["tenant-1"]] == ["instance-1"])
+    assert ([x.instance_uuid for x in instance_leases["tenant-2"]] == ["instance-2"])
+    # Instance leases of tenants without a tenant lease are left out
+    assert ("tenant-3" not in instance_leases)
+    # Only the leases of the tenants owned by this scheduler replica are read
+    tenant_leases, instance_leases = db_persistence.get_all_tenant_and_instance_leases(lambda x: x == "tenant-2")
+    assert ([x.tenant_uuid for x in tenant_leases] == ["tenant-2"])
+    assert (list(instance_leases) == ["tenant-2"])
+    # The owned tenants are read in several IN clauses
+    in_clause_size = db_persistence.in_clause_size
+    db_persistence.in_clause_size = 1
+    try:
+        tenant_leases, instance_leases = db_persistence.get_all_tenant_and_instance_leases(lambda x: True)
+        assert (sorted(instance_leases) == ["tenant-1", "tenant-2"])
+    finally:
+        db_persistence.in_clause_size = in_clause_size
+
+@test(depends_on=[test_get_all_tenant_and_instance_leases])
+def test_chunked_deletes():
+    now = datetime.utcnow()
+    expiry = now + timedelta(seconds=60)
+    db_persistence.add_tenant_lease("tenant-4", 10, "delete", "g@xyz.com", now)
+    db_persistence.add_instance_leases([{"instance_uuid": "instance-4-%d" % i, "tenant_uuid": "tenant-4",
+                                         "expiry": expiry, "action": "delete",
+                                         "created_by": "g@xyz.com", "created_at": now} for i in range(12)])
+    # Small chunks for this test only, the fixture is shared by the tests that follow
+    delete_batch_size = db_persistence.delete_batch_size
+    db_persistence.delete_batch_size = 5
+    try:
+        db_persistence.delete_instance_leases(["instance-4-%d" % i for i in range(7)])
+        assert (len(db_persistence.get_instance_leases_by_tenant("tenant-4")) == 5)
+
+        db_persistence.delete_tenant_lease("tenant-4")
+        assert (db_persistence.get_tenant_lease("tenant-4") is None)
+        assert (len(db_persistence.get_instance_leases_by_tenant("tenant-4")) == 0)
+    finally:
+        db_persistence.delete_batch_size = delete_batch_size
+
+@test(depends_on=[test_chunked_deletes])
+def test_pagination():
+    page = db_persistence.get_tenant_leases_page(limit=1)
+    assert ([x.tenant_uuid for x in page] == ["tenant-1"])
+    page = db_persistence.get_tenant_leases_page(limit=1, marker="tenant-1")
+    assert ([x.tenant_uuid for x in page] == ["tenant-2"])
+    assert (db_persistence.get_tenant_leases_page(action="power off") == [])
+
+    now = datetime.utcnow()
+    page = db_persistence.get_instance_leases_page("tenant-3", limit=10, expires_before=now)
+    assert ([x.instance_uuid for x in page] == ["instance-3"])
+    page = db_persistence.get_instance_leases_page("tenant-3", marker="instance-3")
+    assert ([x.instance_uuid for x in page] == ["instance-4"])
+    page = db_persistence.get_instance_leases_page("tenant-3", action="delete")
+    assert ([x.instance_uuid for x in page] == ["instance-3"])
+
+
+@test(depends_on=[test_pagination])
+def test_tenant_lease_cache():
+    cached = CachedPersistence(db_persistence, ttl=60, max_size=2, version_seconds=0)
+    assert (cached.get_tenant_lease("tenant-1").expiry_mins == db_persistence.get_tenant_lease("tenant-1").expiry_mins)
+    cached.get_tenant_lease("tenant-1")
+    assert (cached.get_tenant_lease("no-such-tenant") is None)
+    cached.get_tenant_lease("no-such-tenant")
+    assert (cached.cache_stats()['hits'] == 2)
+
+    # Writes through the cache invalidate, writes by another replica change the version stamp
+    version = db_persistence.get_tenant_lease_version()
+    cached.update_tenant_lease("tenant-1", 7, "delete", "user-1", datetime.utcnow())
+    assert (cached.get_tenant_lease("tenant-1").expiry_mins == 7)
+    db_persistence.update_tenant_lease("tenant-1", 8, "delete", "user-2", datetime.utcnow())
+    assert (db_persistence.get_tenant_lease_version() == version + 2)
+    assert (cached.get_tenant_lease("tenant-1").expiry_mins == 8)
+
+    cached.get_tenant_lease("tenant-2")
+    cached.get_tenant_lease("tenant-3")
+    assert (cached.cache_stats()['entries'] == 2)
+    assert (cached.cache_stats()['evictions'] >= 1)
+
+
+@test(depends_on=[test_tenant_lease_cache])
+def test_pool_stats():
+    stats = db_persistence.pool_stats()
+    assert (stats['size'] == 5)
+    assert (stats['in_use'] == 0)
+    assert (stats['checkout_count'] > 0)
+    assert (stats['checkout_wait_buckets']['inf'] == stats['checkout_count'])
+
+
+@test(depends_on=[test_pool_stats])
+def test_instance_action_ledger():
+    now = datetime.utcnow()
+    in_clause_size = db_persistence.in_clause_size
+    db_persistence.in_clause_size = 2
+    try:
+        db_persistence.record_instance_actions("power off", {"instance-a-%d" % i: ("tenant-1", 0) for i in range(3)},
+                                               now - timedelta(hours=2))
+        db_persistence.record_instance_actions("power off", {"instance-b-0": ("tenant-2", 0)}, now)
+        actions = db_persistence.get_instance_actions(["instance-a-%d" % i for i in range(4)])
+        assert (sorted(actions) == ["instance-a-0", "instance-a-1", "instance-a-2"])
+        assert (actions["instance-a-0"].result == 0)
+        # The ledger of a cycle is read by tenant, only the entries acted on since 'acted_after'
+        actions = db_persistence.get_instance_actions_by_tenant(now - timedelta(hours=3))
+        assert (sorted(actions) == ["tenant-1", "tenant-2"])
+        assert (sorted(actions["tenant-1"]) == ["instance-a-0", "instance-a-1", "instance-a-2"])
+        actions = db_persistence.get_instance_actions_by_tenant(now - timedelta(hours=3), ["tenant-2", "tenant-3"])
+        assert (list(actions) == ["tenant-2"])
+        assert (list(db_persistence.get_instance_actions_by_tenant(now - timedelta(hours=1))) == ["tenant-2"])
+
+        # Recording again replaces the entry, removed instances and entries acted before 'acted_before' are dropped
+        db_persistence.record_instance_actions("power off", {"instance-a-0": ("tenant-1", 2)}, now,
+                                               remove=["instance-a-1"], acted_before=now - timedelta(hours=1))
+        actions = db_persistence.get_instance_actions(["instance-a-%d" % i for i in range(3)] + ["instance-b-0"])
+        assert (sorted(actions) == ["instance-a-0", "instance-b-0"])
+        assert (actions["instance-a-0"].result == 2)
+    finally:
+        db_persistence.in_clause_size = in_clause_size
@@ -0,0 +1,273 @@
+"""
+Copyright 2016 Platform9 Systems Inc.(http://www.platform9.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from proboscis import test
+from proboscis.asserts import assert_equal, assert_true
+from migrate.versioning.api import upgrade, version_control
+from datetime import datetime, timedelta
+from six.moves.configparser import ConfigParser
+from sqlalchemy import event
+from mors.context_util import Context
+from mors.lease_manager import LeaseManager
+from mors.leasehandler.constants import SUCCESS_OK, ERR_UNKNOWN, VM_STATUS_ACTIVE, VM_STATUS_ERROR, VM_STATUS_SHUTOFF
+from mors.leasehandler.fake_lease_handler import FakeLeaseHandler
+from mors.records import VmRecord
+import eventlet
+import os
+
+# Every test runs against its own database, the scheduler acts on all the tenant leases it finds
+TEST_DB = "test/test_scheduler_%s.db"
+
+
+def _get_lease_manager(name, **options):
+    path = TEST_DB % name
+    if os.path.exists(path):
+        os.remove(path)
+    db_url = "sqlite:///" + path
+    version_control(db_url, "./mors_repo")
+    upgrade(db_url, "./mors_repo")
+    defaults = {"db_conn": db_url,
+                "lease_handler": "test",
+                "sleep_seconds": "60",
+                "inventory_cache_ttl": "0"}
+    defaults.update(options)
+    conf = ConfigParser()
+    conf.read_dict({"DEFAULT": defaults})
+    return LeaseManager(conf)
+
+
+def _remove_lease_manager(name, lm):
+    lm.domain_mgr.engine.dispose()
+    os.remove(TEST_DB % name)
+
+
+def _add_tenants(lm, prefix, count, action):
+    """
+    Tenants with a one hour policy, each owning an expired VM and a new VM
+    """
+    now = datetime.utcnow()
+    tenants = ["%s-%d" % (prefix, i) for i in range(count)]
+    for tenant in tenants:
+        lm.domain_mgr.add_tenant_lease(tenant, 60, action, "a@xyz.com", now)
+        FakeLeaseHandler.tenants[tenant] = [VmRecord(tenant + "-expired", tenant, created_at=now - timedelta(days=1)),
+                                            VmRecord(tenant + "-new", tenant, created_at=now)]
+    return tenants
+
+
+def _run(lm):
+    lm.run()
+    lm._scheduler_timer.cancel()
+
+
+def _vm_ids(tenant):
+    return [vm.instance_uuid for vm in FakeLeaseHandler.tenants[tenant]]
+
+
+@test
+def test_bulk_inventory():
+    lm = _get_lease_manager("bulk", inventory_mode="bulk")
+    tenants = _add_tenants(lm, "bulk-tenant", 3, "delete")
+    handler = lm.lease_handler.lease_handler
+    for _ in range(2):
+        handler.calls.clear()
+        _run(lm)
+        # One listing of all tenants per cycle instead of one per tenant
+        assert_equal(handler.calls['get_all_vms_by_tenant'], 1)
+        assert_equal(handler.calls['get_all_vms'], 0)
+    for tenant in tenants:
+        assert_equal(_vm_ids(tenant), [tenant + "-new"])
+    assert_equal(lm.scheduler_state['tenants'], 3)
+    _remove_lease_manager("bulk", lm)
+
+
+@test
+def test_concurrent_tenants_isolate_failures():
+    lm = _get_lease_manager("concurrency", scheduler_concurrency="4", fake_handler_latency="0.05")
+    tenants = _add_tenants(lm, "concurrent-tenant", 6, "delete")
+    handler = lm.lease_handler.lease_handler
+    in_flight = [0, 0]
+    get_all_vms = handler.get_all_vms
+    delete_vms = handler.delete_vms
+
+    def counting_get_all_vms(tenant_uuid, action=None):
+        in_flight[0] += 1
+        in_flight[1] = max(in_flight)
+        try:
+            return get_all_vms(tenant_uuid, action)
+        finally:
+            in_flight[0] -= 1
+
+    def failing_delete_vms(vms):
+        if vms[0].tenant_uuid == tenants[2]:
+            raise RuntimeError("Nova is unavailable")
+        return delete_vms(vms)
+
+    handler.get_all_vms = counting_get_all_vms
+    handler.delete_vms = failing_delete_vms
+    _run(lm)
+    # The tenants were listed by several green threads at once
+    assert_equal(in_flight[1], 4)
+    assert_equal(lm.scheduler_state['failed_tenants'], 1)
+    assert_equal(lm.scheduler_state['tenants'], 6)
+    assert_equal(lm.scheduler_state['deleted'], 5)
+    # The other tenants were enforced, the failed tenant keeps its expired VM
+    for tenant in tenants[:2] + tenants[3:]:
+        assert_equal(_vm_ids(tenant), [tenant + "-new"])
+    assert_equal(_vm_ids(tenants[2]), [tenants[2] + "-expired", tenants[2] + "-new"])
+    _remove_lease_manager("concurrency", lm)
+
+
+@test
+def test_event_mode():
+    max_sleep_seconds = 600
+    # VMs Nova failed to act on are retried after sleep_seconds
+    lm = _get_lease_manager("event", scheduler_mode="event", max_sleep_seconds=str(max_sleep_seconds),
+                            sleep_seconds="1")
+    tenants = _add_tenants(lm, "event-tenant", 3, "delete")
+    handler = lm.lease_handler.lease_handler
+    lm.run()
+    # Nothing expires before the next full scan
+    full_scan_run_time = lm.next_run_time
+    assert_true(full_scan_run_time > datetime.utcnow() + timedelta(seconds=max_sleep_seconds - 10))
+
+    # An instance lease expiring sooner moves the next run earlier
+    expiry = datetime.utcnow() + timedelta(seconds=1)
+    lm.add_instance_lease(Context("a@xyz.com", "a@xyz.com", "admin", tenants[0]), tenants[0],
+                          {'instance_uuid': tenants[0] + "-new", 'expiry': expiry, 'action': 'delete'})
+    assert_true(lm.next_run_time < full_scan_run_time)
+    assert_true(lm.next_run_time < expiry + timedelta(seconds=1))
+    lm._scheduler_timer.cancel()
+
+    # The due run only looks at the tenant of the expired lease
+    eventlet.sleep(1.1)
+    handler.calls.clear()
+    _run(lm)
+    assert_equal(handler.calls['get_all_vms'], 1)
+    assert_equal(lm.scheduler_state['tenants'], 1)
+    assert_equal(_vm_ids(tenants[0]), [])
+    # The due run keeps the full scan deadline
+    assert_true(lm.next_run_time < full_scan_run_time + timedelta(seconds=1))
+
+    # A VM Nova failed to delete is retried before the full scan deadline
+    expiry = datetime.utcnow() + timedelta(seconds=1)
+    lm.add_instance_lease(Context("a@xyz.com", "a@xyz.com", "admin", tenants[1]), tenants[1],
+                          {'instance_uuid': tenants[1] + "-new", 'expiry': expiry, 'action': 'delete'})
+    lm._scheduler_timer.cancel()
+    failures = [ERR_UNKNOWN]
+    delete_vms = handler.delete_vms
+
+    def failing_delete_vms(vms):
+        if failures:
+            return dict((vm.instance_uuid, failures.pop()) for vm in vms)
+        return delete_vms(vms)
+
+    handler.delete_vms = failing_delete_vms
+    try:
+        eventlet.sleep(1.1)
+        _run(lm)
+        assert_equal(_vm_ids(tenants[1]), [tenants[1] + "-new"])
+        assert_true(lm.next_run_time < datetime.utcnow() + timedelta(seconds=2))
+        eventlet.sleep(1.1)
+        handler.calls.clear()
+        _run(lm)
+        assert_equal(handler.calls['get_all_vms'], 1)
+        assert_equal(_vm_ids(tenants[1]), [])
+    finally:
+        del handler.delete_vms
+
+    # Once max_sleep_seconds have passed since the last full scan every tenant is scanned again
+    lm.last_full_scan_time -= timedelta(seconds=max_sleep_seconds + 1)
+    handler.calls.clear()
+    _run(lm)
+    assert_equal(handler.calls['get_all_vms'], 3)
+    assert_equal(lm.scheduler_state['tenants'], 3)
+    _remove_lease_manager("event", lm)
+
+
+@test
+def test_skip_powered_off_vms():
+    lm = _get_lease_manager("skip")
+    now = datetime.utcnow()
+    tenant = "skip-tenant"
+    # The tenant policy deletes, the listing is not filtered on the power off statuses
+    lm.domain_mgr.add_tenant_lease(tenant, 60, "delete", "a@xyz.com", now)
+    statuses = (("shutoff", VM_STATUS_SHUTOFF), ("active", VM_STATUS_ACTIVE),
+                ("paused", "PAUSED"), ("paused-acted", "PAUSED"))
+    FakeLeaseHandler.tenants[tenant] = [VmRecord("%s-%s" % (tenant, name), tenant, status, created_at=now)
+                                        for name, status in statuses]
+    for vm in FakeLeaseHandler.tenants[tenant]:
+        lm.domain_mgr.add_instance_lease(vm.instance_uuid, tenant, now - timedelta(minutes=1), "power off",
+                                         "a@xyz.com", now)
+    # One VM was powered off within action_recheck_seconds, one was powered off long before
+    lm.domain_mgr.record_instance_actions("power off", {tenant + "-paused-acted": (tenant, SUCCESS_OK)},
+                                          now - timedelta(minutes=1))
+    lm.domain_mgr.record_instance_actions("power off", {tenant + "-gone": (tenant, SUCCESS_OK)},
+                                          now - timedelta(seconds=lm.action_recheck_seconds + 60))
+    handler = lm.lease_handler.lease_handler
+    _run(lm)
+    # SHUTOFF is skipped, ACTIVE is powered off again, the other statuses go by the ledger
+    assert_equal(sorted(handler.powered_off), [tenant + "-active", tenant + "-paused"])
+    assert_equal(lm.scheduler_state['powered_off'], 2)
+    # Writing the ledger of the cycle pruned the entries older than action_recheck_seconds
+    assert_equal(list(lm.domain_mgr.get_instance_actions([tenant + "-gone"])), [])
+
+    # Past action_recheck_seconds the ledger entry is not trusted anymore
+    acted = FakeLeaseHandler.tenants[tenant][3]
+    ledger = lm.domain_mgr.get_instance_actions([acted.instance_uuid])
+    assert_equal(lm._skip_powered_off_vms(tenant, [acted], [acted], datetime.utcnow(), ledger), [])
+    later = datetime.utcnow() + timedelta(seconds=lm.action_recheck_seconds + 1)
+    assert_equal(lm._skip_powered_off_vms(tenant, [acted], [acted], later, ledger), [acted])
+    _remove_lease_manager("skip", lm)
+
+
+@test
+def test_power_off_once():
+    lm = _get_lease_manager("power-off-once")
+    _add_tenants(lm, "power-off-tenant", 2, "power off")
+    handler = lm.lease_handler.lease_handler
+    _run(lm)
+    assert_equal(handler.calls['poweroff_vm'], 2)
+    assert_equal(lm.scheduler_state['powered_off'], 2)
+    # The fake VMs have no status and are listed again, the ledger keeps them from being stopped twice
+    handler.calls.clear()
+    queries = []
+    event.listen(lm.domain_mgr.engine, 'before_cursor_execute', lambda *x: queries.append(1))
+    _run(lm)
+    assert_equal(handler.calls['get_all_vms'], 2)
+    assert_equal(handler.calls['poweroff_vm'], 0)
+    assert_equal(lm.scheduler_state['powered_off'], 0)
+    # The leases and the ledger are read once per cycle, not once per tenant
+    assert_equal(len(queries), 3)
+    _remove_lease_manager("power-off-once", lm)
+
+
+@test
+def test_power_off_error_vms():
+    lm = _get_lease_manager("power-off-error")
+    now = datetime.utcnow()
+    tenant = "power-off-error-tenant"
+    lm.domain_mgr.add_tenant_lease(tenant, 60, "power off", "a@xyz.com", now)
+    FakeLeaseHandler.tenants[tenant] = [VmRecord("%s-%s" % (tenant, status.lower()), tenant, status,
+                                                 created_at=now - timedelta(days=1))
+                                        for status in (VM_STATUS_ACTIVE, VM_STATUS_ERROR, VM_STATUS_SHUTOFF)]
+    handler = lm.lease_handler.lease_handler
+    _run(lm)
+    # Nova stops VMs in error, stopped VMs are not listed for the power off action
+    assert_equal(sorted(handler.powered_off), [tenant + "-active", tenant + "-error"])
+    # The status of a VM in error does not change when stopped, the ledger keeps it from being stopped again
+    handler.powered_off.clear()
+    _run(lm)
+    assert_equal(sorted(handler.powered_off), [tenant + "-active"])
+    _remove_lease_manager("power-off-error", lm)
@@ -0,0 +1,86 @@
+"""
+Copyright 2016 Platform9 Systems Inc.(http://www.platform9.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import json
+import os
+from eventlet import GreenPool
+from proboscis import test
+from proboscis.asserts import assert_equal, assert_true
+from mors.tracing import Tracer, JsonLinesExporter, NOOP_SPAN
+
+TRACE_FILE = "test/test_traces.jsonl"
+
+
+class ListExporter:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+@test
+def test_nested_spans():
+    exporter = ListExporter()
+    tracer = Tracer(exporter)
+    assert_true(tracer.span('orphan') is NOOP_SPAN)
+    with tracer.span('cycle', root=True) as cycle:
+        with tracer.span('tenant', tenant_uuid='tenant-1') as tenant:
+            tenant.set_attribute('vm_count', 3)
+        # Green threads do not see the current span unless it is passed or attached
+        pool = GreenPool(2)
+        assert_equal(list(pool.imap(lambda x: tracer.span('lost'), range(2))), [NOOP_SPAN, NOOP_SPAN])
+
+        def child(parent):
+            with tracer.attach(parent):
+                with tracer.span('attached'):
+                    pass
+        pool.spawn(child, cycle)
+        pool.waitall()
+    assert_equal([x.name for x in exporter.spans], ['tenant', 'attached', 'cycle'])
+    assert_equal(set(x.trace_id for x in exporter.spans), {cycle.trace_id})
+    assert_equal(exporter.spans[0].parent_id, cycle.span_id)
+    assert_equal(exporter.spans[0].attributes, {'tenant_uuid': 'tenant-1', 'vm_count': 3})
+    assert_equal(exporter.spans[1].parent_id, cycle.span_id)
+
+
+@test
+def test_sampling():
+    exporter = ListExporter()
+    tracer = Tracer(exporter, sample_rate=0)
+    with tracer.span('cycle', root=True):
+        with tracer.span('tenant'):
+            pass
+    assert_equal(exporter.spans, [])
+    assert_true(Tracer().span('cycle', root=True) is NOOP_SPAN)
+
+
+@test
+def test_jsonl_exporter():
+    if os.path.exists(TRACE_FILE):
+        os.remove(TRACE_FILE)
+    tracer = Tracer(JsonLinesExporter(TRACE_FILE))
+    try:
+        with tracer.span('cycle', root=True, tenant_count=2):
+            raise ValueError("failed")
+    except ValueError:
+        pass
+    with open(TRACE_FILE) as f:
+        spans = [json.loads(line) for line in f]
+    os.remove(TRACE_FILE)
+    assert_equal(len(spans), 1)
+    assert_equal(spans[0]['name'], 'cycle')
+    assert_equal(spans[0]['attributes'], {'tenant_count': 2})
+    assert_true('failed' in spans[0]['error'])